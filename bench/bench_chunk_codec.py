@@ -0,0 +1,60 @@
+'''
+Compare the trip chunk codecs: bytes stored per chunk and encode/decode
+throughput, on synthetic trips from the Socrata stub.
+
+Usage: python bench/bench_chunk_codec.py [--trips 100000] [--repeat 3]
+
+With REDIS_IP set, the time to GET and decode a stored chunk is measured
+as well.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+from chunk_codec import available_codecs, encode_chunk, decode_chunk
+from socrata_stub import synthetic_kiosks, synthetic_trips
+
+def _best_of(repeat, function):
+    # fastest of `repeat` runs, in seconds
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=100000, help='trips per chunk')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the fastest is reported')
+    args = parser.parse_args()
+
+    trips = synthetic_trips(args.trips, synthetic_kiosks())
+    db = None
+    if os.environ.get('REDIS_IP'):
+        import redis
+        db = redis.Redis(host=os.environ['REDIS_IP'], port=6379, db=15)
+
+    print(f"{args.trips} trips per chunk")
+    print(f"{'codec':<16}{'bytes':>12}{'ratio':>8}{'encode MB/s':>13}{'decode MB/s':>13}{'trips/s':>12}"
+          + (f"{'GET+decode ms':>15}" if db else ''))
+    baseline = None
+    for codec in available_codecs():
+        blob, raw_nbytes = encode_chunk(trips, codec)
+        baseline = baseline or raw_nbytes
+        encode = _best_of(args.repeat, lambda: encode_chunk(trips, codec))
+        decode = _best_of(args.repeat, lambda: decode_chunk(blob))
+        line = (f"{codec:<16}{len(blob):>12}{baseline / len(blob):>8.1f}{raw_nbytes / encode / 1e6:>13.1f}"
+                f"{raw_nbytes / decode / 1e6:>13.1f}{args.trips / decode:>12.0f}")
+        if db:
+            db.set('bench chunk', blob)
+            line += f"{_best_of(args.repeat, lambda: decode_chunk(db.get('bench chunk'))) * 1000:>15.1f}"
+        print(line)
+    if db:
+        db.delete('bench chunk')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+'''
+Time the data access and job code paths at several dataset sizes, and
+write the results as JSON so they can be compared between commits.
+
+Each size is loaded from the seeded generator in bench/synthetic.py into an
+in-process fakeredis server (or the Redis at --redis-ip, databases 15 and
+14, which are flushed), then every stage is run --repeat times and the
+fastest run reported, followed by one more run under tracemalloc for its
+peak memory. Stages marked cold start from an empty dataset cache.
+
+The filter_trips stages run the chunk-wise date and location filter of
+parallel_query on pools of each of --processes sizes, and report their
+speedup over one process.
+
+Usage: python bench/bench_queries.py [--sizes 10000 100000 1000000] [--output results.json]
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import redis
+import data_lib as d
+import parallel_query
+import worker
+from ingest import ingest_trips
+import synthetic
+
+# Query parameters: three months around campus, as the jobs' defaults
+CAMPUS = (30.2862730619728, -97.73937727490916)
+RADIUS_KM = 1.609344
+START, END = datetime(2023, 9, 1), datetime(2023, 11, 30)
+
+def _connect(redis_ip: str) -> tuple:
+    if redis_ip:
+        return redis.Redis(host=redis_ip, port=6379, db=15), redis.Redis(host=redis_ip, port=6379, db=14)
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install fakeredis, or pass --redis-ip")
+    server = fakeredis.FakeServer()
+    return fakeredis.FakeRedis(server=server, db=0), fakeredis.FakeRedis(server=server, db=1)
+
+def load(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis, n_trips: int, seed: int) -> list:
+    '''Replace the data in trips_db and kiosk_db with `n_trips` synthetic trips, as /data would.'''
+    # keep the generation increasing, so no cached data from the previous size is used
+    generation = d.get_generation(trips_db)
+    trips_db.flushdb()
+    kiosk_db.flushdb()
+    kiosk_data = synthetic.kiosks(seed=seed)
+    ingest_trips(trips_db, synthetic.trip_pages(n_trips, kiosk_data, seed))
+    d.update_trip_rollups(trips_db, d.load_trip_columns(trips_db))
+    kiosk_db.set('kiosks', json.dumps(kiosk_data))
+    d.store_kiosk_index(kiosk_db, kiosk_data)
+    d.set_generation(trips_db, generation + 1)
+    return kiosk_data
+
+def _busiest_route(trips_db: redis.client.Redis) -> tuple:
+    index = d.cached_route_index(trips_db)
+    route = int(index.routes[(index.offsets[1:] - index.offsets[:-1]).argmax()])
+    return str(route >> 32), str(route & 0xffffffff)
+
+def measure(function, repeat: int, cold: bool = False) -> dict:
+    '''Best-of-`repeat` time of `function`, and its peak traced memory in one more run.'''
+    runs = []
+    for _ in range(repeat):
+        if cold:
+            d.dataset_cache.clear()
+        started = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - started)
+    if cold:
+        d.dataset_cache.clear()
+    tracemalloc.start()
+    function()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(runs), 'runs': runs, 'peak_bytes': peak_bytes,
+            'rows': len(result) if isinstance(result, (list, dict)) else None}
+
+def run_size(trips_db, kiosk_db, n_trips: int, repeat: int, seed: int, processes: list) -> list:
+    '''Load `n_trips` trips and measure every stage on them.'''
+    started = time.perf_counter()
+    kiosk_data = load(trips_db, kiosk_db, n_trips, seed)
+    results = [{'stage': 'load', 'seconds': time.perf_counter() - started, 'runs': None, 'peak_bytes': None,
+                'rows': n_trips}]
+
+    # the worker jobs read the module-level connections
+    worker.trips_db, worker.kiosk_db = trips_db, kiosk_db
+    kiosk1, kiosk2 = _busiest_route(trips_db)
+    route_job = {'plot_type': 'trip_duration', 'kiosk1': kiosk1, 'kiosk2': kiosk2,
+                 'start_date': START.strftime('%m/%d/%Y'), 'end_date': END.strftime('%m/%d/%Y')}
+    area_job = {'plot_type': 'trips_per_day', 'lat': str(CAMPUS[0]), 'long': str(CAMPUS[1]), 'radius': '1',
+                'start_date': START.strftime('%m/%d/%Y'), 'end_date': END.strftime('%m/%d/%Y')}
+
+    trips = d.get_trips(trips_db)
+    in_range = d.filter_by_date(trips, START, END)
+    stages = {
+        'get_trips': lambda: d.get_trips(trips_db),
+        'get_trips_date_range': lambda: d.get_trips(trips_db, START, END),
+        'filter_by_date': lambda: d.filter_by_date(trips, START, END),
+        'filter_by_location': lambda: d.filter_by_location(in_range, kiosk_data, CAMPUS, RADIUS_KM),
+        'nearest_kiosks': lambda: d.nearest_kiosks(CAMPUS, kiosk_data, 5),
+        'trip_duration_histogram_job_cold': (lambda: worker.trip_duration_histogram_job(route_job), True),
+        'trip_duration_histogram_job': lambda: worker.trip_duration_histogram_job(route_job),
+        'trips_per_day_job_cold': (lambda: worker.trips_per_day_job(area_job), True),
+        'trips_per_day_job': lambda: worker.trips_per_day_job(area_job),
+    }
+    for stage, function in stages.items():
+        function, cold = function if isinstance(function, tuple) else (function, False)
+        results.append({'stage': stage, **measure(function, repeat, cold)})
+
+    # speedup of the parallel filter against the number of processes
+    serial = None
+    parallel_query.PARALLEL_MIN_ROWS = 0
+    for n in processes:
+        parallel_query.start_pool(trips_db, n)
+        result = measure(lambda: parallel_query.filter_trips(trips_db, START, END, kiosk_data, CAMPUS, RADIUS_KM), repeat)
+        serial = serial or result['seconds']
+        results.append({'stage': f'filter_trips_p{n}', 'processes': n, 'speedup': serial / result['seconds'], **result})
+    parallel_query.stop_pool()
+    return results
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of trips')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest is reported')
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[n for n in [1, 2, 4, 8, 16, 32, 64] if n <= (os.cpu_count() or 1)],
+                        help='pool sizes of the filter_trips stages, starting with 1')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--redis-ip', default=None, help='use this Redis instead of an in-process fakeredis')
+    parser.add_argument('--output', default=None, help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    trips_db, kiosk_db = _connect(args.redis_ip)
+    report = {'commit': _commit(), 'cpus': os.cpu_count(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'redis': args.redis_ip or 'fakeredis', 'seed': args.seed, 'repeat': args.repeat, 'results': []}
+    for n_trips in args.sizes:
+        for result in run_size(trips_db, kiosk_db, n_trips, args.repeat, args.seed, args.processes):
+            report['results'].append({'trips': n_trips, **result})
+            print(f"{n_trips:>10} {result['stage']:<34}{result['seconds'] * 1000:>12.1f} ms"
+                  + (f"{result['peak_bytes'] / 2**20:>10.1f} MiB" if result['peak_bytes'] is not None else '')
+                  + (f"{result['speedup']:>8.2f}x" if 'speedup' in result else ''),
+                  file=sys.stderr)
+    report['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if args.redis_ip:
+        trips_db.flushdb()
+        kiosk_db.flushdb()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+    main()
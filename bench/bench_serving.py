@@ -0,0 +1,149 @@
+'''
+Compare the throughput of the Flask dev server (api.py) with the ASGI
+serving mode (api_async.py under uvicorn) on the lookup and status routes,
+and write the results as JSON.
+
+Both servers run as subprocesses against the Redis at --redis-ip. Its trips,
+kiosk, jobs and results databases (0, 1, 3 and 4) are replaced with
+synthetic data, so use a scratch Redis. Each route is requested by
+--concurrency clients on keep-alive connections for --duration seconds,
+from one asyncio process. The /wait route long-polls a job that never
+finishes, so its throughput shows how many waiting requests a server holds.
+
+Usage: python bench/bench_serving.py --redis-ip 127.0.0.1 [--concurrency 1 16 64 256] [--output results.json]
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+SERVERS = {
+    'flask': [sys.executable, '-c', 'import sys, api; api.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'api_async:app', '--host', '127.0.0.1', '--log-level', 'warning',
+             '--no-access-log', '--port'],
+}
+
+def setup(n_trips: int) -> dict:
+    '''Load synthetic data and jobs into Redis, and return the paths to request.'''
+    sys.path.insert(0, SRC)
+    import jobs
+    import worker
+    from bench_queries import load, CAMPUS
+
+    load(jobs.trips_db, jobs.kiosk_db, n_trips, seed=0)
+    jobs.jdb.flushdb()
+    jobs.res.flushdb()
+    params = {'plot_type': 'trips_per_day', 'lat': str(CAMPUS[0]), 'long': str(CAMPUS[1]), 'radius': '1',
+              'start_date': '09/01/2023', 'end_date': '11/30/2023'}
+    done, pending = jobs.add_job(params), jobs.add_job({**params, 'radius': '2'})
+    jobs.store_job_result(done['id'], worker.trips_per_day_job(params))
+    jobs.finish_job(done['id'], 'complete')
+    jobs.q.clear()
+    return {
+        'jobs': f"/jobs/{done['id']}",
+        'results': f"/results/{done['id']}",
+        'nearest': f'/nearest?n=5&lat={CAMPUS[0]}&long={CAMPUS[1]}',
+        'wait': f"/jobs/{pending['id']}/wait?timeout=0.5",
+    }
+
+def start(server: str, port: int, redis_ip: str) -> subprocess.Popen:
+    '''Start `server` on `port` and wait until it answers.'''
+    env = {**os.environ, 'REDIS_IP': redis_ip, 'LOG_LEVEL': 'WARNING'}
+    process = subprocess.Popen(SERVERS[server] + [str(port)], cwd=SRC, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            asyncio.run(_request_once(port, '/jobs/stats'))
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit(f"{server} server did not start")
+
+async def _read_response(reader: asyncio.StreamReader) -> bool:
+    '''Read one response, returning whether the server keeps the connection open.'''
+    headers = (await reader.readuntil(b'\r\n\r\n')).lower()
+    await reader.readexactly(int(re.search(rb'content-length: *(\d+)', headers).group(1)))
+    return b'connection: close' not in headers and not headers.startswith(b'http/1.0')
+
+async def _request_once(port: int, path: str) -> None:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode())
+    await _read_response(reader)
+    writer.close()
+
+async def _client(port: int, path: str, deadline: float, latencies: list, errors: list) -> None:
+    request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode()
+    writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            started = time.perf_counter()
+            writer.write(request)
+            keep_alive = await _read_response(reader)
+            latencies.append(time.perf_counter() - started)
+        except (OSError, asyncio.IncompleteReadError):
+            errors.append(1)
+            keep_alive = False
+        if not keep_alive and writer is not None:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+async def _run(port: int, path: str, concurrency: int, duration: float) -> dict:
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*[_client(port, path, started + duration, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {'requests': len(latencies), 'errors': len(errors), 'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000) if latencies else None,
+            'p99_ms': float(np.percentile(latencies, 99) * 1000) if latencies else None}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-ip', required=True, help='scratch Redis whose databases 0, 1, 3 and 4 are replaced')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64, 256], help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per route and concurrency')
+    parser.add_argument('--trips', type=int, default=10000, help='synthetic trips loaded')
+    parser.add_argument('--port', type=int, default=5099, help='port the servers listen on')
+    parser.add_argument('--output', default=None, help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    os.environ['REDIS_IP'] = args.redis_ip
+    paths = setup(args.trips)
+    report = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'duration': args.duration, 'results': []}
+    for server in SERVERS:
+        process = start(server, args.port, args.redis_ip)
+        try:
+            for route, path in paths.items():
+                for concurrency in args.concurrency:
+                    result = asyncio.run(_run(args.port, path, concurrency, args.duration))
+                    report['results'].append({'server': server, 'route': route, 'concurrency': concurrency, **result})
+                    print(f"{server:<6} {route:<8} {concurrency:>5} clients {result['requests_per_second']:>10.0f} req/s"
+                          f"  p50 {result['p50_ms'] or 0:>8.1f} ms  p99 {result['p99_ms'] or 0:>8.1f} ms"
+                          f"  {result['errors']} errors", file=sys.stderr)
+        finally:
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Seeded synthetic MetroBike data for benchmarks, from thousands to tens of
+millions of trips, in the format of the Socrata trips and kiosk endpoints.
+
+Unlike socrata_stub.synthetic_trips, which spreads trips uniformly, the
+distributions loosely follow the real data: a few busy kiosks account for
+most trips, a fifth of trips return to the kiosk they started from,
+ridership peaks in spring and fall, on weekends and at commute and lunch
+hours, and trip durations are log-normal. Trips are generated a page at a
+time in checkout order, so memory stays bounded however many are requested.
+'''
+import os
+import sys
+from typing import Iterator, List
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+from socrata_stub import synthetic_kiosks
+
+START = np.datetime64('2023-01-01T00:00:00')
+DAYS = 730
+
+# share of trips starting in each hour of the day
+_HOURS = np.array([1, 0.5, 0.3, 0.2, 0.2, 0.5, 1.5, 4, 6, 4, 3.5, 4.5,
+                   6, 5.5, 4.5, 4.5, 5.5, 7, 6, 4.5, 3.5, 3, 2.5, 1.5])
+_HOURS = _HOURS / _HOURS.sum()
+
+def kiosks(n_kiosks: int = 100, seed: int = 0) -> List[dict]:
+    '''Kiosk records scattered around downtown Austin, see socrata_stub.synthetic_kiosks.'''
+    return synthetic_kiosks(n_kiosks, seed)
+
+def _day_weights() -> np.ndarray:
+    day = np.arange(DAYS)
+    weekday = (START.astype('datetime64[D]').astype(np.int64) + day + 3) % 7  # 0 is Monday
+    # two seasonal peaks a year, busier weekends
+    seasonal = 1 + 0.4 * np.cos(4 * np.pi * (day - 105) / 365.25)
+    weights = seasonal * np.where(weekday >= 5, 1.3, 1.0)
+    return weights / weights.sum()
+
+def checkout_epochs(n_trips: int, seed: int = 0) -> np.ndarray:
+    '''Sorted checkout times of `n_trips` trips, in seconds since the Unix epoch.'''
+    rng = np.random.default_rng(seed)
+    days = rng.choice(DAYS, size=n_trips, p=_day_weights())
+    hours = rng.choice(24, size=n_trips, p=_HOURS)
+    seconds = days * 86400 + hours * 3600 + rng.integers(0, 3600, size=n_trips)
+    seconds.sort()
+    return START.astype(np.int64) + seconds
+
+def trip_pages(n_trips: int, kiosk_data: List[dict], seed: int = 0, page_size: int = 50000) -> Iterator[List[dict]]:
+    '''
+    Trip records in the format of the Socrata trips endpoint, oldest first.
+
+    Yields:
+        List[dict]: Pages of up to `page_size` trips, sorted by checkout time.
+    '''
+    rng = np.random.default_rng(seed + 1)
+    epochs = checkout_epochs(n_trips, seed)
+    # Zipf-like kiosk popularity
+    popularity = 1 / np.arange(1, len(kiosk_data) + 1)
+    popularity = rng.permutation(popularity / popularity.sum())
+    kiosk_ids = [kiosk['kiosk_id'] for kiosk in kiosk_data]
+    kiosk_names = [kiosk['kiosk_name'] for kiosk in kiosk_data]
+
+    for start in range(0, n_trips, page_size):
+        page_epochs = epochs[start:start + page_size]
+        n = len(page_epochs)
+        checkout = rng.choice(len(kiosk_data), size=n, p=popularity)
+        returned = np.where(rng.random(n) < 0.2, checkout, rng.choice(len(kiosk_data), size=n, p=popularity))
+        durations = np.minimum(rng.lognormal(2.4, 0.8, size=n), 600).astype(np.int64) + 1
+        bicycles = rng.integers(100, 999, size=n)
+        electric = rng.random(n) < 0.4
+        datetimes = np.datetime_as_string(page_epochs.astype('datetime64[s]'), unit='s')
+        yield [{
+            'trip_id': str(10**8 + start + i),
+            'membership_type': 'Student Membership',
+            'bicycle_id': str(bicycles[i]),
+            'bike_type': 'electric' if electric[i] else 'classic',
+            'checkout_datetime': f'{datetimes[i]}.000',
+            'checkout_date': f'{datetimes[i][:10]}T00:00:00.000',
+            'checkout_time': datetimes[i][11:],
+            'checkout_kiosk_id': kiosk_ids[checkout[i]],
+            'checkout_kiosk': kiosk_names[checkout[i]],
+            'return_kiosk_id': kiosk_ids[returned[i]],
+            'return_kiosk': kiosk_names[returned[i]],
+            'trip_duration_minutes': str(durations[i]),
+            'month': str(int(datetimes[i][5:7])),
+            'year': datetimes[i][:4],
+        } for i in range(n)]
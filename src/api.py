@@ -1,6 +1,10 @@
 # standard library
+import base64
 import logging
 import os
+import time
+import uuid
+import zipfile
 from datetime import datetime
 from typing import List
 
@@ -8,17 +12,24 @@ from typing import List
 import matplotlib.pyplot as plt
 import numpy as np
 import redis
-import requests
-from flask import Flask, request, app, send_file, Response
+from flask import Flask, request, app, Response, stream_with_context, g
+from werkzeug.serving import is_running_from_reloader
 import json
 import folium
 import io
 from PIL import Image
 
 # Project defined
-from gcd_algorithm import great_circle_distance
-from jobs import trips_db, kiosk_db, get_job_by_id, res, add_job, get_results_by_id
-from data_lib import filter_by_date, filter_by_location, nearest_kiosks, get_kiosks, get_trips
+from jobs import trips_db, kiosk_db, get_job_by_id, res, add_job, add_jobs, get_results_by_id, get_results_by_ids, \
+    get_job_cache_stats, watch_job, wait_for_job, q, jdb
+import metrics
+import profiling
+import parallel_query
+from data_lib import nearest_kiosks, \
+    date_range, slice_columns, location_mask, get_generation, GENERATION_KEY, \
+    cached_kiosks, cached_kiosk_ids, cached_trip_columns, cached_kiosk_index, \
+    DatasetCache, dataset_cache
+from render import FORMATS
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -27,84 +38,163 @@ app = Flask(__name__)
 log_level = os.environ.get("LOG_LEVEL")
 logging.basicConfig(level=log_level)
 
-trips_url = "https://data.austintexas.gov/resource/tyfh-5r8s.json?"
-kiosk_url = "https://data.austintexas.gov/resource/qd73-bsdg.json"
+# Longest a client can wait on a job, in seconds, and how often a job's event stream sends a keep-alive
+JOB_WAIT_MAX = float(os.environ.get("JOB_WAIT_MAX", 300))
+JOB_EVENTS_HEARTBEAT = 15
+
+# Most jobs submitted to /jobs/batch, or results fetched from /results, per request
+JOB_BATCH_MAX = int(os.environ.get("JOB_BATCH_MAX", 1000))
+
+# Rendered /show_nearest maps, keyed by location rounded to MAP_COORD_DECIMALS
+# decimal places (about 100 m at 3) and the number of kiosks
+MAP_COORD_DECIMALS = int(os.environ.get("MAP_COORD_DECIMALS", 3))
+map_cache = DatasetCache(int(os.environ.get("MAP_CACHE_MAX_BYTES", 64 * 2**20)))
+
+# Metrics of this API process, served by /metrics along with the worker's
+REQUEST_SECONDS = metrics.Histogram('metrobike_http_request_seconds', 'Time to handle API requests, by route, method and status.',
+                                    ('route', 'method', 'status'))
+QUEUE_DEPTH = metrics.Gauge('metrobike_queue_depth', 'Jobs waiting in the queue.')
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    # by route pattern, e.g. /jobs/<job_id>, so each job id doesn't make a new series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route=route, method=request.method,
+                            status=response.status_code)
+    return response
+
+# Clients allowed to profile routes (profile=1) and jobs ("profile": true), as
+# comma-separated IP addresses or '*' for any. Profiling is off when empty.
+PROFILE_ALLOWLIST = {address.strip() for address in os.environ.get("PROFILE_ALLOWLIST", "").split(',') if address.strip()}
+
+def _profiling_allowed() -> bool:
+    return '*' in PROFILE_ALLOWLIST or request.remote_addr in PROFILE_ALLOWLIST
+
+@app.before_request
+def _start_profile():
+    if PROFILE_ALLOWLIST and request.args.get('profile') == '1' and _profiling_allowed():
+        g.profiler = profiling.start()
+
+@app.after_request
+def _store_profile(response):
+    # a streamed response is only profiled up to the start of the stream
+    if 'profiler' in g:
+        profile_id = str(uuid.uuid4())
+        profiling.stop(res, profile_id, g.pop('profiler'))
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+def _wait_timeout(default: float) -> float:
+    """The `timeout` query parameter of the job wait routes, capped at JOB_WAIT_MAX."""
+    return min(max(float(request.args.get('timeout', default)), 0), JOB_WAIT_MAX)
+
+def _data_loaded() -> bool:
+    """
+    Check whether a dataset has been loaded. The kiosk data is written last by
+    /data, and trips_db always holds the generation counter, so check for it.
+    """
+    return kiosk_db.exists('kiosks') > 0
 
 @app.route('/data', methods=['POST', 'DELETE'])
 def load_data()->tuple:
     """
     Route to load data to Redis via POST request.
 
+    Loading runs as a job in the worker: the response is the job record,
+    and /jobs/<job_id> reports the load progress. A full load replaces the
+    data with the newest `rows` trips once they are all downloaded, routes
+    keep serving the previous data until then. With {"mode": "incremental"}
+    only the trips checked out since the last load are fetched and appended.
+
     Example command: curl -X POST localhost:5000/data -d '{"rows":"100000"}' -H "Content-Type: application/json"
+    Example command: curl -X POST localhost:5000/data -d '{"mode":"incremental"}' -H "Content-Type: application/json"
 
     Returns:
-        tuple: A tuple containing a message indicating the success or failure of data loading (str) and an HTTP status code.
+        tuple: The submitted load job (dict) or an error message (str), and an HTTP status code.
     """
     if request.method == 'POST':
         params = request.get_json()
+        mode = params.get('mode', 'full')
+
+        # Incremental refresh: only fetch trips newer than the ones loaded
+        if mode == 'incremental':
+            if not _data_loaded():
+                return 'No data to refresh. Load data with a full load first.', 400
+            job_params = {'job_type': 'load_data', 'mode': 'incremental'}
+        elif mode == 'full':
+            # Check if 'rows' parameter is provided and valid
+            if 'rows' not in params:
+                logging.error("Missing parameters. Please provide 'rows' parameter.")
+                return "Missing parameters. Please provide 'rows' parameter.", 400
+            try:
+                rows = int(params['rows'])
+                if rows <= 0:
+                    logging.error("The value of 'rows' must be greater than 0.")
+                    return "The value of 'rows' must be greater than 0.", 400
+            except:
+                logging.error("The value of 'rows' must be an integer.")
+                return "The value of 'rows' must be an integer.", 400
+            job_params = {'job_type': 'load_data', 'mode': 'full', 'rows': rows}
+        else:
+            return "Invalid mode. Please use 'full' or 'incremental'.", 400
+        if params.get('profile') is True:
+            if not _profiling_allowed():
+                return "Profiling is not allowed for this client.", 400
+            job_params['profile'] = True
 
-        # Check if 'rows' parameter is provided and valid
-        if 'rows' not in params:
-            logging.error("Missing parameters. Please provide 'rows' parameter.")
-            return "Missing parameters. Please provide 'rows' parameter.", 400
+        # Hand the download off to the worker
         try:
-            rows = int(params['rows'])
-            if rows <= 0:
-                logging.error("The value of 'rows' must be greater than 0.")
-                return "The value of 'rows' must be greater than 0.", 400
+            return add_job(job_params), 202
         except:
-            logging.error("The value of 'rows' must be an integer.")
-            return "The value of 'rows' must be an integer.", 400
-
-        # Load trips data to trips_db in chunks
-        chunk_size = 1000001
-        response = requests.get(trips_url + f"$limit={rows}&$order=checkout_date DESC")
-        if response.status_code != 200:
-            logging.error("Failed to load data to Redis")
-            return 'Failed to load data to Redis', 500
-        # Clear all databases
-        trips_db.flushall()
-        trips_data = response.json()
-        logging.debug(f"Number of trips retrieved: {len(trips_data)}")  
-
-        n = len(trips_data)//chunk_size     # number of chunks
-        if n > 0:
-            # Store in chunks if there are more than 1M rows
-            for i in range(n):
-                trips_db.set(f'chunk {i}',json.dumps(trips_data[i*chunk_size:(i+1)*chunk_size]))
-            trips_db.set(f'chunk {i+1}',json.dumps(trips_data[(i+1)*chunk_size:]))
-        else:
-            # Store in single key called "trips" if less than 1M rows
-            trips_db.set(f'trips',json.dumps(trips_data))
-
-        # Load kiosk data to trips_db in chunks
-        response = requests.get(kiosk_url)
-        if response.status_code != 200:
-            logging.error("Failed to load data to Redis")
-            return 'Failed to load data to Redis', 500
-        kiosk_data = response.json()
-        logging.debug(f"Number of kiosks retrieved: {len(kiosk_data)}")
-        kiosk_db.set('kiosks', json.dumps(kiosk_data))
-
-        return f'Loaded {len(trips_data)} trips and {len(kiosk_data)} kiosks into Redis databases.', 200
+            return "Unable to add job.", 500
 
     elif request.method == 'DELETE':
-        for key in trips_db.keys():
-            trips_db.delete(key)
+        # flush each database in one command, keeping only the next generation
+        def _flush(pipe):
+            generation = get_generation(pipe)
+            pipe.multi()
+            pipe.flushdb()
+            pipe.set(GENERATION_KEY, generation + 1)
 
-        for key in kiosk_db.keys():
-            kiosk_db.delete(key)
+        kiosk_db.flushdb()
+        trips_db.transaction(_flush, GENERATION_KEY)
 
         return f"Deleted trips and kiosks data.", 200
 
+def _encode_cursor(generation: int, position: int) -> str:
+    """Opaque /trips cursor: the dataset generation and the next position in the sorted trips."""
+    return base64.urlsafe_b64encode(json.dumps([generation, position]).encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple:
+    """Inverse of _encode_cursor, raises ValueError for malformed cursors."""
+    try:
+        generation, position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(generation), int(position)
+    except Exception as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+
 @app.route('/trips', methods = ['GET'])
 def get_trip_data()->list:
     '''
     Returns filtered trip data
 
+    Optional query parameters:
+        - limit: maximum number of trips to return. The response is then
+          {"trips": [...], "next_cursor": ...}, pass next_cursor back as
+          `cursor` to get the following page (null on the last page)
+        - cursor: cursor from a previous page, only valid for the same filters and dataset
+        - fields: comma separated trip fields to return, e.g. fields=trip_id,checkout_datetime
+        - format=ndjson (or an "Accept: application/x-ndjson" header): stream one trip per
+          line, the next cursor is sent in the X-Next-Cursor header
+
     Example command: curl "localhost:5000/trips?start_date=01/03/2023&end_date=01/03/2024&latitude=30.286&longitude=-97.739&radius=5"
+    Example command: curl "localhost:5000/trips?radius=5&limit=1000&fields=trip_id,checkout_datetime&format=ndjson"
     '''
-    if trips_db.dbsize() == 0:
+    if not _data_loaded():
         return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
     # default values
     arg_data = {
@@ -126,15 +216,59 @@ def get_trip_data()->list:
         lat = float(arg_data['latitude'])
         long = float(arg_data['longitude'])
         radius = float(arg_data['radius'])*1.609344
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        assert limit is None or limit > 0
     except:
         return 'Invalid Query Parameter Format', 400
-    
-    # get and filter trip data
-    trips = get_trips(trips_db)
-    kiosks = get_kiosks(kiosk_db)
-    trips = filter_by_date(trips, start_date, end_date)
-    trips = filter_by_location(trips, kiosks, (lat,long), radius)
-    return trips
+    fields = [field.strip() for field in request.args['fields'].split(',')] if request.args.get('fields') else None
+    ndjson = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+    # resume after the last trip of the previous page, trips are sorted by checkout time
+    generation = get_generation(trips_db)
+    position = 0
+    if request.args.get('cursor'):
+        try:
+            cursor_generation, position = _decode_cursor(request.args['cursor'])
+        except ValueError:
+            return 'Invalid cursor', 400
+        if cursor_generation != generation:
+            return 'Cursor expired, the data has been reloaded since. Start again without a cursor.', 410
+
+    # filter on the trip columns, then look up the matching trip records
+    all_columns = cached_trip_columns(trips_db)
+    dates = date_range(all_columns, start_date, end_date)
+    dates = slice(max(dates.start, position), max(dates.stop, position))
+    columns = slice_columns(all_columns, dates)
+    kiosks = cached_kiosks(trips_db, kiosk_db)
+    index = cached_kiosk_index(trips_db, kiosk_db)
+    positions = dates.start + np.flatnonzero(location_mask(columns, kiosks, (lat,long), radius, index))
+
+    next_cursor = None
+    if limit is not None and len(positions) > limit:
+        positions = positions[:limit]
+        next_cursor = _encode_cursor(generation, int(positions[-1]) + 1)
+    # only the chunks holding these trips are read, see the dataset manifest,
+    # on a process pool if they are large and not cached yet
+    with metrics.stage('trip_lookup') as stage:
+        trips = parallel_query.trip_records(trips_db, all_columns['row'][positions])
+        stage.rows = len(trips)
+
+    def _project(trip):
+        return {field: trip[field] for field in fields if field in trip} if fields else trip
+
+    if ndjson:
+        # write trips as they are looked up instead of building the whole response
+        def _generate():
+            for trip in trips:
+                yield json.dumps(_project(trip)) + '\n'
+        response = Response(stream_with_context(_generate()), mimetype='application/x-ndjson')
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    if limit is None and position == 0:
+        return [_project(trip) for trip in trips]
+    return {'trips': [_project(trip) for trip in trips], 'next_cursor': next_cursor}
 
 @app.route('/kiosk_ids', methods = ['GET'])
 def get_kiosk_keys():
@@ -143,9 +277,9 @@ def get_kiosk_keys():
 
     Example command: curl localhost:5000/kiosk_ids
     '''
-    if trips_db.dbsize() == 0:
+    if not _data_loaded():
         return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
-    return json.dumps([kiosk['kiosk_id'] for kiosk in get_kiosks(kiosk_db)])
+    return json.dumps([kiosk['kiosk_id'] for kiosk in cached_kiosks(trips_db, kiosk_db)])
 
 @app.route('/show_nearest', methods = ['GET'])
 def show_nearest_kiosks():
@@ -154,7 +288,7 @@ def show_nearest_kiosks():
 
     Example route to paste into browser: localhost:5000/show_nearest?n=5&lat=30.2862730619728&long=-97.73937727490916
     """
-    if trips_db.dbsize() == 0:
+    if not _data_loaded():
         return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
     try:
         n, lat, long = int(request.args.get('n')), float(request.args.get('lat')), float(request.args.get('long'))
@@ -165,8 +299,14 @@ def show_nearest_kiosks():
         logging.error("Missing parameters. Please provide 'n', 'lat', and 'long' parameters.")
         return "Missing parameters. Please provide 'n', 'lat', and 'long' parameters.", 400
     
-    # Get nearest kiosks
-    nearest = nearest_kiosks((lat,long),get_kiosks(kiosk_db),n)
+    # maps are cached per dataset generation, for nearby locations rounded to the same point
+    location = (round(lat, MAP_COORD_DECIMALS), round(long, MAP_COORD_DECIMALS))
+    html = map_cache.get(trips_db, (location, n), lambda: _render_nearest_map(location, n))
+    return Response(html, mimetype='text/html')
+
+def _render_nearest_map(location: tuple, n: int) -> tuple:
+    """Render the folium map of the n nearest kiosks to `location`, as (HTML, size) for map_cache."""
+    nearest = nearest_kiosks(location,cached_kiosks(trips_db, kiosk_db),n,cached_kiosk_index(trips_db, kiosk_db))
 
     # Use Folium to output a map with HTML
     map = folium.Map()
@@ -178,16 +318,46 @@ def show_nearest_kiosks():
         folium.Marker(location=loc, icon=folium.Icon(color=color)).add_to(map)
     
     # Requested location
-    folium.Marker(location=(lat,long), icon=folium.Icon(color='blue')).add_to(map)
+    folium.Marker(location=location, icon=folium.Icon(color='blue')).add_to(map)
 
     # Fit the map to the bounds of the markers
     map.fit_bounds(locations)
 
-    # Save map
-    map.save("map.html")
-
-    return send_file('map.html', mimetype='text/html', as_attachment=False)
+    # Render the map in memory
+    html = map.get_root().render().encode()
+    return html, len(html)
     
+@app.route('/cache/stats', methods = ['GET'])
+def get_cache_stats():
+    '''
+    Returns the size and hit/miss counters of this API process's dataset
+    cache and /show_nearest map cache.
+
+    Example command: curl localhost:5000/cache/stats
+    '''
+    def _summary(cache):
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        return {**stats, 'entries': len(stats['entries']), 'hit_rate': stats['hits'] / lookups if lookups else None}
+    return {'dataset': _summary(dataset_cache), 'map': _summary(map_cache)}
+
+@app.route('/metrics', methods = ['GET'])
+def get_metrics():
+    '''
+    Returns the metrics of this API process and the totals of all worker
+    processes in the Prometheus text format: time, rows and bytes of each
+    stage of request and job handling (labeled component="api" or "worker"),
+    API request times, job run and queue wait times by job type, and the
+    current queue depth.
+
+    Example command: curl localhost:5000/metrics
+    '''
+    QUEUE_DEPTH.set(len(q))
+    worker_samples = metrics.pull(jdb, metrics.WORKER_METRICS_PREFIX, metrics.WORKER_METRICS)
+    text = metrics.render(metrics.WORKER_METRICS, [({'component': 'api'}, None), ({'component': 'worker'}, worker_samples)]) \
+        + metrics.render([REQUEST_SECONDS, QUEUE_DEPTH])
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @app.route('/nearest', methods = ['GET'])
 def get_nearest_kiosks():
     """
@@ -195,7 +365,7 @@ def get_nearest_kiosks():
 
     Example command: curl "localhost:5000/nearest?n=5&lat=30.2862730619728&long=-97.73937727490916"
     """
-    if trips_db.dbsize() == 0:
+    if not _data_loaded():
         return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
     try:
         n, lat, long = int(request.args.get('n')), float(request.args.get('lat')), float(request.args.get('long'))
@@ -207,14 +377,86 @@ def get_nearest_kiosks():
         return "Missing parameters. Please provide 'n', 'lat', and 'long' parameters.", 400
     
     # Get nearest kiosks
-    nearest = nearest_kiosks((lat,long),get_kiosks(kiosk_db),n)
+    kiosks = cached_kiosks(trips_db, kiosk_db)
+    positions, distances = cached_kiosk_index(trips_db, kiosk_db).knn((lat,long), n)
     response_string = "Nearest Kiosks:\n"
-    for kiosk in nearest:
-        distance = great_circle_distance(lat, long, float(kiosk['location']['latitude']), float(kiosk['location']['longitude']))
+    for kiosk, distance in zip([kiosks[i] for i in positions], distances):
         response_string += f"- Kiosk Name: {kiosk['kiosk_name']}, Kiosk ID: {kiosk['kiosk_id']}, Distance: {distance:.2f} mi, Status: {kiosk['kiosk_status']} \n"
 
     return response_string
 
+def _plot_job_params(job_data: dict, kiosk_ids: frozenset) -> dict:
+    """
+    Check the parameters of a submitted plot job and return them as passed
+    to add_job.
+
+    Raises:
+        ValueError: With a message for the client, if the parameters are invalid.
+    """
+    allowed_params = ['kiosk1','kiosk2','start_date','end_date','latitude','longitude','radius','plot_type','format','profile']
+    if not isinstance(job_data, dict):
+        raise ValueError("Job parameters must be a JSON object.")
+    for param in job_data:
+        if param not in allowed_params:
+            raise ValueError(f"Invalid parameters. Allowed parameters are {allowed_params}.")
+    if 'plot_type' not in job_data:
+        raise ValueError("Must include a plot type.")
+    output_format = job_data.get('format', 'default')
+    if output_format != 'default' and output_format not in FORMATS:
+        raise ValueError(f"Invalid format. Please use one of {list(FORMATS)}.")
+    profile = job_data.get('profile', False)
+    if not isinstance(profile, bool):
+        raise ValueError("Invalid profile. Please use true or false.")
+    if profile and not _profiling_allowed():
+        raise ValueError("Profiling is not allowed for this client.")
+    job_params = _plot_type_params(job_data, kiosk_ids, output_format)
+    return {**job_params, 'profile': True} if profile else job_params
+
+def _plot_type_params(job_data: dict, kiosk_ids: frozenset, output_format: str) -> dict:
+    """The parameters of a plot job of the submitted plot type, see _plot_job_params."""
+    if job_data['plot_type'] == 'trip_duration':
+        if not all(key in job_data for key in ['kiosk1', 'kiosk2', 'start_date', 'end_date']):
+            raise ValueError("Invalid parameters for trip duration plot. Please provide start_date, end_date, kiosk1, kiosk2.")
+        try:
+            k1 = job_data['kiosk1']
+            k2 = job_data['kiosk2']
+            assert k1 in kiosk_ids or k1 == 'default' and k2 in kiosk_ids or k2 == 'default'
+            assert job_data['start_date'] == 'default' or datetime.strptime(job_data['start_date'], "%m/%d/%Y")
+            assert job_data['end_date'] == 'default' or datetime.strptime(job_data['end_date'], "%m/%d/%Y")
+        except:
+            raise ValueError("Invalid job parameters.")
+        return {
+            'kiosk1': job_data['kiosk1'],
+            'kiosk2': job_data['kiosk2'],
+            'start_date': job_data['start_date'],
+            'end_date': job_data['end_date'],
+            'plot_type': job_data['plot_type'],
+            'format': output_format
+        }
+
+    elif job_data['plot_type'] == 'trips_per_day':
+        if not all(key in job_data for key in ['start_date', 'end_date', 'latitude', 'longitude', 'radius']):
+            raise ValueError("Invalid parameters for trip duration plot. Please provide start_date, end_date, lat, long and radius.")
+        try:
+            assert job_data['radius'] == 'default' or float(job_data['radius'])
+            assert job_data['latitude'] == 'default' or float(job_data['latitude'])
+            assert job_data['longitude'] == 'default' or float(job_data['longitude'])
+            assert job_data['start_date'] == 'default' or datetime.strptime(job_data['start_date'], "%m/%d/%Y")
+            assert job_data['end_date'] == 'default' or datetime.strptime(job_data['end_date'], "%m/%d/%Y")
+        except:
+            raise ValueError("Invalid job parameters.")
+        return {
+            'start_date': job_data['start_date'],
+            'end_date': job_data['end_date'],
+            'lat': job_data['latitude'],
+            'long': job_data['longitude'],
+            'radius': job_data['radius'],
+            'plot_type': job_data['plot_type'],
+            'format': output_format
+        }
+    else:
+        raise ValueError("Invalid plot type.")
+
 @app.route('/jobs', methods = ['POST'])
 def submit_job():
     '''
@@ -227,73 +469,65 @@ def submit_job():
     - latitude (degrees)
     - longitude (degrees)
     - plot type - 'trip_duration' or 'trips_per_day'
+    - format (optional) - 'png' (default), 'svg', or the plotted data as 'json' or 'csv'
 
     curl -X POST localhost:5000/jobs -d '{"kiosk1":"4055", "kiosk2":"2498", "start_date":"01/31/2023", "end_date":"01/31/2024", "plot_type":"trip_duration"}' -H "Content-Type: application/json"
     curl -X POST localhost:5000/jobs -d '{"start_date": "01/31/2023", "end_date":"01/31/2024", "latitude":"30.286", "longitude":"-97.739", "radius":"3", "plot_type":"trips_per_day"}' -H "Content-Type: application/json"
     '''
-    if trips_db.dbsize() == 0:
+    if not _data_loaded():
         return 'Please load data with "/data" route before submitting a job.'
-    job_data = request.get_json()
-    allowed_params = ['kiosk1','kiosk2','start_date','end_date','latitude','longitude','radius','plot_type']
-    for param in job_data:
-        if param not in allowed_params:
-            return f"Invalid parameters. Allowed parameters are {allowed_params}.", 400
-    if 'plot_type' not in job_data:
-        return "Must include a plot type.", 400
-    
+
     # Ensure job paramaters are valid and submit job
-    if job_data['plot_type'] == 'trip_duration':
-        if all(key in job_data for key in ['kiosk1', 'kiosk2', 'start_date', 'end_date']):
-            try:
-                all_kiosks = json.loads(get_kiosk_keys())
-                k1 = job_data['kiosk1']
-                k2 = job_data['kiosk2']
-                assert k1 in all_kiosks or k1 == 'default' and k2 in all_kiosks or k2 == 'default'
-                assert job_data['start_date'] == 'default' or datetime.strptime(job_data['start_date'], "%m/%d/%Y")
-                assert job_data['end_date'] == 'default' or datetime.strptime(job_data['end_date'], "%m/%d/%Y")
-            except:
-                return "Invalid job parameters.", 400
-            try:
-                job_info = add_job({
-                    'kiosk1': job_data['kiosk1'],
-                    'kiosk2': job_data['kiosk2'],
-                    'start_date': job_data['start_date'],
-                    'end_date': job_data['end_date'],
-                    'plot_type': job_data['plot_type']
-                })
-            except:
-                return "Unable to add job.", 500
-        else:
-            return "Invalid parameters for trip duration plot. Please provide start_date, end_date, kiosk1, kiosk2.", 400
-    
-    elif job_data['plot_type'] == 'trips_per_day':
-        if all(key in job_data for key in ['start_date', 'end_date', 'latitude', 'longitude', 'radius']):
-            try:
-                assert job_data['radius'] == 'default' or float(job_data['radius'])
-                assert job_data['latitude'] == 'default' or float(job_data['latitude'])
-                assert job_data['longitude'] == 'default' or float(job_data['longitude'])
-                assert job_data['start_date'] == 'default' or datetime.strptime(job_data['start_date'], "%m/%d/%Y")
-                assert job_data['end_date'] == 'default' or datetime.strptime(job_data['end_date'], "%m/%d/%Y")
-            except:
-                return "Invalid job parameters.", 400
+    try:
+        job_params = _plot_job_params(request.get_json(), cached_kiosk_ids(trips_db, kiosk_db))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        job_info = add_job(job_params)
+    except:
+        return "Unable to add job.", 500
+    return job_info
 
-            try:
-                job_info = add_job({
-                    'start_date': job_data['start_date'],
-                    'end_date': job_data['end_date'],
-                    'lat': job_data['latitude'],
-                    'long': job_data['longitude'],
-                    'radius': job_data['radius'],
-                    'plot_type': job_data['plot_type']
-                })
-            except:
-                return "Unable to add job.", 500
-        else:
-            return "Invalid parameters for trip duration plot. Please provide start_date, end_date, lat, long and radius.", 400
-    else:
-        return "Invalid plot type.", 400
+@app.route('/jobs/batch', methods = ['POST'])
+def submit_jobs():
+    '''
+    Submit a list of plot jobs, each with the parameters of /jobs, at once.
+    If any job is invalid, none are submitted and the errors are returned
+    by position in the list.
 
-    return job_info
+    curl -X POST localhost:5000/jobs/batch -d '[{"kiosk1":"4055", "kiosk2":"2498", "start_date":"01/31/2023", "end_date":"01/31/2024", "plot_type":"trip_duration"}, {"kiosk1":"3795", "kiosk2":"2548", "start_date":"default", "end_date":"default", "plot_type":"trip_duration"}]' -H "Content-Type: application/json"
+    '''
+    if not _data_loaded():
+        return 'Please load data with "/data" route before submitting a job.'
+    jobs_data = request.get_json()
+    if not isinstance(jobs_data, list):
+        return "Must submit a list of jobs.", 400
+    if len(jobs_data) > JOB_BATCH_MAX:
+        return f"Too many jobs: At most {JOB_BATCH_MAX} per batch.", 400
+
+    kiosk_ids = cached_kiosk_ids(trips_db, kiosk_db)
+    jobs_params, errors = [], {}
+    for i, job_data in enumerate(jobs_data):
+        try:
+            jobs_params.append(_plot_job_params(job_data, kiosk_ids))
+        except ValueError as e:
+            errors[i] = str(e)
+    if errors:
+        return {'errors': errors}, 400
+    try:
+        return add_jobs(jobs_params)
+    except:
+        return "Unable to add jobs.", 500
+
+@app.route('/jobs/stats', methods = ['GET'])
+def get_job_stats():
+    '''
+    Returns how many submitted jobs reused a finished result ('hits'), were
+    attached to an identical job in flight ('attached') or were queued ('misses').
+
+    Example command: curl localhost:5000/jobs/stats
+    '''
+    return get_job_cache_stats()
 
 @app.route('/jobs/<job_id>', methods = ['GET'])
 def get_job(job_id):
@@ -302,13 +536,52 @@ def get_job(job_id):
 
     Example command: curl localhost:5000/jobs/<job_id>
     '''
-    if trips_db.dbsize() == 0:
-        return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
     try:
         return get_job_by_id(job_id)
     except:
         return f"Job {job_id} not found"
     
+@app.route('/jobs/<job_id>/wait', methods = ['GET'])
+def wait_job(job_id):
+    '''
+    Returns job information once the job is complete or failed, or after
+    `timeout` seconds (default 30), whichever comes first.
+
+    Example command: curl "localhost:5000/jobs/<job_id>/wait?timeout=60"
+    '''
+    try:
+        timeout = _wait_timeout(30)
+    except ValueError:
+        return "Invalid timeout: Must be a number of seconds.", 400
+    return wait_for_job(job_id, timeout)
+
+@app.route('/jobs/<job_id>/events', methods = ['GET'])
+def job_events(job_id):
+    '''
+    Streams the job information as server-sent events, one 'status' event
+    now and after every status change, until the job is complete or failed
+    or `timeout` seconds (default JOB_WAIT_MAX) have passed.
+
+    Example command: curl -N localhost:5000/jobs/<job_id>/events
+    '''
+    try:
+        timeout = _wait_timeout(JOB_WAIT_MAX)
+    except ValueError:
+        return "Invalid timeout: Must be a number of seconds.", 400
+
+    def generate():
+        for job_dict in watch_job(job_id, timeout, heartbeat=JOB_EVENTS_HEARTBEAT):
+            if job_dict is None:
+                # comment line, keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+            elif isinstance(job_dict, dict):
+                yield f'event: status\ndata: {json.dumps(job_dict)}\n\n'
+            else:
+                yield f'event: error\ndata: {json.dumps(job_dict)}\n\n'
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/results/<job_id>', methods = ['GET'])
 def get_results(job_id):
     '''
@@ -318,8 +591,6 @@ def get_results(job_id):
 
     Example command: curl -o <output_file_name> localhost:5000/results/<job_id>
     '''
-    if trips_db.dbsize() == 0:
-        return 'Please load data with "/data" route before calling other routes. Check out the /help route for more information.', 200
     # check if the job exists
     try:
         job_dict = get_job_by_id(job_id)
@@ -336,8 +607,91 @@ def get_results(job_id):
     if not results:
         # no results found
         return f"Results for job {job_id} not found."
+    elif job_dict['job parameters'].get('job_type') == 'load_data':
+        # load jobs store a summary message
+        return results.decode()
     else:
-        return Response(results, mimetype="image/png'")
+        return Response(results, mimetype=_result_file(job_dict)[1])
+
+@app.route('/jobs/<job_id>/profile', methods = ['GET'])
+def get_profile(job_id):
+    '''
+    Returns the profile of a job submitted with "profile": true, or of a
+    request made with profile=1, given the id in its X-Profile-Id header.
+    By default a text report of the functions with the most cumulative
+    time; with format=pstats, the stats file, e.g. for snakeviz.
+
+    Optional query parameters:
+        - sort: pstats sort key of the report, e.g. 'tottime' (default 'cumulative')
+        - limit: number of functions in the report (default 50)
+
+    Example command: curl "localhost:5000/jobs/<job_id>/profile?sort=tottime"
+    Example command: curl -o job.prof "localhost:5000/jobs/<job_id>/profile?format=pstats"
+    '''
+    blob = profiling.get_profile(res, job_id)
+    if blob is None:
+        return f"Profile {job_id} not found.", 404
+    if request.args.get('format') == 'pstats':
+        return Response(blob, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename={job_id}.prof'})
+    try:
+        report = profiling.profile_report(blob, request.args.get('sort', 'cumulative'), int(request.args.get('limit', 50)))
+    except (KeyError, ValueError):
+        return "Invalid sort or limit.", 400
+    return Response(report, mimetype='text/plain')
+
+def _result_file(job_dict: dict) -> tuple:
+    """File extension and MIME type of a job's result."""
+    if job_dict['job parameters'].get('job_type') == 'load_data':
+        return 'txt', 'text/plain'
+    output_format = job_dict['job parameters'].get('format', 'png')
+    return output_format, FORMATS[output_format]
+
+@app.route('/results', methods = ['GET'])
+def get_many_results():
+    '''
+    Returns the results of the comma-separated job ids in `ids`, as a zip
+    archive (format=zip, default) or a multipart/mixed stream
+    (format=multipart). The zip archive holds one file per complete job,
+    named after its id, and a status.json with the status of every job.
+    The multipart stream has one part per job, with its id and status in
+    the X-Job-Id and X-Job-Status headers and an empty body if it is not complete.
+
+    Example command: curl -o results.zip "localhost:5000/results?ids=<job_id>,<job_id>"
+    '''
+    jids = [jid for jid in request.args.get('ids', '').split(',') if jid]
+    if not jids:
+        return "Must include job ids, e.g. ids=<job_id>,<job_id>.", 400
+    if len(jids) > JOB_BATCH_MAX:
+        return f"Too many jobs: At most {JOB_BATCH_MAX} per request.", 400
+    output_format = request.args.get('format', 'zip')
+    if output_format not in ['zip', 'multipart']:
+        return "Invalid format: Must be 'zip' or 'multipart'.", 400
+    results = get_results_by_ids(jids)
+
+    if output_format == 'multipart':
+        boundary = uuid.uuid4().hex
+        def _generate():
+            for jid, (job_dict, result) in zip(jids, results):
+                status = job_dict['status'] if isinstance(job_dict, dict) else 'not found'
+                headers = f'--{boundary}\r\nX-Job-Id: {jid}\r\nX-Job-Status: {status}\r\n'
+                if result is not None:
+                    extension, mimetype = _result_file(job_dict)
+                    headers += f'Content-Type: {mimetype}\r\nContent-Disposition: attachment; filename="{jid}.{extension}"\r\n'
+                yield (headers + '\r\n').encode() + (result or b'') + b'\r\n'
+            yield f'--{boundary}--\r\n'.encode()
+        return Response(stream_with_context(_generate()), mimetype=f'multipart/mixed; boundary={boundary}')
+
+    buf = io.BytesIO()
+    statuses = {}
+    with zipfile.ZipFile(buf, 'w') as archive:
+        for jid, (job_dict, result) in zip(jids, results):
+            statuses[jid] = job_dict['status'] if isinstance(job_dict, dict) else 'not found'
+            if result is not None:
+                archive.writestr(f'{jid}.{_result_file(job_dict)[0]}', result)
+        archive.writestr('status.json', json.dumps(statuses))
+    return Response(buf.getvalue(), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="results.zip"'})
 
 @app.route('/help', methods=['GET'])
 def help_route() -> str:
@@ -348,8 +702,14 @@ def help_route() -> str:
     These are the available routes and their functionalities:
 
     /data (POST):
-        Load data (trips and kiosks) into Redis databases.
+        Submit a job loading data (trips and kiosks) into Redis databases. Poll /jobs/<job_id> for progress.
         Example: curl -X POST localhost:5000/data -d '{"rows":"100000"}' -H "Content-Type: application/json"
+        Example: curl -X POST localhost:5000/data -d '{"mode":"incremental"}' -H "Content-Type: application/json"
+
+    /trips (GET):
+        Get the trips in a date range that start or end near a location. Supports limit/cursor paging,
+        a fields projection and streamed newline-delimited JSON (format=ndjson).
+        Example: curl "localhost:5000/trips?start_date=01/03/2023&end_date=01/03/2024&latitude=30.286&longitude=-97.739&radius=5&limit=1000"
 
     /kiosk_ids (GET):
         Get a list of available kiosk IDs.
@@ -359,6 +719,14 @@ def help_route() -> str:
         Plot the n nearest kiosks to a given location on a map and return the map as an HTML file.
         Example: localhost:5000/show_nearest?n=5&lat=30.2862730619728&long=-97.73937727490916
 
+    /cache/stats (GET):
+        Get the size and hit rate of the API's dataset and map caches.
+        Example: curl localhost:5000/cache/stats
+
+    /metrics (GET):
+        Get API and worker metrics (stage and request timings, rows, bytes, job times, queue depth) for Prometheus.
+        Example: curl localhost:5000/metrics
+
     /nearest (GET):
         Print the n nearest kiosks to a given location.
         Example: curl "localhost:5000/nearest?n=5&lat=30.2862730619728&long=-97.73937727490916"
@@ -367,11 +735,40 @@ def help_route() -> str:
         Submit a job request with various parameters (e.g., start date, end date, checkout location, return location, plot type).
         Example: curl -X POST localhost:5000/jobs -d '{"kiosk1":"4055", "kiosk2":"2498", "start_date":"01/31/2023", "end_date":"01/31/2024", "plot_type":"trip_duration"}' -H "Content-Type: application/json"
 
+    /jobs/batch (POST):
+        Submit a list of job requests, each with the parameters of /jobs, at once.
+        Example: curl -X POST localhost:5000/jobs/batch -d '[{"kiosk1":"4055", "kiosk2":"2498", "start_date":"01/31/2023", "end_date":"01/31/2024", "plot_type":"trip_duration"}]' -H "Content-Type: application/json"
+
     /jobs/<job_id> (GET):
         Get job information associated with the given job ID.
         Example: curl localhost:5000/jobs/1234
+
+    /jobs/<job_id>/wait (GET):
+        Wait until the job is complete or failed, for at most timeout seconds, and get its information.
+        Example: curl "localhost:5000/jobs/1234/wait?timeout=60"
+
+    /jobs/<job_id>/events (GET):
+        Stream the job information as server-sent events every time its status changes.
+        Example: curl -N localhost:5000/jobs/1234/events
+
+    /jobs/<job_id>/profile (GET):
+        Get the profile of a job submitted with "profile": true, or of a request made with profile=1
+        (its X-Profile-Id header gives the id). Clients must be in PROFILE_ALLOWLIST.
+        Example: curl "localhost:5000/jobs/1234/profile?sort=tottime"
+
+    /jobs/stats (GET):
+        Get the number of submitted jobs that reused a finished result, joined an identical running job, or were queued.
+        Example: curl localhost:5000/jobs/stats
+
+    /results (GET):
+        Get the results of many jobs as a zip archive (default) or a multipart stream (format=multipart).
+        Example: curl -o results.zip "localhost:5000/results?ids=1234,5678"
     '''
     return help_message
 
 if __name__ == '__main__':
+    # forked before the server starts any thread; in debug mode the server runs
+    # in a child process started by the reloader, and only that one needs the pool
+    if is_running_from_reloader():
+        parallel_query.start_pool(trips_db)
     app.run(debug=True, host = '0.0.0.0', port = 5000)
\ No newline at end of file
@@ -0,0 +1,303 @@
+'''
+ASGI serving mode for the read-only lookup and status routes of api.py,
+which dominate the traffic: /nearest, /kiosk_ids, /jobs/<job_id>,
+/jobs/<job_id>/wait, /jobs/stats and /results/<job_id>. Responses are the
+same as from the Flask app.
+
+Requests wait on Redis through redis.asyncio, with one connection pool per
+database shared by all requests, instead of holding a thread each, and all
+/jobs/<job_id>/wait requests share one pub/sub connection. CPU work, such as
+parsing the kiosk data or the nearest kiosk search, runs in a thread pool
+so it doesn't stall the event loop.
+
+Run with an ASGI server, next to the Flask app for the other routes:
+    uvicorn api_async:app --host 0.0.0.0 --port 5001
+'''
+import asyncio
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import numpy as np
+import redis.asyncio as aioredis
+
+from data_lib import build_kiosk_index, dataset_cache, records_nbytes, GENERATION_KEY, KIOSK_INDEX_KEY
+from jobs import FINAL_STATUSES, JOB_CACHE_STATS_KEY, decode_job, job_events_channel, job_record_key
+from render import FORMATS
+from spatial_index import KioskIndex
+
+# Initialize logging
+log_level = os.environ.get("LOG_LEVEL")
+logging.basicConfig(level=log_level)
+
+# Most connections to Redis per database; requests wait for a free one beyond that
+REDIS_MAX_CONNECTIONS = int(os.environ.get("ASYNC_REDIS_MAX_CONNECTIONS", 64))
+
+# Threads running CPU work off the event loop
+CPU_THREADS = int(os.environ.get("ASYNC_CPU_THREADS", os.cpu_count() or 1))
+
+# Longest a client can wait on a job, in seconds, as in api.py
+JOB_WAIT_MAX = float(os.environ.get("JOB_WAIT_MAX", 300))
+
+REDIS_IP = os.environ.get("REDIS_IP")
+
+def _connect(db: int) -> aioredis.Redis:
+    pool = aioredis.BlockingConnectionPool(host=REDIS_IP, port=6379, db=db, max_connections=REDIS_MAX_CONNECTIONS)
+    return aioredis.Redis(connection_pool=pool)
+
+trips_db, kiosk_db, jdb, res = _connect(0), _connect(1), _connect(3), _connect(4)
+executor = ThreadPoolExecutor(CPU_THREADS)
+
+async def _run_cpu(function, *args):
+    """Run `function(*args)` in the thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+class JobEvents:
+    """
+    Status changes of jobs, received over one pub/sub connection shared by
+    every waiting request, so waiting on any number of jobs takes a single
+    Redis connection.
+    """
+
+    def __init__(self, db: aioredis.Redis):
+        self.db = db
+        self._pubsub = None
+        self._reader = None
+        self._waiters = {}    # channel -> set of asyncio.Event, set on every message
+        self._subscribed = {} # channel -> asyncio.Future, done once the subscription is confirmed
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str):
+        """Yield an asyncio.Event that is set whenever a message is published on `channel`."""
+        if self._pubsub is None:
+            self._pubsub = self.db.pubsub()
+        changed = asyncio.Event()
+        self._waiters.setdefault(channel, set()).add(changed)
+        try:
+            if channel not in self._subscribed:
+                self._subscribed[channel] = asyncio.get_running_loop().create_future()
+                await self._pubsub.subscribe(channel)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+            # messages are only received once Redis confirms the subscription
+            await asyncio.shield(self._subscribed[channel])
+            yield changed
+        finally:
+            waiters = self._waiters[channel]
+            waiters.discard(changed)
+            if not waiters:
+                del self._waiters[channel]
+                del self._subscribed[channel]
+                await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                channel = message['channel'].decode()
+                confirmed = self._subscribed.get(channel)
+                if message['type'] == 'subscribe' and confirmed is not None and not confirmed.done():
+                    confirmed.set_result(None)
+                elif message['type'] == 'message':
+                    for changed in self._waiters.get(channel, ()):
+                        changed.set()
+        except Exception:
+            # restarted by the next subscription, waiting requests time out meanwhile
+            logging.exception("Job event reader failed")
+
+job_events = JobEvents(jdb)
+
+def _text(body: str, status: int = 200) -> tuple:
+    return body.encode(), status, 'text/html; charset=utf-8'
+
+def _json(value) -> tuple:
+    return (json.dumps(value, sort_keys=True) + '\n').encode(), 200, 'application/json'
+
+async def _data_loaded() -> bool:
+    """See api._data_loaded."""
+    return await kiosk_db.exists('kiosks') > 0
+
+async def _cached(name: str, loader):
+    """
+    The dataset cache entry `name`, at the dataset generation read with
+    redis.asyncio. `loader` is a coroutine function returning (value, size in bytes).
+    """
+    generation = await trips_db.get(GENERATION_KEY)
+    generation = int(generation) if generation else 0
+    found, value = dataset_cache.lookup(generation, name)
+    if not found:
+        value, nbytes = await loader()
+        dataset_cache.store(generation, name, value, nbytes)
+    return value
+
+async def cached_kiosks() -> list:
+    """data_lib.cached_kiosks with redis.asyncio."""
+    async def _load():
+        blob = await kiosk_db.get('kiosks')
+        kiosk_data = await _run_cpu(json.loads, blob)
+        return kiosk_data, records_nbytes(kiosk_data)
+    return await _cached('kiosks', _load)
+
+async def cached_kiosk_index() -> KioskIndex:
+    """data_lib.cached_kiosk_index with redis.asyncio."""
+    async def _load():
+        blob = await kiosk_db.get(KIOSK_INDEX_KEY)
+        if blob is None:
+            logging.warning("Kiosk index not found, building it from kiosk data.")
+            index = await _run_cpu(build_kiosk_index, await cached_kiosks())
+        else:
+            index = await _run_cpu(KioskIndex.from_bytes, blob)
+        return index, sum(array.nbytes for array in vars(index).values() if isinstance(array, np.ndarray))
+    return await _cached('kiosk_index', _load)
+
+async def get_job_by_id(jid: str):
+    """jobs.get_job_by_id with redis.asyncio."""
+    fields = await jdb.hgetall(job_record_key(jid))
+    if fields:
+        job_dict = decode_job(fields)
+        if 'attached to' in job_dict:
+            primary = await get_job_by_id(job_dict['attached to'])
+            if isinstance(primary, dict):
+                job_dict.update({name: primary[name] for name in ['status', 'progress'] if name in primary})
+        return job_dict
+    # records written before jobs were stored as hashes
+    job_json = await jdb.get(jid)
+    if job_json:
+        return json.loads(job_json)
+    return f"No job found with ID {jid}."
+
+async def wait_for_job(jid: str, timeout: float):
+    """jobs.wait_for_job with redis.asyncio, over the shared job_events connection."""
+    job_dict = await get_job_by_id(jid)
+    if not isinstance(job_dict, dict) or job_dict['status'] in FINAL_STATUSES:
+        return job_dict
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # attached jobs take the status of the job they are attached to
+    channel = job_events_channel(job_dict.get('attached to', jid))
+    try:
+        async with job_events.subscribe(channel) as changed:
+            # read the job again, it may have changed before the subscription started
+            job_dict = await get_job_by_id(jid)
+            while job_dict['status'] not in FINAL_STATUSES:
+                await asyncio.wait_for(changed.wait(), max(deadline - loop.time(), 0))
+                changed.clear()
+                job_dict = await get_job_by_id(jid)
+    except asyncio.TimeoutError:
+        pass
+    return job_dict
+
+async def get_kiosk_keys(query: dict) -> tuple:
+    '''See api.get_kiosk_keys.'''
+    if not await _data_loaded():
+        return _text('Please load data with "/data" route before calling other routes. Check out the /help route for more information.')
+    return _text(json.dumps([kiosk['kiosk_id'] for kiosk in await cached_kiosks()]))
+
+def _nearest_kiosks_text(kiosks: list, index: KioskIndex, location: tuple, n: int) -> str:
+    positions, distances = index.knn(location, n)
+    response_string = "Nearest Kiosks:\n"
+    for kiosk, distance in zip([kiosks[i] for i in positions], distances):
+        response_string += f"- Kiosk Name: {kiosk['kiosk_name']}, Kiosk ID: {kiosk['kiosk_id']}, Distance: {distance:.2f} mi, Status: {kiosk['kiosk_status']} \n"
+    return response_string
+
+async def get_nearest_kiosks(query: dict) -> tuple:
+    '''See api.get_nearest_kiosks.'''
+    if not await _data_loaded():
+        return _text('Please load data with "/data" route before calling other routes. Check out the /help route for more information.')
+    try:
+        n, lat, long = int(query.get('n')), float(query.get('lat')), float(query.get('long'))
+    except (TypeError, ValueError):
+        return _text("Invalid parameters. Please provide valid 'n', 'lat', and 'long' parameters.", 400)
+    if not all([lat,long]):
+        return _text("Missing parameters. Please provide 'n', 'lat', and 'long' parameters.", 400)
+    kiosks, index = await cached_kiosks(), await cached_kiosk_index()
+    return _text(await _run_cpu(_nearest_kiosks_text, kiosks, index, (lat, long), n))
+
+async def get_job(query: dict, job_id: str) -> tuple:
+    '''See api.get_job.'''
+    job_dict = await get_job_by_id(job_id)
+    return _json(job_dict) if isinstance(job_dict, dict) else _text(job_dict)
+
+async def wait_job(query: dict, job_id: str) -> tuple:
+    '''See api.wait_job.'''
+    try:
+        timeout = min(max(float(query.get('timeout', 30)), 0), JOB_WAIT_MAX)
+    except ValueError:
+        return _text("Invalid timeout: Must be a number of seconds.", 400)
+    job_dict = await wait_for_job(job_id, timeout)
+    return _json(job_dict) if isinstance(job_dict, dict) else _text(job_dict)
+
+async def get_job_stats(query: dict) -> tuple:
+    '''See api.get_job_stats.'''
+    stats = {name.decode(): int(count) for name, count in (await jdb.hgetall(JOB_CACHE_STATS_KEY)).items()}
+    return _json({name: stats.get(name, 0) for name in ['hits', 'attached', 'misses']})
+
+async def get_results(query: dict, job_id: str) -> tuple:
+    '''See api.get_results.'''
+    job_dict = await get_job_by_id(job_id)
+    if not isinstance(job_dict, dict):
+        return _text(f"Job {job_id} not found.")
+    status = job_dict['status']
+    if status != 'complete':
+        return _text(f"Job {job_id} not complete. Current status: {status}")
+    results = await res.get(job_dict.get('attached to', job_id))
+    if not results:
+        return _text(f"Results for job {job_id} not found.")
+    if job_dict['job parameters'].get('job_type') == 'load_data':
+        # load jobs store a summary message
+        return _text(results.decode())
+    return results, 200, FORMATS[job_dict['job parameters'].get('format', 'png')]
+
+ROUTES = [
+    (re.compile(r'/kiosk_ids'), get_kiosk_keys),
+    (re.compile(r'/nearest'), get_nearest_kiosks),
+    (re.compile(r'/jobs/stats'), get_job_stats),
+    (re.compile(r'/jobs/(?P<job_id>[^/]+)'), get_job),
+    (re.compile(r'/jobs/(?P<job_id>[^/]+)/wait'), wait_job),
+    (re.compile(r'/results/(?P<job_id>[^/]+)'), get_results),
+]
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for db in [trips_db, kiosk_db, jdb, res]:
+                await db.connection_pool.disconnect()
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    for pattern, handler in ROUTES:
+        match = pattern.fullmatch(scope['path'])
+        if match:
+            break
+    else:
+        handler = None
+
+    if handler is None:
+        body, status, content_type = _text("Not Found: this route is served by the Flask app (api.py).", 404)
+    elif scope['method'] not in ['GET', 'HEAD']:
+        body, status, content_type = _text("Method Not Allowed", 405)
+    else:
+        query = {name: values[0] for name, values in parse_qs(scope['query_string'].decode()).items()}
+        try:
+            body, status, content_type = await handler(query, **match.groupdict())
+        except Exception:
+            logging.exception(f"Error handling {scope['path']}")
+            body, status, content_type = _text("Internal Server Error", 500)
+
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b''})
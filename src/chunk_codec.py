@@ -0,0 +1,116 @@
+import json
+import os
+import zlib
+from typing import List
+
+# optional codecs, only available if their package is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Trip chunks start with a header byte: the serializer in the high four bits
+# and the compressor in the low four. Chunks written before codecs existed are
+# bare JSON arrays, which start with '[' (0x5b, an unused serializer), so old
+# and new chunks can be read side by side.
+SERIALIZERS = {'json': 1, 'msgpack': 2}
+COMPRESSORS = {'none': 0, 'zlib': 1, 'lz4': 2, 'zstd': 3}
+
+# Codec trip chunks are written with, '<serializer>' or '<serializer>+<compressor>'
+CHUNK_CODEC = os.environ.get("CHUNK_CODEC", "json+zlib")
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+def _serialize(serializer: str, trips_data: List[dict]) -> bytes:
+    if serializer == 'json':
+        return json.dumps(trips_data, separators=(',', ':')).encode()
+    return msgpack.packb(trips_data)
+
+def _deserialize(serializer: str, payload: bytes) -> List[dict]:
+    if serializer == 'json':
+        return json.loads(payload)
+    return msgpack.unpackb(payload)
+
+def _compress(compressor: str, payload: bytes) -> bytes:
+    if compressor == 'zlib':
+        return zlib.compress(payload, ZLIB_LEVEL)
+    if compressor == 'lz4':
+        return lz4.frame.compress(payload)
+    if compressor == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return payload
+
+def _decompress(compressor: str, data: bytes) -> bytes:
+    if compressor == 'zlib':
+        return zlib.decompress(data)
+    if compressor == 'lz4':
+        return lz4.frame.decompress(data)
+    if compressor == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+# package needed by each optional part of a codec
+_REQUIREMENTS = {'msgpack': ('msgpack', msgpack), 'lz4': ('lz4', lz4), 'zstd': ('zstandard', zstandard)}
+
+def _check_available(part: str) -> None:
+    package, module = _REQUIREMENTS.get(part, (None, True))
+    if module is None:
+        raise RuntimeError(f"The {part} chunk codec requires the '{package}' package")
+
+def parse_codec(codec: str) -> tuple:
+    """
+    Split a codec name into (serializer, compressor).
+
+    Raises:
+        ValueError: if the serializer or compressor is unknown.
+    """
+    serializer, _, compressor = codec.partition('+')
+    compressor = compressor or 'none'
+    if serializer not in SERIALIZERS or compressor not in COMPRESSORS:
+        raise ValueError(f"Invalid chunk codec {codec}: Must be one of {list(SERIALIZERS)}, "
+                         f"optionally followed by + and one of {list(COMPRESSORS)}")
+    return serializer, compressor
+
+def available_codecs() -> List[str]:
+    """Every codec whose packages are installed."""
+    codecs = []
+    for serializer in SERIALIZERS:
+        for compressor in COMPRESSORS:
+            if all(_REQUIREMENTS.get(part, (None, True))[1] is not None for part in [serializer, compressor]):
+                codecs.append(serializer if compressor == 'none' else f'{serializer}+{compressor}')
+    return codecs
+
+def encode_chunk(trips_data: List[dict], codec: str = None) -> tuple:
+    """
+    Encode a chunk of trip records with `codec` (default CHUNK_CODEC).
+
+    Returns:
+        tuple: (encoded chunk, size of the serialized records before compression)
+    """
+    serializer, compressor = parse_codec(codec or CHUNK_CODEC)
+    _check_available(serializer)
+    _check_available(compressor)
+    payload = _serialize(serializer, trips_data)
+    header = bytes([SERIALIZERS[serializer] << 4 | COMPRESSORS[compressor]])
+    return header + _compress(compressor, payload), len(payload)
+
+def decode_chunk(blob: bytes) -> List[dict]:
+    """Decode a chunk of trip records written by encode_chunk, or by versions without codecs."""
+    if blob[:1] == b'[':
+        return json.loads(blob)
+    serializer = {value: name for name, value in SERIALIZERS.items()}.get(blob[0] >> 4)
+    compressor = {value: name for name, value in COMPRESSORS.items()}.get(blob[0] & 0x0f)
+    if serializer is None or compressor is None:
+        raise ValueError(f"Unknown chunk header byte {blob[0]:#04x}")
+    _check_available(serializer)
+    _check_available(compressor)
+    return _deserialize(serializer, _decompress(compressor, blob[1:]))
@@ -1,10 +1,49 @@
 import redis
 import json
+import os
+import sys
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import List
-from gcd_algorithm import great_circle_distance
+from typing import Callable, List
+import numpy as np
+from spatial_index import KioskIndex
+from route_index import RouteIndex, DailyRouteCounts
+from chunk_codec import decode_chunk
+import metrics
 import logging
 
+# Columnar trip store. Each field is kept as one packed little-endian array
+# in trips_db under the key 'column:<name>', row-aligned with get_trips().
+# Trips are stored sorted by checkout time, so date ranges are contiguous.
+TRIP_COLUMNS = {
+    'checkout_epoch': '<i8',     # checkout_datetime in seconds since the Unix epoch
+    'checkout_kiosk_id': '<i4',
+    'return_kiosk_id': '<i4',
+    'duration_minutes': '<i4',
+    'day': '<i4',                # checkout day in days since the Unix epoch
+}
+MISSING_ID = -1
+
+# Serialized KioskIndex over the kiosks, stored in kiosk_db next to 'kiosks'
+KIOSK_INDEX_KEY = 'kiosk_index'
+
+# Serialized RouteIndex and DailyRouteCounts over the trip columns, stored in trips_db
+ROUTE_INDEX_KEY = 'route_index'
+DAILY_COUNTS_KEY = 'daily_route_counts'
+
+# Dataset generation counter, bumped by every write to the trips/kiosk data
+GENERATION_KEY = 'generation'
+
+# JSON description of the stored trips, written by /data alongside the chunks:
+# {'schema_version', 'generation', 'rows', 'min_epoch', 'max_epoch',
+#  'chunks': [{'key', 'rows', 'min_epoch', 'max_epoch', 'codec', 'nbytes'}, ...]}
+# with the chunks in row order, checkout times in seconds since the Unix epoch,
+# and the codec and uncompressed size of each chunk (see chunk_codec). Version 1
+# manifests have no 'codec' or 'nbytes'.
+MANIFEST_KEY = 'manifest'
+MANIFEST_SCHEMA_VERSION = 2
+
 def get_data(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis) -> tuple:
     """
     Retrieve trips and kiosk data from Redis databases.
@@ -17,32 +56,96 @@ def get_data(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis) -> tupl
         tuple: A tuple containing trips data (list) and kiosk data (list).
     """
     # Retrieve trips & kiosk data from redis database
-    trips_data = []
-    for key in sorted(trips_db.keys()):
-        trips_data.extend(json.loads(trips_db.get(key)))
+    trips_data = get_trips(trips_db)
 
     # Retrieve kiosks data
     kiosk_data = json.loads(kiosk_db.get('kiosks'))
 
     return trips_data, kiosk_data
 
-def get_trips(trips_db: redis.client.Redis) -> tuple:
+def get_trips(trips_db: redis.client.Redis, start_datetime: datetime = None, end_datetime: datetime = None) -> List[dict]:
     """
     Retrieve trips data from Redis database.
 
     Args:
         trips_db (redis.client.Redis): Redis connection for trips database.
+        start_datetime, end_datetime (datetime): Optional checkout time range. Chunks
+            that the manifest shows hold no trip in the range are not read at all;
+            the others are returned whole, so filter_by_date still applies.
 
     Returns:
         List[dict]: Trips data
     """
-    # Retrieve trips data
-    trips_data = []
-    for key in sorted(trips_db.keys()):
-        trips_data.extend(json.loads(trips_db.get(key)))
+    chunks = get_manifest(trips_db)['chunks']
+    if start_datetime is not None:
+        chunks = [chunk for chunk in chunks if chunk['max_epoch'] >= to_epoch(start_datetime)]
+    if end_datetime is not None:
+        chunks = [chunk for chunk in chunks if chunk['min_epoch'] <= to_epoch(end_datetime)]
+    if not chunks:
+        return []
 
+    # Retrieve trips data
+    trips_data, _ = _read_chunks(trips_db, [chunk['key'] for chunk in chunks])
     return trips_data
 
+def _read_chunks(trips_db: redis.client.Redis, keys: List[str]) -> tuple:
+    """Fetch and decode the trip chunks at `keys`. Returns (trip records, encoded chunks)."""
+    with metrics.stage('redis_fetch') as stage:
+        blobs = trips_db.mget(keys)
+        stage.nbytes = sum(len(blob) for blob in blobs)
+    with metrics.stage('chunk_decode') as stage:
+        trips_data = [trip for blob in blobs for trip in decode_chunk(blob)]
+        stage.rows = len(trips_data)
+    return trips_data, blobs
+
+def trip_chunk_keys(trips_db: redis.client.Redis) -> List[str]:
+    """Return the keys holding JSON trip records, in row order."""
+    return [chunk['key'] for chunk in get_manifest(trips_db)['chunks']]
+
+def new_manifest() -> dict:
+    """The manifest of a dataset without trips."""
+    return {'schema_version': MANIFEST_SCHEMA_VERSION, 'generation': 0, 'rows': 0,
+            'min_epoch': None, 'max_epoch': None, 'chunks': []}
+
+def add_manifest_chunk(manifest: dict, key: str, columns: dict, codec: str, nbytes: int) -> dict:
+    """
+    Return `manifest` with the chunk stored at `key` appended, given the
+    trip columns of the chunk (see build_trip_columns), its codec and its
+    size before compression.
+    """
+    epoch = columns['checkout_epoch']
+    chunk = {'key': key, 'rows': len(epoch), 'min_epoch': int(epoch.min()), 'max_epoch': int(epoch.max()),
+             'codec': codec, 'nbytes': nbytes}
+    bounds = [bound for bound in [manifest['min_epoch'], manifest['max_epoch']] if bound is not None]
+    return {**manifest, 'rows': manifest['rows'] + chunk['rows'],
+            'min_epoch': min(bounds + [chunk['min_epoch']]), 'max_epoch': max(bounds + [chunk['max_epoch']]),
+            'chunks': manifest['chunks'] + [chunk]}
+
+def get_manifest(trips_db: redis.client.Redis) -> dict:
+    """
+    Return the manifest of the trips in trips_db, see MANIFEST_KEY.
+
+    Data loaded by older versions has no manifest. It is then rebuilt from
+    the 'trips' and 'chunk <i>' keys, found with SCAN and ordered numerically
+    so that 'chunk 10' comes after 'chunk 2', but not stored.
+    """
+    blob = trips_db.get(MANIFEST_KEY)
+    if blob is not None:
+        return json.loads(blob)
+
+    manifest = new_manifest()
+    keys = [key.decode() for key in trips_db.scan_iter(match='chunk *')] + \
+        (['trips'] if trips_db.exists('trips') else [])
+    if keys:
+        logging.warning("Dataset manifest not found, rebuilding it from the trip records.")
+    for key in sorted(keys, key=lambda key: -1 if key == 'trips' else int(key.split()[1])):
+        blob = trips_db.get(key)
+        trips_data = decode_chunk(blob)
+        if trips_data:
+            manifest = add_manifest_chunk(manifest, key, build_trip_columns(trips_data), 'json', len(blob))
+    manifest['generation'] = get_generation(trips_db)
+    return manifest
+
 def get_kiosks(kiosk_db: redis.client.Redis) -> tuple:
     """
     Retrieve kiosk data from Redis database.
@@ -57,6 +160,232 @@ def get_kiosks(kiosk_db: redis.client.Redis) -> tuple:
     kiosk_data = json.loads(kiosk_db.get('kiosks'))
     return kiosk_data
 
+def column_key(name: str) -> str:
+    """Return the trips_db key holding the packed array for column `name`."""
+    return f'column:{name}'
+
+def parse_kiosk_ids(values: List[str]) -> np.ndarray:
+    """
+    Convert kiosk id strings to an int32 array. Ids that are missing or
+    not integers are mapped to MISSING_ID.
+    """
+    try:
+        ids = np.array(values, dtype='U').astype(np.int32)
+    except ValueError:
+        ids = np.array([int(v) if v and v.isdigit() else MISSING_ID for v in values], dtype=np.int32)
+    ids[ids < 0] = MISSING_ID
+    return ids
+
+def to_epoch(dt: datetime) -> int:
+    """Convert a naive datetime to seconds since the Unix epoch, as stored in 'checkout_epoch'."""
+    return int(np.datetime64(dt, 's').astype(np.int64))
+
+def build_trip_columns(trips_data: List[dict]) -> dict:
+    """
+    Build the columnar representation of a list of trip records.
+
+    Args:
+        trips_data (List[dict]): Trip records as returned by the trips API.
+
+    Returns:
+        dict: Maps each name in TRIP_COLUMNS to a NumPy array with one entry per trip.
+    """
+    epoch = np.array([trip['checkout_datetime'] for trip in trips_data], dtype='datetime64[s]').astype(np.int64)
+    durations = [trip.get('trip_duration_minutes') or MISSING_ID for trip in trips_data]
+    columns = {
+        'checkout_epoch': epoch,
+        'checkout_kiosk_id': parse_kiosk_ids([trip.get('checkout_kiosk_id') for trip in trips_data]),
+        'return_kiosk_id': parse_kiosk_ids([trip.get('return_kiosk_id') for trip in trips_data]),
+        'duration_minutes': np.array(durations, dtype=np.float64),
+        'day': epoch // 86400,
+    }
+    return {name: columns[name].astype(dtype) for name, dtype in TRIP_COLUMNS.items()}
+
+def store_trip_columns(trips_db: redis.client.Redis, columns: dict) -> None:
+    """
+    Write trip columns to trips_db as packed binary blobs.
+
+    Args:
+        trips_db (redis.client.Redis): Redis connection for trips database.
+        columns (dict): Output of build_trip_columns.
+    """
+    pipe = trips_db.pipeline()
+    for name, dtype in TRIP_COLUMNS.items():
+        pipe.set(column_key(name), np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+    pipe.execute()
+
+def load_trip_columns(trips_db: redis.client.Redis) -> dict:
+    """
+    Load the trip columns from trips_db, sorted by checkout time.
+
+    The arrays are read-only views over the bytes returned by Redis, so
+    nothing is decoded or copied. If the columns are missing (e.g. data
+    loaded by an older version) they are rebuilt from the trip records.
+
+    Args:
+        trips_db (redis.client.Redis): Redis connection for trips database.
+
+    Returns:
+        dict: Maps each name in TRIP_COLUMNS to a NumPy array, plus 'row',
+        the position of each trip in get_trips().
+    """
+    with metrics.stage('redis_fetch') as stage:
+        blobs = trips_db.mget([column_key(name) for name in TRIP_COLUMNS])
+        stage.nbytes = sum(len(blob) for blob in blobs if blob is not None)
+    if any(blob is None for blob in blobs):
+        logging.warning("Trip columns not found, rebuilding them from trip records.")
+        columns = build_trip_columns(get_trips(trips_db))
+    else:
+        columns = {name: np.frombuffer(blob, dtype=dtype) for (name, dtype), blob in zip(TRIP_COLUMNS.items(), blobs)}
+    return sort_trip_columns(columns)
+
+def sort_trip_columns(columns: dict) -> dict:
+    """
+    Order trip columns by checkout time and add the 'row' column mapping each
+    entry back to its trip record.
+
+    Data written by /data is already sorted, in which case this is a single
+    vectorized check and the columns are returned as they are.
+    """
+    epoch = columns['checkout_epoch']
+    if np.all(epoch[1:] >= epoch[:-1]):
+        order = np.arange(len(epoch))
+    else:
+        logging.warning("Trip columns are not sorted by checkout time, sorting them.")
+        order = np.argsort(epoch, kind='stable')
+        columns = {name: column[order] for name, column in columns.items()}
+    return {**columns, 'row': order}
+
+def date_range(columns: dict, start_datetime: datetime, end_datetime: datetime) -> slice:
+    '''
+    Columnar equivalent of filter_by_date. Finds the trips checked out within
+    [start_datetime, end_datetime] with two binary searches over the sorted
+    checkout times.
+
+    Returns:
+        slice: the contiguous range of matching entries in the columns
+    '''
+    with metrics.stage('date_filter') as stage:
+        epoch = columns['checkout_epoch']
+        start = np.searchsorted(epoch, to_epoch(start_datetime), side='left')
+        stop = np.searchsorted(epoch, to_epoch(end_datetime), side='right')
+        rows = slice(int(start), int(max(start, stop)))
+        stage.rows = rows.stop - rows.start
+    return rows
+
+def slice_columns(columns: dict, rows: slice) -> dict:
+    '''Return views of every column restricted to `rows`.'''
+    return {name: column[rows] for name, column in columns.items()}
+
+def build_kiosk_index(kiosk_data: List[dict]) -> KioskIndex:
+    '''
+    Build the spatial index over kiosk locations. Query results are
+    positions into `kiosk_data`.
+    '''
+    lats = [float(kiosk_dict['location']['latitude']) for kiosk_dict in kiosk_data]
+    longs = [float(kiosk_dict['location']['longitude']) for kiosk_dict in kiosk_data]
+    return KioskIndex(lats, longs, parse_kiosk_ids([kiosk_dict['kiosk_id'] for kiosk_dict in kiosk_data]))
+
+def store_kiosk_index(kiosk_db: redis.client.Redis, kiosk_data: List[dict]) -> None:
+    """
+    Build the kiosk spatial index and store it in kiosk_db, so that API
+    replicas and workers can load it without rebuilding it.
+    """
+    kiosk_db.set(KIOSK_INDEX_KEY, build_kiosk_index(kiosk_data).to_bytes())
+
+def load_kiosk_index(kiosk_db: redis.client.Redis, kiosk_data: List[dict]) -> KioskIndex:
+    """
+    Load the kiosk spatial index from kiosk_db, building it from `kiosk_data`
+    if it has not been stored (e.g. data loaded by an older version).
+    """
+    blob = kiosk_db.get(KIOSK_INDEX_KEY)
+    if blob is None:
+        logging.warning("Kiosk index not found, building it from kiosk data.")
+        return build_kiosk_index(kiosk_data)
+    return KioskIndex.from_bytes(blob)
+
+def _update_rollup(trips_db: redis.client.Redis, key: str, rollup_class: type, columns: dict):
+    # trips appended since the rollup was stored are merged in, replaced data is rebuilt
+    blob = trips_db.get(key)
+    rollup = rollup_class.from_bytes(blob) if blob is not None else None
+    n_trips = len(columns['checkout_epoch'])
+    if rollup is None or rollup.n_trips > n_trips:
+        rollup = rollup_class.build(columns, MISSING_ID)
+    elif rollup.n_trips < n_trips:
+        rollup = rollup.extend(slice_columns(columns, slice(rollup.n_trips, n_trips)), MISSING_ID)
+    trips_db.set(key, rollup.to_bytes())
+    return rollup
+
+def _load_rollup(trips_db: redis.client.Redis, key: str, rollup_class: type, columns: dict):
+    blob = trips_db.get(key)
+    rollup = rollup_class.from_bytes(blob) if blob is not None else None
+    if rollup is None or rollup.n_trips != len(columns['checkout_epoch']):
+        logging.warning(f"{rollup_class.__name__} not found or out of date, building it from trip columns.")
+        return rollup_class.build(columns, MISSING_ID)
+    return rollup
+
+def update_trip_rollups(trips_db: redis.client.Redis, columns: dict) -> None:
+    """
+    Bring the stored route index and daily route counts up to date with the
+    trip columns.
+
+    Trips appended since they were stored are merged in. If they are
+    missing, or cover more trips than `columns` (the data was replaced),
+    they are rebuilt from scratch.
+
+    Args:
+        trips_db (redis.client.Redis): Redis connection for trips database.
+        columns (dict): All the trip columns, see load_trip_columns.
+    """
+    _update_rollup(trips_db, ROUTE_INDEX_KEY, RouteIndex, columns)
+    _update_rollup(trips_db, DAILY_COUNTS_KEY, DailyRouteCounts, columns)
+
+def load_route_index(trips_db: redis.client.Redis, columns: dict) -> RouteIndex:
+    """
+    Load the route index from trips_db, building it from `columns` if it has
+    not been stored or is out of date (e.g. data loaded by an older version).
+    """
+    return _load_rollup(trips_db, ROUTE_INDEX_KEY, RouteIndex, columns)
+
+def load_daily_counts(trips_db: redis.client.Redis, columns: dict) -> DailyRouteCounts:
+    """
+    Load the daily route counts from trips_db, building them from `columns`
+    if they have not been stored or are out of date.
+    """
+    return _load_rollup(trips_db, DAILY_COUNTS_KEY, DailyRouteCounts, columns)
+
+def kiosks_within(kiosk_data: List[dict], coordinates: tuple, radius: float, index: KioskIndex = None) -> np.ndarray:
+    '''
+    Returns:
+        np.ndarray: the integer ids (see parse_kiosk_ids) of the kiosks within
+        `radius` km of `coordinates`
+    '''
+    index = index if index is not None else build_kiosk_index(kiosk_data)
+    positions, _ = index.within(coordinates, radius)
+    return parse_kiosk_ids([kiosk_data[i]['kiosk_id'] for i in positions])
+
+def location_mask(columns: dict, kiosk_data: List[dict], coordinates: tuple, radius: float,
+                  index: KioskIndex = None) -> np.ndarray:
+    '''
+    Columnar equivalent of filter_by_location. `index` is the kiosk spatial
+    index, it is built from `kiosk_data` if not given.
+
+    Returns:
+        np.ndarray: boolean mask of the trips whose checkout and return kiosks
+        are both within `radius` km of `coordinates`
+    '''
+    with metrics.stage('location_filter') as stage:
+        kiosk_ids = kiosks_within(kiosk_data, coordinates, radius, index)
+
+        # lookup table indexed by kiosk id, the last entry (index -1) catches MISSING_ID
+        checkout_ids, return_ids = columns['checkout_kiosk_id'], columns['return_kiosk_id']
+        size = max(kiosk_ids.max(initial=0), checkout_ids.max(initial=0), return_ids.max(initial=0)) + 2
+        table = np.zeros(size, dtype=bool)
+        table[kiosk_ids[kiosk_ids != MISSING_ID]] = True
+
+        mask = table[checkout_ids] & table[return_ids]
+        stage.rows = int(np.count_nonzero(mask))
+    return mask
 
 def filter_by_date(trips_data: List[dict], start_datetime: datetime, end_datetime:datetime) -> List[dict]:
     '''
@@ -82,10 +411,14 @@ def filter_by_date(trips_data: List[dict], start_datetime: datetime, end_datetim
         date_str = trip_dict['checkout_datetime']
         trip_datetime = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S.%f')
         return start_datetime <= trip_datetime <= end_datetime
-    
-    return [trip for trip in trips_data if _in_interval(trip)]
 
-def filter_by_location(trips_data: List[dict], kiosk_data: List[dict], coordinates: tuple, radius:float) -> List[dict]:
+    with metrics.stage('date_filter') as stage:
+        filtered_data = [trip for trip in trips_data if _in_interval(trip)]
+        stage.rows = len(filtered_data)
+    return filtered_data
+
+def filter_by_location(trips_data: List[dict], kiosk_data: List[dict], coordinates: tuple, radius:float,
+                       index: KioskIndex = None) -> List[dict]:
     '''
     Filters trip data based on the distance of the checkout or return kiosk to a specified geolocation
 
@@ -94,6 +427,7 @@ def filter_by_location(trips_data: List[dict], kiosk_data: List[dict], coordinat
         kiosk_data: Each dict is data for one kiosk. Must have keys 'kiosk_id', and 'location'
         coordinates: (float, float) - the specified latitude and longitude
         radius: distance in km around specified coordinates to filter by.
+        index: kiosk spatial index, built from kiosk_data if not given
 
     Returns:
         List[dict]: the filtered data
@@ -106,15 +440,11 @@ def filter_by_location(trips_data: List[dict], kiosk_data: List[dict], coordinat
                         coordinates=ut_coords,
                         radius = 10)
     '''
-    # precompute distance from each kiosk to the coordinates
-    kiosk_distances = {} # dict mapping kiosk id to distance from coordinates
-    lat1, long1 = coordinates
-    for kiosk_dict in kiosk_data:
-        kiosk_id = kiosk_dict['kiosk_id']
-        kiosk_loc = kiosk_dict['location']
-        lat2, long2 = float(kiosk_loc['latitude']), float(kiosk_loc['longitude'])
-        dist = great_circle_distance(lat1, long1, lat2, long2)
-        kiosk_distances[kiosk_id] = dist
+    # look up the kiosks within the radius of the coordinates
+    index = index if index is not None else build_kiosk_index(kiosk_data)
+    positions, _ = index.within(coordinates, radius)
+    ids_in_radius = {kiosk_data[i]['kiosk_id'] for i in positions}
+    all_ids = {kiosk_dict['kiosk_id'] for kiosk_dict in kiosk_data}
 
     missing_ids = set()
 
@@ -122,44 +452,251 @@ def filter_by_location(trips_data: List[dict], kiosk_data: List[dict], coordinat
     def _kiosks_in_radius(trip):
         # check if both kiosks are within radius
         for kiosk_id in (trip['checkout_kiosk_id'], trip['return_kiosk_id']):
-            try:
-                dist = kiosk_distances[kiosk_id]
-            except KeyError:
+            if kiosk_id not in all_ids:
                 missing_ids.add(kiosk_id)
                 return False
 
-            if dist > radius:
+            if kiosk_id not in ids_in_radius:
                 return False
             
         return True
 
     # filter data with list comprehension
-    filtered_data = [trip for trip in trips_data if _kiosks_in_radius(trip)]
+    with metrics.stage('location_filter') as stage:
+        filtered_data = [trip for trip in trips_data if _kiosks_in_radius(trip)]
+        stage.rows = len(filtered_data)
 
     # report missing kiosk ids
     logging.info(f"Missing kiosk IDs {missing_ids}")
 
     return filtered_data
 
-def nearest_kiosks( coordinates: tuple, kiosk_data: List[dict], n_kiosks) -> dict:
+def nearest_kiosks( coordinates: tuple, kiosk_data: List[dict], n_kiosks, index: KioskIndex = None) -> dict:
     '''
     Tells the user the nearest kiosk locations 
     
     Args:
     location[tuple]: The coordinates the user inputs
+    index[KioskIndex]: kiosk spatial index, built from kiosk_data if not given
 
     Returns:
 
     (will name the variable here) [dict]: Returns the name/location of nearby kiosks and their eclidian distance magnitude 
     '''
-    lat_1,long_1 = coordinates
-
-    def dist_from_point(kiosk_dict):
-        kiosk_coords = kiosk_dict['location']
-        lat = float(kiosk_coords['latitude'])
-        long = float(kiosk_coords['longitude'])
-        return great_circle_distance(lat,long,lat_1,long_1)
-    
-    sorted_kiosks = sorted(kiosk_data, key = dist_from_point )
+    index = index if index is not None else build_kiosk_index(kiosk_data)
+    positions, _ = index.knn(coordinates, n_kiosks)
+
+    return [kiosk_data[i] for i in positions]
+
+def get_generation(trips_db: redis.client.Redis) -> int:
+    """Return the current dataset generation (0 if no data has been loaded)."""
+    generation = trips_db.get(GENERATION_KEY)
+    return int(generation) if generation else 0
+
+def _set_generation(pipe: redis.client.Pipeline, generation: int) -> int:
+    # set the generation counter and the manifest's copy of it together
+    manifest = pipe.get(MANIFEST_KEY)
+    pipe.multi()
+    pipe.set(GENERATION_KEY, generation)
+    if manifest is not None:
+        pipe.set(MANIFEST_KEY, json.dumps({**json.loads(manifest), 'generation': generation}))
+    return generation
+
+def set_generation(trips_db: redis.client.Redis, generation: int) -> None:
+    """Publish a new dataset generation, invalidating every process-local cache."""
+    trips_db.transaction(lambda pipe: _set_generation(pipe, generation), MANIFEST_KEY)
+
+def bump_generation(trips_db: redis.client.Redis) -> int:
+    """Atomically advance the dataset generation and return the new value."""
+    return trips_db.transaction(lambda pipe: _set_generation(pipe, get_generation(pipe) + 1),
+                                GENERATION_KEY, MANIFEST_KEY, value_from_callable=True)
+
+class DatasetCache:
+    """
+    Process-local cache of parsed datasets, shared by the API and the worker.
+
+    Entries are tagged with the dataset generation they were loaded at. Every
+    lookup does a single GET of the generation; when it has changed, all
+    entries are dropped before anything is served. Within a generation,
+    entries are evicted least-recently-used first once their total size
+    exceeds `max_bytes`, and values larger than `max_bytes` are never cached.
+    Sizes are the memory the values hold: the nbytes of NumPy arrays, or
+    value_nbytes and records_nbytes for parsed JSON.
+    """
 
-    return sorted_kiosks[0:n_kiosks]
\ No newline at end of file
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # name -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def get(self, trips_db: redis.client.Redis, name: str, loader: Callable[[], tuple]):
+        """
+        Return the cached value for `name`, calling `loader` on a miss.
+
+        Args:
+            trips_db (redis.client.Redis): Redis connection holding the generation counter.
+            name (str): Cache entry name.
+            loader (Callable): Returns a tuple (value, size in bytes).
+        """
+        generation = get_generation(trips_db)
+        found, value = self.lookup(generation, name)
+        if not found:
+            value, nbytes = loader()
+            self.store(generation, name, value, nbytes)
+        return value
+
+    def lookup(self, generation: int, name: str) -> tuple:
+        """
+        Return (True, cached value) for `name` at dataset `generation`, or
+        (False, None) on a miss. For callers that read the generation
+        themselves, e.g. with redis.asyncio, and then store what they load.
+        """
+        with self._lock:
+            if generation != self.generation:
+                self._evict_all()
+                self.generation = generation
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return True, self._entries[name][0]
+            self.misses += 1
+            return False, None
+
+    def store(self, generation: int, name: str, value, nbytes: int) -> None:
+        """Cache `value` of size `nbytes` as `name`, loaded at dataset `generation`."""
+        with self._lock:
+            # don't store data that was superseded while it was loading
+            if generation == self.generation and nbytes <= self.max_bytes and name not in self._entries:
+                self._entries[name] = (value, nbytes)
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted_bytes
+                    self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every cached entry."""
+        with self._lock:
+            self._evict_all()
+
+    def _evict_all(self) -> None:
+        self.evictions += len(self._entries)
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Return size and hit/miss counters for logging."""
+        with self._lock:
+            return {'generation': self.generation, 'entries': list(self._entries), 'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+dataset_cache = DatasetCache(int(os.environ.get('DATASET_CACHE_MAX_BYTES', 2**30)))
+
+# Most records measured by records_nbytes
+SIZE_SAMPLE = 100
+
+def value_nbytes(value) -> int:
+    """Memory held by a parsed JSON value, measured with sys.getsizeof down to every key and item."""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_nbytes(key) + value_nbytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(value_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+def records_nbytes(records: list) -> int:
+    """
+    Estimated memory held by a list of parsed records, the size the dataset
+    cache charges for them: the list, plus the average value_nbytes of up
+    to SIZE_SAMPLE records spread over it times the number of records. Keys
+    are counted in every record, though decoders may share them, so the
+    estimate errs high.
+    """
+    sample = records[::max(1, len(records) // SIZE_SAMPLE)]
+    per_record = sum(value_nbytes(record) for record in sample) / len(sample) if sample else 0
+    return sys.getsizeof(records) + int(per_record * len(records))
+
+def cached_manifest(trips_db: redis.client.Redis) -> dict:
+    """get_manifest through the process-local dataset cache. The result must not be modified."""
+    def _load():
+        manifest = get_manifest(trips_db)
+        return manifest, value_nbytes(manifest)
+    return dataset_cache.get(trips_db, 'manifest', _load)
+
+def cached_trips(trips_db: redis.client.Redis) -> List[dict]:
+    """get_trips through the process-local dataset cache. The result must not be modified."""
+    def _load():
+        chunks = cached_manifest(trips_db)['chunks']
+        trips_data, _ = _read_chunks(trips_db, [chunk['key'] for chunk in chunks]) if chunks else ([], [])
+        return trips_data, records_nbytes(trips_data)
+    return dataset_cache.get(trips_db, 'trips', _load)
+
+def cached_trip_records(trips_db: redis.client.Redis, rows: np.ndarray) -> List[dict]:
+    """
+    The trip records at positions `rows` of get_trips(), through the
+    process-local dataset cache. Only the chunks holding them are read and
+    cached. The records must not be modified.
+    """
+    chunks = cached_manifest(trips_db)['chunks']
+    starts = np.cumsum([0] + [chunk['rows'] for chunk in chunks])
+    chunk_of = np.searchsorted(starts, rows, side='right') - 1
+
+    def _loader(chunk):
+        def _load():
+            trips_data, _ = _read_chunks(trips_db, [chunk['key']])
+            return trips_data, records_nbytes(trips_data)
+        return _load
+
+    records = {i: dataset_cache.get(trips_db, f"chunk:{chunks[i]['key']}", _loader(chunks[i]))
+               for i in np.unique(chunk_of)}
+    return [records[i][row - starts[i]] for i, row in zip(chunk_of, rows)]
+
+def cached_kiosks(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis) -> List[dict]:
+    """get_kiosks through the process-local dataset cache. The result must not be modified."""
+    def _load():
+        with metrics.stage('redis_fetch') as stage:
+            blob = kiosk_db.get('kiosks')
+            stage.nbytes = len(blob)
+        kiosk_data = json.loads(blob)
+        return kiosk_data, records_nbytes(kiosk_data)
+    return dataset_cache.get(trips_db, 'kiosks', _load)
+
+def cached_kiosk_ids(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis) -> frozenset:
+    """The set of kiosk ids, for validating job parameters, through the process-local dataset cache."""
+    def _load():
+        kiosk_ids = frozenset(kiosk['kiosk_id'] for kiosk in cached_kiosks(trips_db, kiosk_db))
+        return kiosk_ids, value_nbytes(kiosk_ids)
+    return dataset_cache.get(trips_db, 'kiosk_ids', _load)
+
+def cached_kiosk_index(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis) -> KioskIndex:
+    """load_kiosk_index through the process-local dataset cache."""
+    def _load():
+        index = load_kiosk_index(kiosk_db, cached_kiosks(trips_db, kiosk_db))
+        return index, sum(array.nbytes for array in vars(index).values() if isinstance(array, np.ndarray))
+    return dataset_cache.get(trips_db, 'kiosk_index', _load)
+
+def cached_trip_columns(trips_db: redis.client.Redis) -> dict:
+    """load_trip_columns through the process-local dataset cache."""
+    def _load():
+        columns = load_trip_columns(trips_db)
+        return columns, sum(column.nbytes for column in columns.values())
+    return dataset_cache.get(trips_db, 'columns', _load)
+
+def cached_route_index(trips_db: redis.client.Redis) -> RouteIndex:
+    """load_route_index through the process-local dataset cache."""
+    def _load():
+        index = load_route_index(trips_db, cached_trip_columns(trips_db))
+        return index, index.nbytes()
+    return dataset_cache.get(trips_db, 'route_index', _load)
+
+def cached_daily_counts(trips_db: redis.client.Redis) -> DailyRouteCounts:
+    """load_daily_counts through the process-local dataset cache."""
+    def _load():
+        counts = load_daily_counts(trips_db, cached_trip_columns(trips_db))
+        return counts, counts.nbytes()
+    return dataset_cache.get(trips_db, 'daily_counts', _load)
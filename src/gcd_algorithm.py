@@ -1,46 +1,98 @@
-from math import radians, sin, cos, acos
+import numpy as np
 
-def great_circle_distance(
-    lat1: float, 
-    long1: float, 
-    lat2: float, 
-    long2: float, 
-    radius: float = 6371.009, 
-    input_format: str = 'degrees'
-) -> float:
+def great_circle_distances(
+    lat1,
+    long1,
+    lat2,
+    long2,
+    radius: float = 6371.009,
+    input_format: str = 'degrees',
+    method: str = 'haversine',
+    pairwise: bool = False
+) -> np.ndarray:
     """
-    Description: Computes the great circle distance of two points on a sphere 
-    using the spherical law of cosines. 
+    Description: Computes great circle distances between arrays of points on
+    a sphere in a single vectorized pass.
+
+    By default the inputs are broadcast against each other, so passing a
+    single point for point 1 and arrays for point 2 computes one-to-many
+    distances. With `pairwise=True` the distance from every point 1 to every
+    point 2 is computed instead.
 
     Additional info: https://en.wikipedia.org/wiki/Great-circle_distance
 
     Parameters:
-    - long1 (float): The longitude of point 1.
-    - lat1 (float): The latitude of point 1.
-    - long2 (float): The longitude of point 2.
-    - lat2 (float): The latitude of point 2.
-    - radius (float): Radius of the sphere. 
+    - lat1, long1 (float or array-like): Latitudes and longitudes of point(s) 1.
+    - lat2, long2 (float or array-like): Latitudes and longitudes of point(s) 2.
+    - radius (float): Radius of the sphere.
       Default 6371.009 - the mean radius of Earth in km.
     - input_format (string): Either 'degrees' or 'radians'. Default 'degrees'
+    - method (string): Either 'haversine' or 'cosines'. Default 'haversine'.
+      The spherical law of cosines loses precision for nearby points, the
+      haversine formula is numerically stable at all distances.
+    - pairwise (bool): If True, return a matrix of shape (len(lat1), len(lat2)).
 
     Returns:
-    - float: The great-circle distance between point 1 and point 2.
+    - np.ndarray: The great-circle distances between point(s) 1 and point(s) 2.
     """
 
     # check for valid input
     if input_format not in ['degrees', 'radians']:
         raise ValueError("Invalid format: Must be 'degrees' or 'radians'")
+    if method not in ['haversine', 'cosines']:
+        raise ValueError("Invalid method: Must be 'haversine' or 'cosines'")
+
+    lat1, long1 = np.asarray(lat1, dtype=np.float64), np.asarray(long1, dtype=np.float64)
+    lat2, long2 = np.asarray(lat2, dtype=np.float64), np.asarray(long2, dtype=np.float64)
 
     # convert coordinates if specified
     if input_format == 'degrees':
-        long1, lat1 = radians(long1), radians(lat1)
-        long2, lat2 = radians(long2), radians(lat2)
+        lat1, long1 = np.radians(lat1), np.radians(long1)
+        lat2, long2 = np.radians(lat2), np.radians(long2)
 
+    # broadcast to a (len(point 1), len(point 2)) matrix
+    if pairwise:
+        lat1, long1 = lat1.reshape(-1, 1), long1.reshape(-1, 1)
+        lat2, long2 = lat2.reshape(1, -1), long2.reshape(1, -1)
 
-    # compute central angle using spherical law of cosines
-    delta_lambda = abs(long1 - long2)
-    delta_sigma = acos(sin(lat1)*sin(lat2) + cos(lat1)
-                       * cos(lat2)*cos(delta_lambda))
+    # compute central angle
+    delta_lambda = np.abs(long1 - long2)
+    if method == 'haversine':
+        h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(delta_lambda / 2)**2
+        delta_sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    else:
+        cos_sigma = np.sin(lat1)*np.sin(lat2) + np.cos(lat1)*np.cos(lat2)*np.cos(delta_lambda)
+        delta_sigma = np.arccos(np.clip(cos_sigma, -1, 1))
 
     # return arclength of the sphere
-    return delta_sigma * radius
\ No newline at end of file
+    return delta_sigma * radius
+
+def great_circle_distance(
+    lat1: float,
+    long1: float,
+    lat2: float,
+    long2: float,
+    radius: float = 6371.009,
+    input_format: str = 'degrees',
+    method: str = 'haversine'
+) -> float:
+    """
+    Description: Computes the great circle distance of two points on a sphere.
+    Scalar wrapper around great_circle_distances.
+
+    Additional info: https://en.wikipedia.org/wiki/Great-circle_distance
+
+    Parameters:
+    - long1 (float): The longitude of point 1.
+    - lat1 (float): The latitude of point 1.
+    - long2 (float): The longitude of point 2.
+    - lat2 (float): The latitude of point 2.
+    - radius (float): Radius of the sphere.
+      Default 6371.009 - the mean radius of Earth in km.
+    - input_format (string): Either 'degrees' or 'radians'. Default 'degrees'
+    - method (string): Either 'haversine' or 'cosines'. Default 'haversine'
+
+    Returns:
+    - float: The great-circle distance between point 1 and point 2.
+    """
+    return float(great_circle_distances(lat1, long1, lat2, long2, radius, input_format, method))
@@ -0,0 +1,379 @@
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterator, List, Optional
+import numpy as np
+import redis
+import requests
+
+from data_lib import TRIP_COLUMNS, GENERATION_KEY, MANIFEST_KEY, build_trip_columns, column_key, get_generation, \
+    set_generation, store_kiosk_index, load_trip_columns, update_trip_rollups, get_manifest, \
+    add_manifest_chunk, get_trips, store_trip_columns
+from chunk_codec import CHUNK_CODEC, encode_chunk
+
+# Socrata endpoints for the MetroBike trips and kiosks
+TRIPS_URL = "https://data.austintexas.gov/resource/tyfh-5r8s.json"
+KIOSK_URL = "https://data.austintexas.gov/resource/qd73-bsdg.json"
+
+# Number of trips requested from the Socrata API per page
+PAGE_SIZE = 50000
+
+# Number of trips stored per 'chunk <i>' key
+TRIP_CHUNK_SIZE = 100000
+
+# Number of downloaded pages buffered ahead of the Redis writes
+PREFETCH_PAGES = 2
+
+# Seconds between checks of the prefetch thread for a consumer that stopped
+PREFETCH_POLL = 0.1
+
+# checkout_datetime of the newest trip ingested, used by incremental refreshes
+HIGH_WATER_MARK_KEY = 'high_water_mark'
+
+def _get_json(session: requests.Session, url: str, params: dict):
+    """GET a Socrata endpoint and decode the JSON body, raising on HTTP errors."""
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+def iter_trip_pages(url: str, rows: int, page_size: int = PAGE_SIZE) -> Iterator[List[dict]]:
+    """
+    Page through the newest `rows` trips of the Socrata trips endpoint, oldest first.
+
+    The checkout time of the oldest trip to load is found first, then pages
+    are requested in ascending time order with $limit/$offset, so only one
+    page is ever held in memory.
+
+    Args:
+        url (str): Socrata trips endpoint.
+        rows (int): Number of most recent trips to load.
+        page_size (int): Number of trips per request.
+
+    Yields:
+        List[dict]: One page of trip records, sorted by checkout time.
+    """
+    with requests.Session() as session:
+        # checkout time of the rows-th most recent trip
+        cutoff = _get_json(session, url, {
+            '$select': 'checkout_datetime',
+            '$order': 'checkout_datetime DESC',
+            '$limit': 1,
+            '$offset': rows - 1,
+        })
+        if cutoff:
+            where = f"checkout_datetime >= '{cutoff[0]['checkout_datetime']}'"
+            # skip the oldest trips sharing the cutoff time beyond the requested rows
+            total = _get_json(session, url, {'$select': 'count(*) AS total', '$where': where})
+            offset = int(total[0]['total']) - rows
+        else:
+            where, offset = None, 0
+
+        loaded = 0
+        while loaded < rows:
+            params = {
+                '$order': 'checkout_datetime ASC, trip_id ASC',
+                '$limit': min(page_size, rows - loaded),
+                '$offset': offset + loaded,
+            }
+            if where:
+                params['$where'] = where
+            page = _get_json(session, url, params)
+            if not page:
+                break
+            loaded += len(page)
+            logging.debug(f"Fetched {loaded} trips")
+            yield page
+
+def iter_new_trip_pages(url: str, high_water_mark: str, page_size: int = PAGE_SIZE) -> Iterator[List[dict]]:
+    """
+    Page through the trips checked out after `high_water_mark`, oldest first.
+
+    Args:
+        url (str): Socrata trips endpoint.
+        high_water_mark (str): checkout_datetime of the newest trip already loaded.
+        page_size (int): Number of trips per request.
+
+    Yields:
+        List[dict]: One page of trip records, sorted by checkout time.
+    """
+    with requests.Session() as session:
+        loaded = 0
+        while True:
+            page = _get_json(session, url, {
+                '$where': f"checkout_datetime > '{high_water_mark}'",
+                '$order': 'checkout_datetime ASC, trip_id ASC',
+                '$limit': page_size,
+                '$offset': loaded,
+            })
+            if not page:
+                break
+            loaded += len(page)
+            logging.debug(f"Fetched {loaded} new trips")
+            yield page
+
+def prefetch(iterator: Iterator, depth: int = PREFETCH_PAGES) -> Iterator:
+    """
+    Run `iterator` in a background thread, buffering up to `depth` items, so
+    that the next page downloads while the current one is written to Redis.
+    Exceptions raised by `iterator` are re-raised in the consuming thread.
+    If the consumer stops early, the thread fetches no further item and
+    exits within PREFETCH_POLL seconds.
+    """
+    iterator = iter(iterator)
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item) -> bool:
+        # give up once the consumer has stopped, as nothing will read the item
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=PREFETCH_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            while not stop.is_set():
+                if not _put(next(iterator)):
+                    return
+        except StopIteration:
+            pass
+        except Exception as error:
+            if not _put(error):
+                return
+        _put(done)
+
+    threading.Thread(target=_produce, name='prefetch', daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # stop the producer if the consumer stopped early, and drop what it buffered
+        stop.set()
+        while not buffer.empty():
+            buffer.get_nowait()
+
+def write_trip_chunk(trips_db: redis.client.Redis, manifest: dict, trips_data: List[dict], codec: str = None) -> tuple:
+    """
+    Store one chunk of trips as the next 'chunk <i>' key of `manifest`,
+    encoded with `codec` (default chunk_codec.CHUNK_CODEC), append it to the
+    trip columns, and update the manifest and the high-water mark, in a
+    single transaction.
+
+    Returns:
+        tuple: (the updated manifest, number of bytes written)
+    """
+    columns = build_trip_columns(trips_data)
+    codec = codec or CHUNK_CODEC
+    records, raw_nbytes = encode_chunk(trips_data, codec)
+    key = f"chunk {len(manifest['chunks'])}"
+    manifest = add_manifest_chunk(manifest, key, columns, codec, raw_nbytes)
+    pipe = trips_db.pipeline()
+    pipe.set(key, records)
+    pipe.set(MANIFEST_KEY, json.dumps(manifest))
+    pipe.set(HIGH_WATER_MARK_KEY, trips_data[-1]['checkout_datetime'])
+    nbytes = len(records)
+    for name, dtype in TRIP_COLUMNS.items():
+        blob = np.ascontiguousarray(columns[name], dtype=dtype).tobytes()
+        pipe.append(column_key(name), blob)
+        nbytes += len(blob)
+    pipe.execute()
+    return manifest, nbytes
+
+def ingest_trips(trips_db: redis.client.Redis, pages: Iterator[List[dict]], chunk_size: int = TRIP_CHUNK_SIZE,
+                 progress: Callable[[dict], None] = None) -> int:
+    """
+    Write pages of trips, sorted by checkout time, to trips_db in fixed-size chunks.
+
+    Memory use is bounded by one chunk plus the pages held by `pages`, no
+    matter how many trips are loaded. The trips must all be newer than the
+    ones already stored, if any, and are appended after them in the manifest
+    and the trip columns.
+
+    Args:
+        trips_db (redis.client.Redis): Redis connection for trips database.
+        pages (Iterator[List[dict]]): Pages of trip records, e.g. from iter_trip_pages.
+        chunk_size (int): Number of trips per chunk.
+        progress (Callable): Called after every page with a dict of 'rows_fetched',
+            'rows_written', 'chunks_written', 'bytes_written' and 'elapsed_seconds'.
+
+    Returns:
+        int: Number of trips written.
+    """
+    started = time.monotonic()
+    stats = {'rows_fetched': 0, 'rows_written': 0, 'chunks_written': 0, 'bytes_written': 0}
+    manifest = get_manifest(trips_db)
+    if manifest['rows'] and trips_db.exists(*[column_key(name) for name in TRIP_COLUMNS]) < len(TRIP_COLUMNS):
+        # data loaded by an older version, whose columns must be stored before the new trips are appended
+        logging.warning("Trip columns not found, storing them before appending trips.")
+        store_trip_columns(trips_db, build_trip_columns(get_trips(trips_db)))
+
+    def _write(trips_data):
+        nonlocal manifest
+        manifest, nbytes = write_trip_chunk(trips_db, manifest, trips_data)
+        stats['bytes_written'] += nbytes
+        stats['chunks_written'] += 1
+        stats['rows_written'] += len(trips_data)
+
+    def _report():
+        if progress:
+            progress({**stats, 'elapsed_seconds': round(time.monotonic() - started, 3)})
+
+    buffer = []
+    for page in pages:
+        buffer.extend(page)
+        stats['rows_fetched'] += len(page)
+        while len(buffer) >= chunk_size:
+            _write(buffer[:chunk_size])
+            del buffer[:chunk_size]
+        _report()
+    if buffer:
+        _write(buffer)
+        _report()
+    logging.info(f"Wrote {stats['rows_written']} trips to Redis")
+    return stats['rows_written']
+
+def fetch_kiosks(url: str) -> List[dict]:
+    """Download the kiosk records from the Socrata kiosk endpoint."""
+    with requests.Session() as session:
+        return _get_json(session, url, {})
+
+def get_high_water_mark(trips_db: redis.client.Redis) -> Optional[str]:
+    """
+    Return the checkout_datetime of the newest trip loaded, or None if there
+    are no trips. Data loaded by older versions has no stored high-water
+    mark, in which case it is derived from the trip columns.
+    """
+    high_water_mark = trips_db.get(HIGH_WATER_MARK_KEY)
+    if high_water_mark:
+        return high_water_mark.decode()
+    epoch = load_trip_columns(trips_db)['checkout_epoch']
+    if not len(epoch):
+        return None
+    return str(epoch[-1].astype('datetime64[s]')) + '.000'
+
+def _db_index(db: redis.client.Redis) -> int:
+    """Return the Redis database number a connection is bound to."""
+    return int(db.connection_pool.connection_kwargs.get('db', 0))
+
+def swap_dataset(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis,
+                 staging_trips_db: redis.client.Redis, staging_kiosk_db: redis.client.Redis) -> int:
+    """
+    Atomically replace the live trips and kiosk databases with the staging
+    ones using SWAPDB, and give the staged data the next generation. The
+    previous data ends up in the staging databases.
+
+    Returns:
+        int: The generation of the swapped-in dataset.
+    """
+    def _swap(pipe):
+        generation = get_generation(pipe) + 1
+        set_generation(staging_trips_db, generation)
+        pipe.multi()
+        pipe.swapdb(_db_index(trips_db), _db_index(staging_trips_db))
+        pipe.swapdb(_db_index(kiosk_db), _db_index(staging_kiosk_db))
+        return generation
+
+    # retried if the live generation changes before the swap
+    return trips_db.transaction(_swap, GENERATION_KEY, value_from_callable=True)
+
+def load_dataset(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis,
+                 staging_trips_db: redis.client.Redis, staging_kiosk_db: redis.client.Redis,
+                 trips_url: str, kiosk_url: str, rows: int, progress: Callable[[dict], None] = None) -> tuple:
+    """
+    Replace the trips and kiosk data with the newest `rows` trips and the
+    current kiosks.
+
+    The new dataset is written to the staging databases while the current
+    one keeps serving reads, then swapped in atomically (see swap_dataset).
+    A failed request leaves the current data in place. Jobs, the queue and
+    results are not touched.
+
+    Args:
+        trips_db, kiosk_db (redis.client.Redis): Live trips and kiosk databases.
+        staging_trips_db, staging_kiosk_db (redis.client.Redis): Scratch databases to build the new dataset in.
+        trips_url, kiosk_url (str): Socrata endpoints.
+        rows (int): Number of most recent trips to load.
+        progress (Callable): Progress callback, see ingest_trips.
+
+    Raises:
+        requests.RequestException: if a request to the Socrata API fails.
+
+    Returns:
+        tuple: (number of trips, number of kiosks) loaded.
+    """
+    kiosk_data = fetch_kiosks(kiosk_url)
+    staging_trips_db.flushdb()
+    staging_kiosk_db.flushdb()
+    try:
+        n_trips = ingest_trips(staging_trips_db, prefetch(iter_trip_pages(trips_url, rows)), progress=progress)
+        update_trip_rollups(staging_trips_db, load_trip_columns(staging_trips_db))
+        staging_kiosk_db.set('kiosks', json.dumps(kiosk_data))
+        store_kiosk_index(staging_kiosk_db, kiosk_data)
+        generation = swap_dataset(trips_db, kiosk_db, staging_trips_db, staging_kiosk_db)
+        logging.info(f"Swapped in dataset generation {generation}")
+    finally:
+        # drop the previous (or partially loaded) dataset
+        staging_trips_db.flushdb(asynchronous=True)
+        staging_kiosk_db.flushdb(asynchronous=True)
+    return n_trips, len(kiosk_data)
+
+def copy_dataset(source_db: redis.client.Redis, destination_db: redis.client.Redis, batch: int = 1000) -> None:
+    """Copy every key of `source_db` into `destination_db` with COPY, so the data never leaves Redis."""
+    pipe = source_db.pipeline(transaction=False)
+    for i, key in enumerate(source_db.scan_iter(count=batch), 1):
+        pipe.copy(key, key, destination_db=_db_index(destination_db), replace=True)
+        if i % batch == 0:
+            pipe.execute()
+    pipe.execute()
+
+def refresh_dataset(trips_db: redis.client.Redis, kiosk_db: redis.client.Redis,
+                    staging_trips_db: redis.client.Redis, staging_kiosk_db: redis.client.Redis,
+                    trips_url: str, kiosk_url: str, progress: Callable[[dict], None] = None) -> tuple:
+    """
+    Append the trips checked out since the last load as new chunks, and
+    refresh the kiosks and their spatial index.
+
+    Only the new trips are downloaded. They are newer than every stored trip,
+    so the trip columns are extended and stay sorted, and only the new trips
+    are merged into the route index and daily counts. As with load_dataset,
+    this is done on a copy of the trips in the staging databases, swapped in
+    when complete, so reads keep using the previous dataset in the meantime
+    and a failed refresh leaves it untouched.
+
+    Raises:
+        requests.RequestException: if a request to the Socrata API fails.
+
+    Returns:
+        tuple: (number of new trips, number of kiosks) loaded.
+    """
+    kiosk_data = fetch_kiosks(kiosk_url)
+    high_water_mark = get_high_water_mark(trips_db)
+    logging.info(f"Refreshing trips checked out after {high_water_mark}")
+
+    staging_trips_db.flushdb()
+    staging_kiosk_db.flushdb()
+    try:
+        copy_dataset(trips_db, staging_trips_db)
+        n_trips = ingest_trips(staging_trips_db, prefetch(iter_new_trip_pages(trips_url, high_water_mark)),
+                               progress=progress)
+        update_trip_rollups(staging_trips_db, load_trip_columns(staging_trips_db))
+        staging_kiosk_db.set('kiosks', json.dumps(kiosk_data))
+        store_kiosk_index(staging_kiosk_db, kiosk_data)
+        generation = swap_dataset(trips_db, kiosk_db, staging_trips_db, staging_kiosk_db)
+        logging.info(f"Swapped in dataset generation {generation}")
+    finally:
+        # drop the previous (or partially refreshed) dataset
+        staging_trips_db.flushdb(asynchronous=True)
+        staging_kiosk_db.flushdb(asynchronous=True)
+    return n_trips, len(kiosk_data)
@@ -1,10 +1,16 @@
+import hashlib
 import json
+import time
 import uuid
+from collections import Counter
+from datetime import datetime
 import redis
 from hotqueue import HotQueue
 import os
 import logging
 
+from data_lib import get_generation
+
 # Initialize logging
 log_level = os.environ.get("LOG_LEVEL")
 logging.basicConfig(level=log_level)
@@ -12,9 +18,62 @@ logging.basicConfig(level=log_level)
 REDIS_IP = os.environ.get("REDIS_IP")
 trips_db = redis.Redis(host=REDIS_IP, port=6379, db=0)
 kiosk_db = redis.Redis(host=REDIS_IP, port=6379, db=1)
-q = HotQueue("queue", host=REDIS_IP, port=6379, db=2)
+# the queue shares a database with the job records, so a job is saved and queued in one transaction
+q = HotQueue("queue", host=REDIS_IP, port=6379, db=3)
 jdb = redis.Redis(host=REDIS_IP, port=6379, db=3)
 res = redis.Redis(host=REDIS_IP, port=6379, db=4)
+# data load jobs build the new dataset here before swapping it in
+trips_staging_db = redis.Redis(host=REDIS_IP, port=6379, db=5)
+kiosk_staging_db = redis.Redis(host=REDIS_IP, port=6379, db=6)
+
+# Values used for job parameters submitted as 'default', per plot type
+JOB_DEFAULTS = {
+    'trip_duration': {'start_date': '01/31/2023', 'end_date': '01/31/2024', 'kiosk1': '3795', 'kiosk2': '2548',
+                      'format': 'png'},
+    'trips_per_day': {'start_date': '01/31/2023', 'end_date': '01/31/2024', 'lat': '30.2862730619728',
+                      'long': '-97.73937727490916', 'radius': '1', 'format': 'png'},
+}
+
+# Seconds a job is considered in flight for deduplication, in case its worker dies
+INFLIGHT_TTL = int(os.environ.get("JOB_INFLIGHT_TTL", 3600))
+
+# Job record fields stored as JSON, and numeric fields
+_JSON_FIELDS = ['job parameters', 'progress']
+_FLOAT_FIELDS = ['submitted_at', 'started_at', 'finished_at']
+_INT_FIELDS = ['wait_ms', 'duration_ms']
+
+# Statuses after which a job no longer changes
+FINAL_STATUSES = ['complete', 'failed']
+
+# Timestamp recorded when a job enters each status
+_STATUS_TIMESTAMPS = {'in progress': 'started_at', 'complete': 'finished_at', 'failed': 'finished_at'}
+
+# Update fields of an existing job record in one step. ARGV: the current
+# time, the timestamp field to set to it (or ''), then field/value pairs.
+# Setting started_at also records wait_ms since submission, and setting
+# finished_at records duration_ms since the start. Returns 0 if there is no record.
+_update_job = jdb.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local now = tonumber(ARGV[1])
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local since = ({started_at = 'submitted_at', finished_at = 'started_at'})[ARGV[2]]
+if since then
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[1])
+    local start = redis.call('HGET', KEYS[1], since)
+    if start then
+        local field = ARGV[2] == 'started_at' and 'wait_ms' or 'duration_ms'
+        redis.call('HSET', KEYS[1], field, math.floor((now - tonumber(start)) * 1000 + 0.5))
+    end
+end
+return 1
+""")
+
+# Hash in jdb counting memoized results reused, in-flight jobs attached to and jobs computed
+JOB_CACHE_STATS_KEY = 'job_cache_stats'
 
 def _generate_jid()->str:
     """
@@ -31,61 +90,318 @@ def _instantiate_job(jid, status, job_params):
     status, genes, and operation parameters.
     """
     logging.info(f"Instantiating job with ID {jid}...")
-    job_dict = {'id': jid, 'status': status, 'job parameters': job_params}
+    job_dict = {'id': jid, 'status': status, 'job parameters': job_params, 'submitted_at': time.time()}
     logging.info("Job instantiated successfully.")
     return job_dict
 
-def _save_job(jid, job_dict):
-    """Save a job object in the Redis database."""
+def job_record_key(jid):
+    """Key of the hash holding the record of job `jid` in jdb."""
+    return f'job:{jid}'
+
+def job_events_channel(jid):
+    """Pub/sub channel in jdb on which the status changes of job `jid` are published."""
+    return f'job:{jid}:events'
+
+def _encode_job(job_dict):
+    return {name: json.dumps(value) if name in _JSON_FIELDS else value for name, value in job_dict.items()}
+
+def decode_job(fields):
+    """The job record dict stored in the hash fields `fields`, as read with HGETALL."""
+    job_dict = {}
+    for name, value in fields.items():
+        name, value = name.decode(), value.decode()
+        if name in _JSON_FIELDS:
+            value = json.loads(value)
+        elif name in _FLOAT_FIELDS:
+            value = float(value)
+        elif name in _INT_FIELDS:
+            value = int(value)
+        job_dict[name] = value
+    return job_dict
+
+def canonical_job_params(job_params):
+    """
+    Return the canonical form of plot job parameters: 'default' values
+    resolved, dates as zero-padded MM/DD/YYYY, coordinates and radius as
+    floats, the two kiosks of a route in sorted order (route plots don't
+    depend on it) and only the parameters the plot type uses. Jobs with the
+    same canonical parameters produce the same result on the same dataset.
+    Other jobs are returned unchanged.
+    """
+    defaults = JOB_DEFAULTS.get(job_params.get('plot_type'))
+    if job_params.get('job_type') == 'load_data' or defaults is None:
+        return job_params
+    params = {'plot_type': job_params['plot_type']}
+    for name, default in defaults.items():
+        value = job_params.get(name, 'default')
+        value = default if value == 'default' else value
+        if name in ['start_date', 'end_date']:
+            value = datetime.strptime(value, "%m/%d/%Y").strftime("%m/%d/%Y")
+        elif name in ['lat', 'long', 'radius']:
+            value = repr(float(value))
+        params[name] = str(value)
+    if 'kiosk1' in params:
+        params['kiosk1'], params['kiosk2'] = sorted([params['kiosk1'], params['kiosk2']])
+    return params
+
+def job_key(job_params, generation=None):
+    """
+    Content address of a job: a hash of its canonical parameters and the
+    dataset generation (by default the current one), or None for jobs whose
+    results can't be reused (data loads).
+    """
+    if job_params.get('job_type') == 'load_data' or job_params.get('plot_type') not in JOB_DEFAULTS:
+        return None
+    if generation is None:
+        generation = get_generation(trips_db)
+    canonical = json.dumps(canonical_job_params(job_params), sort_keys=True)
+    return hashlib.sha256(f"{generation}:{canonical}".encode()).hexdigest()
+
+def _save_job(jid, job_dict, pipe=None):
+    """Save a job object in the Redis database, as part of `pipe` if given."""
     logging.info(f"Saving job with ID {jid} to the database...")
-    jdb.set(jid, json.dumps(job_dict))
+    (pipe or jdb).hset(job_record_key(jid), mapping=_encode_job(job_dict))
     logging.info("Job saved successfully.")
 
-def _queue_job(jid):
-    """Add a job to the redis queue."""
+def _queue_job(jid, pipe=None):
+    """Add a job to the redis queue, as part of `pipe` if given."""
     logging.info(f"Queueing job with ID {jid}...")
-    q.put(jid)
+    # same as q.put, which can't join a pipeline
+    (pipe or jdb).rpush(q.key, q.serializer.dumps(jid))
     logging.info("Job queued successfully.")
     return
 
 def add_job(job_params, status="submitted"):
-    """Add a job to the redis queue."""
-    logging.info("Adding job to the system...")
-    jid = _generate_jid()
-    job_dict = _instantiate_job(jid, status, job_params)
-    _save_job(jid, job_dict)
-    _queue_job(jid)
-    logging.info("Job added successfully.")
-    return job_dict
+    """
+    Add a job to the redis queue.
+
+    Plot jobs are deduplicated by job_key: if the same job already finished
+    on the current dataset, or is queued or running, the new job is attached
+    to it instead of being queued, and reports its status and results.
+    """
+    return add_jobs([job_params], status)[0]
+
+def add_jobs(jobs_params, status="submitted"):
+    """
+    Add many jobs to the redis queue, deduplicated as in add_job, with a
+    fixed number of round trips to Redis however many jobs there are.
+    Identical jobs within `jobs_params` are attached to the first of them.
+    Jobs with {'profile': True} are never deduplicated, so they always run
+    and are profiled. Returns the job dictionaries in order.
+    """
+    logging.info(f"Adding {len(jobs_params)} jobs to the system...")
+    generation = get_generation(trips_db)
+    job_dicts = []
+    for job_params in jobs_params:
+        profile = job_params.get('profile') is True
+        job_params = canonical_job_params(job_params)
+        if profile:
+            job_params = {**job_params, 'profile': True}
+        job_dict = _instantiate_job(_generate_jid(), status, job_params)
+        key = None if profile else job_key(job_params, generation)
+        if key is not None:
+            job_dict['key'] = key
+        job_dicts.append(job_dict)
+
+    # reuse finished results, else attach to identical jobs in flight
+    keyed = [job_dict for job_dict in job_dicts if 'key' in job_dict]
+    memos = res.mget([f"memo:{job_dict['key']}" for job_dict in keyed]) if keyed else []
+    pipe = jdb.pipeline(transaction=False)
+    for job_dict, memo in zip(keyed, memos):
+        if memo is None:
+            # claim the key, then read who holds it: this job if the claim succeeded
+            pipe.set(f"inflight:{job_dict['key']}", job_dict['id'], nx=True, ex=INFLIGHT_TTL)
+            pipe.get(f"inflight:{job_dict['key']}")
+    holders = iter(pipe.execute()[1::2])
+    stats = Counter()
+    for job_dict, memo in zip(keyed, memos):
+        primary = (memo or next(holders)).decode()
+        if memo is not None:
+            stats['hits'] += 1
+        elif primary == job_dict['id']:
+            stats['misses'] += 1
+            continue
+        else:
+            stats['attached'] += 1
+        job_dict['attached to'] = primary
+        logging.info(f"Job {job_dict['id']} attached to job {primary} with the same parameters.")
+
+    # save and queue (or attach) the jobs in one transaction
+    attached = [job_dict for job_dict in job_dicts if 'attached to' in job_dict]
+    pipe = jdb.pipeline(transaction=True)
+    for job_dict in job_dicts:
+        _save_job(job_dict['id'], job_dict, pipe)
+        if 'attached to' not in job_dict:
+            _queue_job(job_dict['id'], pipe)
+    for stat, count in stats.items():
+        pipe.hincrby(JOB_CACHE_STATS_KEY, stat, count)
+    for job_dict in attached:
+        pipe.hget(job_record_key(job_dict['attached to']), 'status')
+    replies = pipe.execute(raise_on_error=False)
+
+    # attached jobs report the status of the job they are attached to
+    for job_dict, primary_status in zip(attached, replies[len(replies) - len(attached):]):
+        if isinstance(primary_status, bytes):
+            job_dict['status'] = primary_status.decode()
+        else:
+            # records written before jobs were stored as hashes
+            job_dict.update(get_job_by_id(job_dict['id']))
+    logging.info("Jobs added successfully.")
+    return job_dicts
+
+def get_job_cache_stats():
+    """Return the number of jobs served from memoized results, attached to in-flight jobs and computed."""
+    stats = {name.decode(): int(count) for name, count in jdb.hgetall(JOB_CACHE_STATS_KEY).items()}
+    return {name: stats.get(name, 0) for name in ['hits', 'attached', 'misses']}
 
 def get_job_by_id(jid):
-    """Return job dictionary given jid"""
+    """
+    Return job dictionary given jid. Jobs attached to another job report
+    that job's status and progress.
+    """
     logging.info(f"Retrieving job with ID {jid}...")
-    job_json = jdb.get(jid)
-    if job_json:
-        job_dict = json.loads(job_json)
+    fields = jdb.hgetall(job_record_key(jid))
+    if fields:
+        job_dict = decode_job(fields)
+        if 'attached to' in job_dict:
+            primary = get_job_by_id(job_dict['attached to'])
+            if isinstance(primary, dict):
+                job_dict.update({name: primary[name] for name in ['status', 'progress'] if name in primary})
         logging.info("Job retrieved successfully.")
         return job_dict
-    else:
-        logging.error(f"No job found with ID {jid}.")
-        return f"No job found with ID {jid}."
+    # records written before jobs were stored as hashes
+    job_json = jdb.get(jid)
+    if job_json:
+        return json.loads(job_json)
+    logging.error(f"No job found with ID {jid}.")
+    return f"No job found with ID {jid}."
 
-def update_job_status(jid, status):
-    """Update the status of job with job id `jid` to status `status`."""
-    job_dict = get_job_by_id(jid)
-    if job_dict:
-        logging.info(f"Updating job status for job ID {jid} to '{status}'")
-        job_dict['status'] = status
-        _save_job(jid, job_dict)
-        logging.info(f"Job status updated successfully.")
-    else:
+def get_jobs_by_ids(jids):
+    """
+    Return the job dictionaries of many jobs, like get_job_by_id, with two
+    round trips to Redis.
+    """
+    pipe = jdb.pipeline(transaction=False)
+    for jid in jids:
+        pipe.hgetall(job_record_key(jid))
+    job_dicts = [decode_job(fields) if fields else get_job_by_id(jid) for jid, fields in zip(jids, pipe.execute())]
+    attached = [job_dict for job_dict in job_dicts if isinstance(job_dict, dict) and 'attached to' in job_dict]
+    for job_dict in attached:
+        pipe.hmget(job_record_key(job_dict['attached to']), ['status', 'progress'])
+    for job_dict, (status, progress) in zip(attached, pipe.execute() if attached else []):
+        if status is None:
+            job_dict.update(get_job_by_id(job_dict['id']))
+            continue
+        job_dict['status'] = status.decode()
+        if progress is not None:
+            job_dict['progress'] = json.loads(progress)
+    return job_dicts
+
+def _update_job_fields(jid, fields, timestamp=''):
+    """Set `fields` of job `jid`, and the `timestamp` field to now if given, in one round trip."""
+    args = [time.time(), timestamp]
+    for name, value in _encode_job(fields).items():
+        args.extend([name, value])
+    if not _update_job(keys=[job_record_key(jid)], args=args):
         logging.error(f"Job with ID {jid} not found.")
         raise Exception("Job not found")
-    
+
+def update_job_status(jid, status):
+    """
+    Update the status of job with job id `jid` to status `status`. Starting
+    a job records started_at and wait_ms, finishing it finished_at and duration_ms.
+    """
+    logging.info(f"Updating job status for job ID {jid} to '{status}'")
+    _update_job_fields(jid, {'status': status}, _STATUS_TIMESTAMPS.get(status, ''))
+    # wake up clients waiting on the job, see watch_job
+    jdb.publish(job_events_channel(jid), status)
+    logging.info(f"Job status updated successfully.")
+
+def update_job_progress(jid, progress):
+    """Record the progress dict of a running job with job id `jid`."""
+    _update_job_fields(jid, {'progress': progress})
+
+def watch_job(jid, timeout, heartbeat=None):
+    """
+    Follow the status of job `jid` without polling.
+
+    Yields the job dictionary once straight away and again after every
+    status change, until the job is complete or failed or `timeout` seconds
+    have passed. If `heartbeat` is given, None is yielded whenever that many
+    seconds pass without a change. Yields the error message of get_job_by_id
+    if there is no such job.
+    """
+    job_dict = get_job_by_id(jid)
+    if not isinstance(job_dict, dict) or job_dict['status'] in FINAL_STATUSES:
+        yield job_dict
+        return
+    deadline = time.monotonic() + timeout
+    pubsub = jdb.pubsub(ignore_subscribe_messages=True)
+    try:
+        # attached jobs take the status of the job they are attached to
+        pubsub.subscribe(job_events_channel(job_dict.get('attached to', jid)))
+        # read the job again, it may have changed before the subscription started
+        job_dict = get_job_by_id(jid)
+        yield job_dict
+        last_yield = time.monotonic()
+        while job_dict['status'] not in FINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if pubsub.get_message(timeout=min(remaining, heartbeat or remaining)) is not None:
+                job_dict = get_job_by_id(jid)
+                yield job_dict
+            elif heartbeat is not None and time.monotonic() - last_yield >= heartbeat:
+                yield None
+            else:
+                # e.g. the subscription confirmation
+                continue
+            last_yield = time.monotonic()
+    finally:
+        pubsub.close()
+
+def wait_for_job(jid, timeout):
+    """
+    Block until job `jid` is complete or failed, for at most `timeout`
+    seconds, and return its job dictionary.
+    """
+    for job_dict in watch_job(jid, timeout):
+        pass
+    return job_dict
+
+def finish_job(jid, status):
+    """
+    Set the final status of job `jid`. A complete job's result becomes the
+    memoized result for its key, and the key is no longer in flight.
+    """
+    update_job_status(jid, status)
+    key = jdb.hget(job_record_key(jid), 'key')
+    if key is not None:
+        key = key.decode()
+        if status == 'complete':
+            res.set(f'memo:{key}', jid)
+        # only clear the in-flight marker if it is still this job's
+        if jdb.get(f'inflight:{key}') == jid.encode():
+            jdb.delete(f'inflight:{key}')
+
 def store_job_result(jid, result_data):
     '''Store job results in the results database'''
     res.set(jid, result_data)
 
 def get_results_by_id(jid):
-    '''Returns the job result for a given job id'''
-    return res.get(jid)
\ No newline at end of file
+    '''Returns the job result for a given job id, following jobs attached to another job'''
+    job_dict = get_job_by_id(jid)
+    if isinstance(job_dict, dict) and 'attached to' in job_dict:
+        jid = job_dict['attached to']
+    return res.get(jid)
+
+def get_results_by_ids(jids):
+    """
+    Return the job dictionaries and results of many jobs, with one MGET for
+    the results. The result is None for jobs that are not complete.
+    """
+    job_dicts = get_jobs_by_ids(jids)
+    complete = [job_dict for job_dict in job_dicts if isinstance(job_dict, dict) and job_dict['status'] == 'complete']
+    results = dict(zip([job_dict['id'] for job_dict in complete],
+                       res.mget([job_dict.get('attached to', job_dict['id']) for job_dict in complete]) if complete else []))
+    return [(job_dict, results.get(jid)) for jid, job_dict in zip(jids, job_dicts)]
\ No newline at end of file
@@ -0,0 +1,230 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+# Upper bounds of the duration histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+_BUCKET_BOUND = re.compile(r'(?:^|,)le="([^"]*)"$')
+
+def _sample_order(sample: str) -> tuple:
+    # by label set, then _bucket samples by increasing bound before _count and _sum
+    name, _, labels = sample.partition('{')
+    labels = labels.rstrip('}')
+    bound = _BUCKET_BOUND.search(labels)
+    if bound is None:
+        return labels, name, 0.0
+    return labels[:bound.start()], name, float(bound.group(1))
+
+class Metric:
+    """
+    A metric in the Prometheus text exposition format: a name, help text,
+    label names and a value per combination of label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {} # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Dict[str, float]:
+        """Current value of every sample, by sample name with labels, e.g. 'x_total{stage="fetch"}'."""
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def take(self) -> dict:
+        """Reset the metric and return its values, to be merged into the same metric in another process."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict) -> None:
+        """Add values returned by take."""
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = value if key not in self._values else self._merge(self._values[key], value)
+
+    def _merge(self, current, value):
+        raise NotImplementedError
+
+class Counter(Metric):
+    """A total that only goes up, e.g. rows processed."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _merge(self, current: float, value: float) -> float:
+        return current + value
+
+    def samples(self) -> Dict[str, float]:
+        with self._lock:
+            return {self.name + _format_labels(dict(zip(self.labelnames, key))): value
+                    for key, value in self._values.items()}
+
+class Histogram(Metric):
+    """The distribution of observed values, e.g. durations, in cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2)) # buckets, +Inf, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def _merge(self, current: list, value: list) -> list:
+        return [a + b for a, b in zip(current, value)]
+
+    def samples(self) -> Dict[str, float]:
+        samples = {}
+        with self._lock:
+            for key, counts in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                for bound, count in zip([*map(_format_value, self.buckets), '+Inf'], counts):
+                    samples[f'{self.name}_bucket{_format_labels({**labels, "le": bound})}'] = count
+                samples[f'{self.name}_count{_format_labels(labels)}'] = counts[-2]
+                samples[f'{self.name}_sum{_format_labels(labels)}'] = counts[-1]
+        return samples
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. queue depth, set when it is read."""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _merge(self, current: float, value: float) -> float:
+        return value
+
+    def samples(self) -> Dict[str, float]:
+        with self._lock:
+            return {self.name + _format_labels(dict(zip(self.labelnames, key))): value
+                    for key, value in self._values.items()}
+
+def _add_labels(sample: str, labels: dict) -> str:
+    if not labels:
+        return sample
+    name, brace, rest = sample.partition('{')
+    extra = _format_labels(labels)[1:-1]
+    return f'{name}{{{extra},{rest}' if brace else f'{name}{{{extra}}}'
+
+def render(metrics: List[Metric], sources: list = None) -> str:
+    """
+    Format metrics in the Prometheus text exposition format (version 0.0.4).
+
+    Args:
+        metrics (List[Metric]): Metrics to include.
+        sources (list): Where to take the samples from, as (extra labels, samples by
+            metric name) pairs, where None stands for the metrics' own samples,
+            e.g. [({'component': 'api'}, None), ({'component': 'worker'}, pull(...))].
+            By default, the metrics' own samples without extra labels.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, samples in sources or [({}, None)]:
+            metric_samples = metric.samples() if samples is None else samples.get(metric.name, {})
+            lines.extend(f'{_add_labels(sample, labels)} {_format_value(value)}'
+                         for sample, value in sorted(metric_samples.items(), key=lambda item: _sample_order(item[0])))
+    return '\n'.join(lines) + '\n'
+
+def push(db, prefix: str, metrics: List[Metric]) -> None:
+    """
+    Add the samples of counters and histograms to the totals kept in Redis,
+    one hash per metric at '<prefix>:<metric name>', and reset them, so that
+    several processes can aggregate their metrics. One round trip.
+    """
+    pipe = db.pipeline(transaction=False)
+    for metric in metrics:
+        for sample, value in metric.samples().items():
+            if value:
+                pipe.hincrbyfloat(f'{prefix}:{metric.name}', sample, value)
+        metric.reset()
+    pipe.execute()
+
+def pull(db, prefix: str, metrics: List[Metric]) -> Dict[str, Dict[str, float]]:
+    """The totals written by push, by metric name, for render."""
+    pipe = db.pipeline(transaction=False)
+    for metric in metrics:
+        pipe.hgetall(f'{prefix}:{metric.name}')
+    return {metric.name: {sample.decode(): float(value) for sample, value in totals.items()}
+            for metric, totals in zip(metrics, pipe.execute())}
+
+# Metrics of the code shared by the API and the worker. Stages are the steps
+# of the hot paths, e.g. fetching from Redis, decoding, filtering or plotting.
+STAGE_SECONDS = Histogram('metrobike_stage_seconds', 'Time spent in each stage of request and job handling.', ('stage',))
+STAGE_ROWS = Counter('metrobike_stage_rows_total', 'Rows (trips or kiosks) output by each stage.', ('stage',))
+STAGE_BYTES = Counter('metrobike_stage_bytes_total', 'Bytes read from Redis or produced by each stage.', ('stage',))
+STAGE_METRICS = [STAGE_SECONDS, STAGE_ROWS, STAGE_BYTES]
+
+# Metrics of the worker, pushed to Redis by every worker process after each
+# job under WORKER_METRICS_PREFIX and exposed by the API's /metrics
+JOB_SECONDS = Histogram('metrobike_job_seconds', 'Time to run a job, by job type and final status.', ('job_type', 'status'))
+JOB_WAIT_SECONDS = Histogram('metrobike_job_wait_seconds', 'Time jobs waited in the queue before a worker started them.', ('job_type',))
+WORKER_METRICS = STAGE_METRICS + [JOB_SECONDS, JOB_WAIT_SECONDS]
+WORKER_METRICS_PREFIX = 'metrics:worker'
+
+class _Stage:
+    """Rows and bytes of a timed stage, set by the code being timed."""
+    __slots__ = ['rows', 'nbytes']
+
+    def __init__(self):
+        self.rows = None
+        self.nbytes = None
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a stage of the hot path into STAGE_SECONDS. The rows and bytes it
+    handled can be recorded by setting `rows` and `nbytes` on the object
+    yielded.
+
+        with metrics.stage('redis_fetch') as s:
+            blob = trips_db.get(key)
+            s.nbytes = len(blob)
+    """
+    recorded = _Stage()
+    started = time.perf_counter()
+    try:
+        yield recorded
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+        if recorded.rows is not None:
+            STAGE_ROWS.inc(recorded.rows, stage=name)
+        if recorded.nbytes is not None:
+            STAGE_BYTES.inc(recorded.nbytes, stage=name)
@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import threading
+from datetime import datetime
+from typing import Callable, List
+import numpy as np
+import redis
+
+from chunk_codec import decode_chunk
+from data_lib import filter_by_date, filter_by_location, get_manifest, cached_manifest, cached_trip_records, \
+    get_generation, to_epoch, dataset_cache
+import metrics
+
+# Processes fetching and decoding trip chunks in parallel, 1 to always run serially
+PARALLEL_PROCESSES = int(os.environ.get("PARALLEL_PROCESSES", os.cpu_count() or 1))
+
+# Fewest trips in the chunks of a query for it to run on the process pool;
+# smaller queries run serially, as sending the work to the pool would cost more
+PARALLEL_MIN_ROWS = int(os.environ.get("PARALLEL_MIN_ROWS", 200000))
+
+# Most queries running on the process pool at once; others wait for their turn
+PARALLEL_QUERIES = int(os.environ.get("PARALLEL_QUERIES", 2))
+
+# Started by start_pool, and in the pool processes, the connection they read chunks with
+_pool = None
+_pool_trips_db = None
+_pool_slots = threading.BoundedSemaphore(PARALLEL_QUERIES)
+_trips_db = None
+
+def _init_process(trips_db: redis.client.Redis):
+    global _trips_db
+    _trips_db = trips_db
+    # samples inherited from the parent would be counted twice
+    for metric in metrics.STAGE_METRICS:
+        metric.reset()
+
+def start_pool(trips_db: redis.client.Redis, processes: int = None) -> None:
+    """
+    Start the pool of `processes` processes (default PARALLEL_PROCESSES)
+    that map_chunks runs large queries on, reading from `trips_db`. No pool
+    is started for a single process.
+
+    The processes are forked, so call this at startup, before any other
+    thread is started: a lock held by another thread at that point, e.g. in
+    redis-py or the metrics, would stay locked in the processes.
+    """
+    global _pool, _pool_trips_db
+    stop_pool()
+    processes = PARALLEL_PROCESSES if processes is None else processes
+    if processes > 1:
+        _pool = multiprocessing.get_context('fork').Pool(processes, _init_process, (trips_db,))
+        _pool_trips_db = trips_db
+
+def stop_pool() -> None:
+    """Stop the pool started by start_pool, if any."""
+    global _pool, _pool_trips_db
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = _pool_trips_db = None
+
+def _run_chunk(task: tuple):
+    key, function, args = task
+    result = function(decode_chunk(_trips_db.get(key)), *args)
+    # sent back with the result, as this process doesn't serve /metrics
+    return result, [metric.take() for metric in metrics.STAGE_METRICS]
+
+def _use_pool(trips_db: redis.client.Redis, rows: int) -> bool:
+    return _pool is not None and trips_db is _pool_trips_db and rows >= PARALLEL_MIN_ROWS
+
+def map_chunks(trips_db: redis.client.Redis, tasks: List[tuple], function: Callable) -> list:
+    """
+    Apply `function(trips_data, *args)` to the decoded records of each trip
+    chunk, for `tasks` given as (manifest chunk entry, args) pairs, and return
+    the results in the order of `tasks`.
+
+    When the pool of start_pool reads from `trips_db` and the chunks hold at
+    least PARALLEL_MIN_ROWS trips, each chunk is fetched, decoded and
+    processed by one of its processes, which only send back the result, and
+    at most PARALLEL_QUERIES calls use the pool at once. Otherwise the
+    chunks are processed here, one after another. `function` must be
+    defined at the top level of a module, so it can be sent to the pool.
+    """
+    with metrics.stage('chunk_map') as stage:
+        stage.rows = sum(chunk['rows'] for chunk, _ in tasks)
+        if not _use_pool(trips_db, stage.rows):
+            blobs = trips_db.mget([chunk['key'] for chunk, _ in tasks]) if tasks else []
+            return [function(decode_chunk(blob), *args) for blob, (_, args) in zip(blobs, tasks)]
+
+        with _pool_slots:
+            outputs = _pool.map(_run_chunk, [(chunk['key'], function, args) for chunk, args in tasks], chunksize=1)
+        for _, values in outputs:
+            for metric, metric_values in zip(metrics.STAGE_METRICS, values):
+                metric.merge(metric_values)
+        return [result for result, _ in outputs]
+
+def _filter_chunk(trips_data: List[dict], start_datetime: datetime, end_datetime: datetime,
+                  kiosk_data: List[dict], coordinates: tuple, radius: float) -> List[dict]:
+    trips_data = filter_by_date(trips_data, start_datetime, end_datetime)
+    if coordinates is not None:
+        trips_data = filter_by_location(trips_data, kiosk_data, coordinates, radius)
+    return trips_data
+
+def filter_trips(trips_db: redis.client.Redis, start_datetime: datetime, end_datetime: datetime,
+                 kiosk_data: List[dict] = None, coordinates: tuple = None, radius: float = None) -> List[dict]:
+    '''
+    The trips checked out within [start_datetime, end_datetime], and if
+    `coordinates` are given, whose kiosks are within `radius` km of them, in
+    the order of get_trips(). Same as filter_by_date and filter_by_location
+    on get_trips(), but chunk by chunk, in parallel for large datasets (see
+    map_chunks). Chunks outside the date range are not read.
+    '''
+    chunks = [chunk for chunk in get_manifest(trips_db)['chunks']
+              if chunk['max_epoch'] >= to_epoch(start_datetime) and chunk['min_epoch'] <= to_epoch(end_datetime)]
+    args = (start_datetime, end_datetime, kiosk_data, coordinates, radius)
+    results = map_chunks(trips_db, [(chunk, args) for chunk in chunks], _filter_chunk)
+    return [trip for trips_data in results for trip in trips_data]
+
+def _select_rows(trips_data: List[dict], rows: np.ndarray) -> List[dict]:
+    return [trips_data[row] for row in rows]
+
+def trip_records(trips_db: redis.client.Redis, rows: np.ndarray) -> List[dict]:
+    """
+    The trip records at positions `rows` of get_trips(), as
+    cached_trip_records. When the chunks holding them that are not in the
+    dataset cache have at least PARALLEL_MIN_ROWS trips, those chunks are
+    read on the process pool (see map_chunks), which only sends back the
+    records asked for; the chunks are then not cached. The records must not
+    be modified.
+    """
+    chunks = cached_manifest(trips_db)['chunks']
+    starts = np.cumsum([0] + [chunk['rows'] for chunk in chunks])
+    chunk_of = np.searchsorted(starts, rows, side='right') - 1
+    needed = np.unique(chunk_of)
+    if not _use_pool(trips_db, sum(chunks[i]['rows'] for i in needed)):
+        return cached_trip_records(trips_db, rows)
+
+    generation = get_generation(trips_db)
+    cached, missing = {}, []
+    for i in needed:
+        found, records = dataset_cache.lookup(generation, f"chunk:{chunks[i]['key']}")
+        if found:
+            cached[i] = records
+        else:
+            missing.append(i)
+    if not _use_pool(trips_db, sum(chunks[i]['rows'] for i in missing)):
+        return cached_trip_records(trips_db, rows)
+
+    tasks = [(chunks[i], (rows[chunk_of == i] - starts[i],)) for i in missing]
+    selected = {i: iter(records) for i, records in zip(missing, map_chunks(trips_db, tasks, _select_rows))}
+    return [next(selected[i]) if i in selected else cached[i][row - starts[i]] for i, row in zip(chunk_of, rows)]
@@ -0,0 +1,49 @@
+import cProfile
+import io
+import marshal
+import os
+import pstats
+from contextlib import contextmanager
+
+import redis
+
+# Seconds profiles are kept in Redis
+PROFILE_TTL = int(os.environ.get("PROFILE_TTL", 7 * 86400))
+
+def profile_key(pid: str) -> str:
+    """Key of a profile in the results database, next to the result of job `pid`."""
+    return f'profile:{pid}'
+
+def start() -> cProfile.Profile:
+    """Start profiling the calling thread."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop(db: redis.client.Redis, pid: str, profiler: cProfile.Profile) -> None:
+    """Stop `profiler` and store its stats under `pid`, in the pstats file format."""
+    profiler.disable()
+    profiler.create_stats()
+    db.set(profile_key(pid), marshal.dumps(profiler.stats), ex=PROFILE_TTL)
+
+@contextmanager
+def profiled(db: redis.client.Redis, pid: str):
+    """Profile the body of the with statement and store the stats under `pid`."""
+    profiler = start()
+    try:
+        yield
+    finally:
+        stop(db, pid, profiler)
+
+def get_profile(db: redis.client.Redis, pid: str) -> bytes:
+    """The stored profile of `pid` in the pstats file format, or None."""
+    return db.get(profile_key(pid))
+
+def profile_report(blob: bytes, sort: str = 'cumulative', limit: int = 50) -> str:
+    """Text report of a stored profile: the `limit` functions with the most `sort` time."""
+    buf = io.StringIO()
+    stats = pstats.Stats(stream=buf)
+    stats.stats = marshal.loads(blob)
+    stats.get_top_level_stats()
+    stats.sort_stats(sort).print_stats(limit)
+    return buf.getvalue()
@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import os
+from dataclasses import dataclass
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import metrics
+
+# Output formats of job results and their MIME types
+FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+
+# Size of rendered plots, in inches and dots per inch
+FIGURE_WIDTH = float(os.environ.get("PLOT_WIDTH", 15))
+FIGURE_HEIGHT = float(os.environ.get("PLOT_HEIGHT", 8))
+FIGURE_DPI = float(os.environ.get("PLOT_DPI", 100))
+
+@dataclass
+class Plot:
+    """
+    Data and labels of a job's plot, independent of the output format.
+
+    For a 'hist' plot, `x` holds the bin edges and `y` the count of each bin
+    (one fewer than the edges). For a 'line' plot, `x` and `y` are the points.
+    """
+    kind: str
+    x: np.ndarray
+    y: np.ndarray
+    title: str
+    xlabel: str
+    ylabel: str
+
+class Renderer:
+    """
+    Renders plots with the object-oriented Agg API, without pyplot.
+
+    One figure and canvas are created up front and cleared between plots,
+    so rendering any number of jobs doesn't accumulate figures. A Renderer
+    is not thread-safe; the worker processes each have their own.
+    """
+
+    def __init__(self, width: float = FIGURE_WIDTH, height: float = FIGURE_HEIGHT, dpi: float = FIGURE_DPI):
+        self.figure = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+
+    def render(self, plot: Plot, format: str = 'png') -> bytes:
+        """
+        Render `plot` in one of FORMATS. 'json' and 'csv' return the data
+        series directly and skip drawing entirely.
+        """
+        with metrics.stage(f'render_{format}') as stage:
+            output = self._render(plot, format)
+            stage.rows = len(plot.y)
+            stage.nbytes = len(output)
+        return output
+
+    def _render(self, plot: Plot, format: str) -> bytes:
+        if format == 'json':
+            return _to_json(plot)
+        if format == 'csv':
+            return _to_csv(plot)
+        if format not in FORMATS:
+            raise ValueError(f"Invalid format: Must be one of {list(FORMATS)}")
+
+        self.figure.clear()
+        axes = self.figure.add_subplot()
+        if plot.kind == 'hist':
+            axes.hist(plot.x[:-1], bins=plot.x, weights=plot.y)
+        else:
+            axes.plot(plot.x, plot.y)
+        axes.set_xlabel(plot.xlabel)
+        axes.set_ylabel(plot.ylabel)
+        axes.set_title(plot.title)
+        self.figure.tight_layout()
+
+        buf = io.BytesIO()
+        self.figure.savefig(buf, format=format)
+        return buf.getvalue()
+
+def _series(values: np.ndarray) -> list:
+    # dates as ISO strings, numbers as Python scalars
+    if np.issubdtype(values.dtype, np.datetime64):
+        return [str(value) for value in values]
+    return values.tolist()
+
+def _to_json(plot: Plot) -> bytes:
+    data = {'title': plot.title, 'xlabel': plot.xlabel, 'ylabel': plot.ylabel}
+    if plot.kind == 'hist':
+        data.update({'bin_edges': _series(plot.x), 'counts': _series(plot.y)})
+    else:
+        data.update({'x': _series(plot.x), 'y': _series(plot.y)})
+    return json.dumps(data).encode()
+
+def _to_csv(plot: Plot) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if plot.kind == 'hist':
+        edges = _series(plot.x)
+        writer.writerow([f'{plot.xlabel} from', f'{plot.xlabel} to', plot.ylabel])
+        writer.writerows(zip(edges[:-1], edges[1:], _series(plot.y)))
+    else:
+        writer.writerow([plot.xlabel, plot.ylabel])
+        writer.writerows(zip(_series(plot.x), _series(plot.y)))
+    return buf.getvalue().encode()
@@ -0,0 +1,233 @@
+import struct
+import numpy as np
+
+# Serialization header: magic, number of trips covered, number of routes, number of indexed trips
+_HEADER = struct.Struct('<4sQII')
+_MAGIC = b'RTX1'
+
+def route_keys(kiosk_ids1: np.ndarray, kiosk_ids2: np.ndarray) -> np.ndarray:
+    """Key of the unordered pair of kiosks of each trip, the same in both directions."""
+    lo = np.minimum(kiosk_ids1, kiosk_ids2).astype(np.int64)
+    hi = np.maximum(kiosk_ids1, kiosk_ids2).astype(np.int64)
+    return (lo << 32) | hi
+
+class RouteIndex:
+    """
+    Trips grouped by route, the unordered pair of their checkout and return
+    kiosks.
+
+    The index is stored in compressed sparse row form: `routes` holds the
+    sorted route keys, and the trips of routes[i] are the entries
+    offsets[i]:offsets[i + 1] of the `epochs`, `durations` and `checkout_ids`
+    arrays, in checkout time order. Looking up a route is a binary search,
+    and a date range within it is two more.
+
+    Trips with a missing kiosk id are not indexed.
+    """
+
+    def __init__(self, routes: np.ndarray, offsets: np.ndarray, epochs: np.ndarray, durations: np.ndarray,
+                 checkout_ids: np.ndarray, n_trips: int):
+        self.routes = routes
+        self.offsets = offsets
+        self.epochs = epochs
+        self.durations = durations
+        self.checkout_ids = checkout_ids
+        # number of rows of the trip columns covered, indexed or not
+        self.n_trips = n_trips
+
+    @classmethod
+    def build(cls, columns: dict, missing_id: int = -1) -> 'RouteIndex':
+        """
+        Build the index from trip columns sorted by checkout time (see
+        data_lib.load_trip_columns).
+        """
+        checkout_ids, return_ids = columns['checkout_kiosk_id'], columns['return_kiosk_id']
+        indexed = np.flatnonzero((checkout_ids != missing_id) & (return_ids != missing_id))
+        keys = route_keys(checkout_ids[indexed], return_ids[indexed])
+        # stable, so each route keeps checkout time order
+        order = np.argsort(keys, kind='stable')
+        keys, order = keys[order], indexed[order]
+        return cls._from_sorted(keys, columns['checkout_epoch'][order], columns['duration_minutes'][order],
+                                checkout_ids[order], len(checkout_ids))
+
+    @classmethod
+    def _from_sorted(cls, keys, epochs, durations, checkout_ids, n_trips) -> 'RouteIndex':
+        routes, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+        return cls(routes, offsets, np.ascontiguousarray(epochs, dtype=np.int64),
+                   np.ascontiguousarray(durations, dtype=np.int32),
+                   np.ascontiguousarray(checkout_ids, dtype=np.int32), n_trips)
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def extend(self, columns: dict, missing_id: int = -1) -> 'RouteIndex':
+        """
+        Return a new index that also covers `columns`, trips that are all
+        newer than the ones already indexed, e.g. the rows appended by an
+        incremental refresh.
+        """
+        new = RouteIndex.build(columns, missing_id)
+        keys = np.concatenate([np.repeat(self.routes, np.diff(self.offsets)), np.repeat(new.routes, np.diff(new.offsets))])
+        # stable, so the old trips of each route stay ahead of the newer ones
+        order = np.argsort(keys, kind='stable')
+        return RouteIndex._from_sorted(keys[order], np.concatenate([self.epochs, new.epochs])[order],
+                                       np.concatenate([self.durations, new.durations])[order],
+                                       np.concatenate([self.checkout_ids, new.checkout_ids])[order],
+                                       self.n_trips + new.n_trips)
+
+    def route(self, kiosk_id1: int, kiosk_id2: int, start_epoch: int = None, end_epoch: int = None) -> slice:
+        """
+        Find the trips between two kiosks, in either direction.
+
+        Args:
+            kiosk_id1, kiosk_id2 (int): Integer kiosk ids, see data_lib.parse_kiosk_ids.
+            start_epoch, end_epoch (int): Optional inclusive range of checkout times, in seconds since the Unix epoch.
+
+        Returns:
+            slice: The matching entries of `epochs`, `durations` and `checkout_ids`.
+        """
+        key = route_keys(np.array([kiosk_id1]), np.array([kiosk_id2]))[0]
+        i = int(np.searchsorted(self.routes, key))
+        if i == len(self.routes) or self.routes[i] != key:
+            return slice(0, 0)
+        lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+        epochs = self.epochs[lo:hi]
+        start = lo + int(np.searchsorted(epochs, start_epoch, side='left')) if start_epoch is not None else lo
+        stop = lo + int(np.searchsorted(epochs, end_epoch, side='right')) if end_epoch is not None else hi
+        return slice(start, max(start, stop))
+
+    def nbytes(self) -> int:
+        """Total size of the index arrays, for the dataset cache."""
+        return sum(array.nbytes for array in [self.routes, self.offsets, self.epochs, self.durations, self.checkout_ids])
+
+    def to_bytes(self) -> bytes:
+        """Serialize the index so it can be stored in Redis next to the trip columns."""
+        arrays = [self.routes, self.offsets, self.epochs, self.durations, self.checkout_ids]
+        return _HEADER.pack(_MAGIC, self.n_trips, len(self.routes), len(self)) + b''.join(array.tobytes() for array in arrays)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'RouteIndex':
+        """Load an index written by to_bytes without copying the arrays."""
+        magic, n_trips, n_routes, n = _HEADER.unpack_from(blob)
+        if magic != _MAGIC:
+            raise ValueError("Not a serialized RouteIndex")
+        arrays, offset = [], _HEADER.size
+        for dtype, count in [('<i8', n_routes), ('<i8', n_routes + 1), ('<i8', n), ('<i4', n), ('<i4', n)]:
+            array = np.frombuffer(blob, dtype=dtype, count=count, offset=offset)
+            arrays.append(array)
+            offset += array.nbytes
+        return cls(*arrays, n_trips)
+
+# Serialization header: magic, number of trips covered, number of (day, route) entries
+_COUNTS_HEADER = struct.Struct('<4sQI')
+_COUNTS_MAGIC = b'RDC1'
+
+class DailyRouteCounts:
+    """
+    Number of trips per route and checkout day, a sparse rollup of the trip
+    columns.
+
+    Only the (day, route) pairs with at least one trip are kept, as three
+    arrays sorted by day and then route. Counting the trips per day between
+    a set of kiosks reads only the entries in the date range, so it costs
+    days × active routes rather than the number of trips.
+
+    Trips with a missing kiosk id are not counted.
+    """
+
+    def __init__(self, days: np.ndarray, routes: np.ndarray, counts: np.ndarray, n_trips: int):
+        self.days = days
+        self.routes = routes
+        self.counts = counts
+        # number of rows of the trip columns covered, counted or not
+        self.n_trips = n_trips
+
+    @classmethod
+    def build(cls, columns: dict, missing_id: int = -1) -> 'DailyRouteCounts':
+        """Count the trips in trip columns (see data_lib.load_trip_columns) per route and day."""
+        checkout_ids, return_ids = columns['checkout_kiosk_id'], columns['return_kiosk_id']
+        counted = (checkout_ids != missing_id) & (return_ids != missing_id)
+        days = columns['day'][counted]
+        routes = route_keys(checkout_ids[counted], return_ids[counted])
+        return cls._aggregate(days, routes, np.ones(len(days), dtype=np.int32), len(checkout_ids))
+
+    @classmethod
+    def _aggregate(cls, days, routes, counts, n_trips) -> 'DailyRouteCounts':
+        order = np.lexsort((routes, days))
+        days, routes, counts = days[order], routes[order], counts[order]
+        if not len(days):
+            return cls(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), n_trips)
+        # first entry of every run of equal (day, route)
+        starts = np.flatnonzero(np.r_[True, (days[1:] != days[:-1]) | (routes[1:] != routes[:-1])])
+        totals = np.add.reduceat(counts, starts)
+        return cls(np.ascontiguousarray(days[starts], dtype=np.int32), np.ascontiguousarray(routes[starts], dtype=np.int64),
+                   np.ascontiguousarray(totals, dtype=np.int32), n_trips)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def extend(self, columns: dict, missing_id: int = -1) -> 'DailyRouteCounts':
+        """
+        Return new counts that also cover `columns`, trips that are all newer
+        than the ones already counted. Only the entries from the first new
+        day onwards are recounted.
+        """
+        new = DailyRouteCounts.build(columns, missing_id)
+        split = int(np.searchsorted(self.days, new.days[0])) if len(new) else len(self)
+        tail = DailyRouteCounts._aggregate(np.concatenate([self.days[split:], new.days]),
+                                           np.concatenate([self.routes[split:], new.routes]),
+                                           np.concatenate([self.counts[split:], new.counts]), 0)
+        return DailyRouteCounts(np.concatenate([self.days[:split], tail.days]),
+                                np.concatenate([self.routes[:split], tail.routes]),
+                                np.concatenate([self.counts[:split], tail.counts]), self.n_trips + new.n_trips)
+
+    def trips_per_day(self, kiosk_ids: np.ndarray, start_day: int, end_day: int) -> tuple:
+        """
+        Count the trips per day that start and end at kiosks in `kiosk_ids`.
+
+        Args:
+            kiosk_ids (np.ndarray): Integer kiosk ids, see data_lib.parse_kiosk_ids.
+            start_day, end_day (int): Range of checkout days [start_day, end_day), in days since the Unix epoch.
+
+        Returns:
+            tuple: (days, number of trips), for the days with at least one trip.
+        """
+        lo, hi = np.searchsorted(self.days, [start_day, end_day])
+        days, routes, counts = self.days[lo:hi], self.routes[lo:hi], self.counts[lo:hi]
+        kiosk_ids = np.asarray(kiosk_ids, dtype=np.int64)
+        kiosk_ids = kiosk_ids[kiosk_ids >= 0]
+        if not len(days) or not len(kiosk_ids):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+        # membership table indexed by kiosk id, ids beyond the table are never in range
+        route_lo, route_hi = routes >> 32, routes & 0xffffffff
+        table = np.zeros(max(kiosk_ids.max(), route_hi.max()) + 1, dtype=bool)
+        table[kiosk_ids] = True
+        in_range = table[route_lo] & table[route_hi]
+
+        totals = np.bincount(days[in_range] - days[0], weights=counts[in_range], minlength=int(days[-1] - days[0]) + 1)
+        nonzero = np.flatnonzero(totals)
+        return days[0] + nonzero.astype(np.int32), totals[nonzero].astype(np.int64)
+
+    def nbytes(self) -> int:
+        """Total size of the count arrays, for the dataset cache."""
+        return self.days.nbytes + self.routes.nbytes + self.counts.nbytes
+
+    def to_bytes(self) -> bytes:
+        """Serialize the counts so they can be stored in Redis next to the trip columns."""
+        return _COUNTS_HEADER.pack(_COUNTS_MAGIC, self.n_trips, len(self)) + \
+            self.days.tobytes() + self.routes.tobytes() + self.counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'DailyRouteCounts':
+        """Load counts written by to_bytes without copying the arrays."""
+        magic, n_trips, n = _COUNTS_HEADER.unpack_from(blob)
+        if magic != _COUNTS_MAGIC:
+            raise ValueError("Not serialized DailyRouteCounts")
+        arrays, offset = [], _COUNTS_HEADER.size
+        for dtype in ['<i4', '<i8', '<i4']:
+            array = np.frombuffer(blob, dtype=dtype, count=n, offset=offset)
+            arrays.append(array)
+            offset += array.nbytes
+        return cls(*arrays, n_trips)
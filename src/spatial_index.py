@@ -0,0 +1,182 @@
+import heapq
+import struct
+import numpy as np
+from gcd_algorithm import great_circle_distances
+
+EARTH_RADIUS_KM = 6371.009
+
+# Ranges of at most LEAF_SIZE kiosks are scanned with one vectorized pass
+LEAF_SIZE = 8
+
+# Serialization header: magic, number of kiosks, leaf size
+_HEADER = struct.Struct('<4sIH')
+_MAGIC = b'KDX1'
+
+def _unit_vectors(lats: np.ndarray, longs: np.ndarray) -> np.ndarray:
+    """Convert latitudes and longitudes (radians) to points on the unit sphere."""
+    return np.column_stack([np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)])
+
+def _chord_length(radius_km: float) -> float:
+    """Straight-line distance on the unit sphere matching a great circle distance in km."""
+    angle = min(radius_km / EARTH_RADIUS_KM, np.pi)
+    return 2 * np.sin(angle / 2)
+
+class KioskIndex:
+    """
+    KD-tree over kiosk locations projected onto the unit sphere.
+
+    Straight-line (chord) distance between points on the sphere increases
+    monotonically with great circle distance, so an ordinary Euclidean
+    KD-tree answers nearest neighbour and radius queries exactly. The tree is
+    implicit: the points are arranged so that the median of every range is
+    the splitting node, and only the split dimension of each node is stored.
+    This keeps the index a handful of flat arrays that can be stored in Redis.
+
+    Query results are positions into the kiosk list the index was built from.
+    """
+
+    def __init__(self, lats: np.ndarray, longs: np.ndarray, kiosk_ids: np.ndarray, leaf_size: int = LEAF_SIZE):
+        """
+        Build the index.
+
+        Args:
+            lats (np.ndarray): Kiosk latitudes in degrees.
+            longs (np.ndarray): Kiosk longitudes in degrees.
+            kiosk_ids (np.ndarray): Integer kiosk ids, see data_lib.parse_kiosk_ids.
+            leaf_size (int): Largest range scanned without further splitting.
+        """
+        self.leaf_size = leaf_size
+        self.lats = np.array(lats, dtype=np.float64)
+        self.longs = np.array(longs, dtype=np.float64)
+        self.kiosk_ids = np.array(kiosk_ids, dtype=np.int32)
+        self.positions = np.arange(len(self.lats), dtype=np.int32)
+        self.points = _unit_vectors(np.radians(self.lats), np.radians(self.longs))
+        self.split_dims = np.zeros(len(self.lats), dtype=np.int8)
+        self._build(0, len(self.lats))
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def _build(self, lo: int, hi: int) -> None:
+        # reorder the slots in [lo, hi) around the median of the widest dimension
+        stack = [(lo, hi)]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo <= self.leaf_size:
+                continue
+            mid = (lo + hi) // 2
+            dim = int(np.argmax(np.ptp(self.points[lo:hi], axis=0)))
+            order = lo + np.argpartition(self.points[lo:hi, dim], mid - lo)
+            for array in (self.points, self.lats, self.longs, self.kiosk_ids, self.positions):
+                array[lo:hi] = array[order]
+            self.split_dims[mid] = dim
+            stack.extend([(lo, mid), (mid + 1, hi)])
+
+    def _distances_km(self, point: tuple, slots: np.ndarray) -> np.ndarray:
+        return great_circle_distances(point[0], point[1], self.lats[slots], self.longs[slots])
+
+    def knn(self, point: tuple, k: int) -> tuple:
+        """
+        Find the k kiosks nearest to a point.
+
+        Args:
+            point (tuple): (latitude, longitude) in degrees.
+            k (int): Number of kiosks to return.
+
+        Returns:
+            tuple: (positions, distances in km), nearest first.
+        """
+        k = min(max(int(k), 0), len(self))
+        if k == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+        query = _unit_vectors(np.radians(point[0]), np.radians(point[1]))[0]
+        heap = [] # max-heap of (-squared chord, slot) holding the best k slots
+
+        def _offer(slots):
+            d2 = ((self.points[slots] - query)**2).sum(axis=1)
+            for dist2, slot in zip(d2.tolist(), slots.tolist()):
+                if len(heap) < k:
+                    heapq.heappush(heap, (-dist2, slot))
+                elif dist2 < -heap[0][0]:
+                    heapq.heapreplace(heap, (-dist2, slot))
+
+        # each entry holds a range and a lower bound on its squared chord distance
+        stack = [(0, len(self), 0.0)]
+        while stack:
+            lo, hi, bound2 = stack.pop()
+            if len(heap) == k and bound2 >= -heap[0][0]:
+                continue
+            if hi - lo <= self.leaf_size:
+                _offer(np.arange(lo, hi))
+                continue
+            mid = (lo + hi) // 2
+            diff = query[self.split_dims[mid]] - self.points[mid, self.split_dims[mid]]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            _offer(np.array([mid]))
+            stack.append((*far, max(bound2, diff**2)))
+            stack.append((*near, bound2))
+
+        slots = np.array([slot for _, slot in heap], dtype=np.int64)
+        distances = self._distances_km(point, slots)
+        order = np.lexsort((self.positions[slots], distances))
+        return self.positions[slots[order]], distances[order]
+
+    def within(self, point: tuple, radius_km: float) -> tuple:
+        """
+        Find every kiosk within a great circle distance of a point.
+
+        Args:
+            point (tuple): (latitude, longitude) in degrees.
+            radius_km (float): Search radius in km.
+
+        Returns:
+            tuple: (positions, distances in km), nearest first.
+        """
+        query = _unit_vectors(np.radians(point[0]), np.radians(point[1]))[0]
+        # pad the chord radius so kiosks on the boundary are decided by the exact distance below
+        r2 = (_chord_length(radius_km) + 1e-9)**2
+        found = []
+
+        stack = [(0, len(self))]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo <= self.leaf_size:
+                slots = np.arange(lo, hi)
+                found.append(slots[((self.points[slots] - query)**2).sum(axis=1) <= r2])
+                continue
+            mid = (lo + hi) // 2
+            diff = query[self.split_dims[mid]] - self.points[mid, self.split_dims[mid]]
+            found.append(np.array([mid]) if ((self.points[mid] - query)**2).sum() <= r2 else np.empty(0, dtype=np.int64))
+            if diff < 0 or diff**2 <= r2:
+                stack.append((lo, mid))
+            if diff >= 0 or diff**2 <= r2:
+                stack.append((mid + 1, hi))
+
+        slots = np.concatenate(found).astype(np.int64) if found else np.empty(0, dtype=np.int64)
+        distances = self._distances_km(point, slots)
+        keep = distances <= radius_km
+        slots, distances = slots[keep], distances[keep]
+        order = np.lexsort((self.positions[slots], distances))
+        return self.positions[slots[order]], distances[order]
+
+    def to_bytes(self) -> bytes:
+        """Serialize the index so it can be stored in Redis next to 'kiosks'."""
+        arrays = [self.lats, self.longs, self.points, self.kiosk_ids, self.positions, self.split_dims]
+        return _HEADER.pack(_MAGIC, len(self), self.leaf_size) + b''.join(array.tobytes() for array in arrays)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'KioskIndex':
+        """Load an index written by to_bytes without rebuilding the tree."""
+        magic, n, leaf_size = _HEADER.unpack_from(blob)
+        if magic != _MAGIC:
+            raise ValueError("Not a serialized KioskIndex")
+        index = cls.__new__(cls)
+        index.leaf_size = leaf_size
+        offset = _HEADER.size
+        for name, dtype, shape in [('lats', '<f8', (n,)), ('longs', '<f8', (n,)), ('points', '<f8', (n, 3)),
+                                   ('kiosk_ids', '<i4', (n,)), ('positions', '<i4', (n,)), ('split_dims', 'i1', (n,))]:
+            count = int(np.prod(shape))
+            array = np.frombuffer(blob, dtype=dtype, count=count, offset=offset).reshape(shape)
+            setattr(index, name, array)
+            offset += array.nbytes
+        return index
@@ -1,21 +1,46 @@
 import time
 import logging
-import json
+import multiprocessing
 import os
+import signal
+from contextlib import nullcontext
 from datetime import datetime
-import matplotlib.pyplot as plt
-import io
 
 import jobs
-from jobs import trips_db, kiosk_db, q, jdb, res
-from data_lib import filter_by_date, filter_by_location, nearest_kiosks, get_trips, get_kiosks
-from gcd_algorithm import great_circle_distance
+import metrics
+import profiling
+import requests
+from redis.exceptions import LockError
+from jobs import trips_db, kiosk_db, q, jdb, res, trips_staging_db, kiosk_staging_db
+import numpy as np
+from data_lib import cached_kiosks, cached_kiosk_index, cached_route_index, cached_daily_counts, kiosks_within, \
+    parse_kiosk_ids, to_epoch, dataset_cache, MISSING_ID
+from ingest import TRIPS_URL, KIOSK_URL, load_dataset, refresh_dataset
+from render import Plot, Renderer
 
 # Initialize logging
 log_level = os.environ.get("LOG_LEVEL")
 logging.basicConfig(level=log_level)
 
-@q.worker
+# Number of worker processes consuming the job queue
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+
+# Seconds between throughput log lines
+STATS_INTERVAL = float(os.environ.get("WORKER_STATS_INTERVAL", 60))
+
+# Seconds a worker blocks on the queue before checking for shutdown
+POLL_TIMEOUT = 1
+
+# Seconds the data load lock is held at most, so a worker dying mid-load
+# doesn't block later loads; longer than the slowest full load
+DATA_LOAD_LOCK_TIMEOUT = float(os.environ.get("DATA_LOAD_LOCK_TIMEOUT", 4 * 3600))
+
+# Seconds a data load waits for another one to finish before failing
+DATA_LOAD_LOCK_WAIT = float(os.environ.get("DATA_LOAD_LOCK_WAIT", 60))
+
+# Reused for every plot rendered by this process
+renderer = Renderer()
+
 def process_job(job_id):
     """
     Process a job from the queue.
@@ -27,71 +52,213 @@ def process_job(job_id):
 
     # Update job status to "in progress"
     jobs.update_job_status(job_id, "in progress")
-    
-    # Simulate processing time
-    time.sleep(5)
 
-    # Generate the desired plot
     result = None
-    job_params = jobs.get_job_by_id(job_id)['job parameters']
-    job_type = job_params['plot_type']
-    if job_type == 'trip_duration':
-        result = trip_duration_histogram_job(job_params)
-    elif job_type == 'trips_per_day':
-        result = trips_per_day_job(job_params)
-    else: 
-        # Simulate processing time
-        logging.warning('Invalid plot/job type')
-        time.sleep(5)
-    
-    res.set(job_id, result)
+    status = "failed" # unless it gets to the end
+    started = time.perf_counter()
+    job_dict = jobs.get_job_by_id(job_id)
+    job_params = job_dict['job parameters']
+    job_type = job_params.get('job_type') or job_params.get('plot_type')
+    if 'wait_ms' in job_dict:
+        metrics.JOB_WAIT_SECONDS.observe(job_dict['wait_ms'] / 1000, job_type=job_type)
+    try:
+        # profiled jobs store their stats next to the result, see /jobs/<job_id>/profile
+        with profiling.profiled(res, job_id) if job_params.get('profile') else nullcontext():
+            if job_params.get('job_type') == 'load_data':
+                job_status, result = load_data_job(job_id, job_params)
+            else:
+                # Generate the desired plot
+                if job_type == 'trip_duration':
+                    result = trip_duration_histogram_job(job_params)
+                elif job_type == 'trips_per_day':
+                    result = trips_per_day_job(job_params)
+                else: 
+                    logging.warning('Invalid plot/job type')
+                job_status = "complete"
+
+        jobs.store_job_result(job_id, result)
+
+        # Update status, publishing the result for identical jobs
+        jobs.finish_job(job_id, job_status)
+        status = job_status
+    finally:
+        metrics.JOB_SECONDS.observe(time.perf_counter() - started, job_type=job_type, status=status)
+    logging.info(f"Job with ID {job_id} processed with status '{status}'")
+
+def warm_cache():
+    """
+    Load the datasets used by jobs into the process-local dataset cache.
+    Called before forking the worker processes, so that they share one copy
+    of the (mostly NumPy) data copy-on-write instead of each loading its own.
+    """
+    if not kiosk_db.exists('kiosks'):
+        logging.info("No data loaded, nothing to warm up.")
+        return
+    started = time.monotonic()
+    cached_kiosks(trips_db, kiosk_db)
+    cached_kiosk_index(trips_db, kiosk_db)
+    cached_route_index(trips_db)
+    cached_daily_counts(trips_db)
+    logging.info(f"Warmed up dataset cache in {time.monotonic() - started:.2f}s: {dataset_cache.stats()}")
+
+def _push_metrics():
+    # add this process' metrics to the totals in Redis, served by the API's /metrics
+    try:
+        metrics.push(jdb, metrics.WORKER_METRICS_PREFIX, metrics.WORKER_METRICS)
+    except Exception:
+        logging.exception("Failed to push worker metrics")
+
+# Set by SIGTERM/SIGINT, the worker exits once its current job is done
+_shutdown = False
+
+def _request_shutdown(signum, frame):
+    global _shutdown
+    _shutdown = True
+
+def consume(completed):
+    """
+    Process jobs from the queue until SIGTERM or SIGINT is received. A job
+    in progress is always finished first.
+
+    Args:
+        completed (multiprocessing.Value): Counter of processed jobs, shared by the worker processes.
+    """
+    while not _shutdown:
+        job_id = q.get(block=True, timeout=POLL_TIMEOUT)
+        if job_id is None:
+            continue
+        try:
+            process_job(job_id)
+        except Exception:
+            logging.exception(f"Job with ID {job_id} failed")
+            jobs.finish_job(job_id, "failed")
+        _push_metrics()
+        with completed.get_lock():
+            completed.value += 1
+
+def run_workers(n_processes=WORKER_PROCESSES):
+    """
+    Run `n_processes` worker processes consuming the job queue, forked after
+    warming up the dataset cache. Workers that die are replaced, and the job
+    throughput is logged every STATS_INTERVAL seconds. On SIGTERM or SIGINT
+    the workers shut down once their current jobs are done.
+    """
+    context = multiprocessing.get_context('fork')
+    completed = context.Value('q', 0)
+    warm_cache()
+    # pushed before forking, or every worker process would push them again
+    _push_metrics()
 
-    # Update status
-    jobs.update_job_status(job_id, "complete")
-    logging.info(f"Job with ID {job_id} processed successfully")
+    # installed before forking, so the workers inherit them
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, _request_shutdown)
+
+    def _start():
+        process = context.Process(target=consume, args=(completed,))
+        process.start()
+        return process
+
+    processes = [_start() for _ in range(n_processes)]
+    logging.info(f"Started {n_processes} worker processes")
+
+    started = last_time = time.monotonic()
+    last_count = 0
+    while not _shutdown:
+        time.sleep(POLL_TIMEOUT)
+        for i, process in enumerate(processes):
+            if not process.is_alive() and not _shutdown:
+                logging.warning(f"Worker process {process.pid} exited with code {process.exitcode}, restarting it")
+                processes[i] = _start()
+        now = time.monotonic()
+        if now - last_time >= STATS_INTERVAL:
+            count = completed.value
+            logging.info(f"Processed {count - last_count} jobs in {now - last_time:.0f}s "
+                         f"({(count - last_count) / (now - last_time):.2f} jobs/sec)")
+            last_count, last_time = count, now
+
+    logging.info("Shutting down, waiting for jobs in progress")
+    for process in processes:
+        # the signal may only have been sent to this process
+        process.terminate()
+        process.join()
+    elapsed = time.monotonic() - started
+    logging.info(f"Processed {completed.value} jobs in {elapsed:.0f}s ({completed.value / elapsed:.2f} jobs/sec)")
+
+def load_data_job(job_id, job_parameters):
+    '''
+    Loads trips and kiosks into Redis, reporting progress in the job record.
+
+    Expected keys in job_parameters:
+        - 'mode': 'full' or 'incremental'
+        - 'rows': number of most recent trips to load (full loads only)
+
+    Both modes build the new dataset in the staging databases and swap it in
+    when complete, so reads keep using the previous dataset in the meantime.
+
+    Returns a tuple (job status, result message).
+    '''
+    progress = lambda stats: jobs.update_job_progress(job_id, stats)
+
+    # only one load may use the staging databases at a time
+    lock = jdb.lock('data_load_lock', timeout=DATA_LOAD_LOCK_TIMEOUT, blocking_timeout=DATA_LOAD_LOCK_WAIT)
+    if not lock.acquire():
+        logging.error("Failed to load data to Redis: another data load is in progress")
+        return "failed", "another data load is in progress"
+    try:
+        if job_parameters['mode'] == 'incremental':
+            n_trips, n_kiosks = refresh_dataset(trips_db, kiosk_db, trips_staging_db, kiosk_staging_db,
+                                                TRIPS_URL, KIOSK_URL, progress)
+            message = f'Added {n_trips} new trips and refreshed {n_kiosks} kiosks in Redis databases.'
+        else:
+            n_trips, n_kiosks = load_dataset(trips_db, kiosk_db, trips_staging_db, kiosk_staging_db,
+                                             TRIPS_URL, KIOSK_URL, int(job_parameters['rows']), progress)
+            message = f'Loaded {n_trips} trips and {n_kiosks} kiosks into Redis databases.'
+    except requests.RequestException as error:
+        logging.error(f"Failed to load data to Redis: {error}")
+        return "failed", f"Failed to load data to Redis: {error}"
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # the lease ran out and another load may hold the lock now
+            logging.warning("Data load lock expired before the load finished.")
+    return "complete", message
 
 def trip_duration_histogram_job(job_parameters):
     """
     Function that plots the route data for a given time interval between two kiosk locations.
+    The result is rendered in job_parameters['format'], one of render.FORMATS (default 'png').
     """
-    start_date = datetime(year=2023, month=1, day=31) if job_parameters['start_date'] == 'default' else datetime.strptime(job_parameters['start_date'], "%m/%d/%Y")
-    end_date = datetime(year=2024, month=1, day=31) if job_parameters['end_date'] == 'default' else datetime.strptime(job_parameters['end_date'], "%m/%d/%Y")
-
-    k1 = '3795' if job_parameters['kiosk1'] == 'default' else job_parameters['kiosk1']
-    k2 = '2548' if job_parameters['kiosk1'] == 'default' else job_parameters['kiosk2']
+    job_parameters = jobs.canonical_job_params(job_parameters)
+    start_date = datetime.strptime(job_parameters['start_date'], "%m/%d/%Y")
+    end_date = datetime.strptime(job_parameters['end_date'], "%m/%d/%Y")
+    k1, k2 = job_parameters['kiosk1'], job_parameters['kiosk2']
     # Check if parameters are provided and valid
     if not all([start_date,end_date, k1, k2]):
         logging.error("Missing or invalid parameters. Please provide 'day', 'kiosk1', and 'kiosk2' parameters.")
         return "Missing or invalid parameters. Please provide 'day', 'kiosk1', and 'kiosk2' parameters.", 400
 
-    # Get all the trips on that day between the two kiosks
-    trips = []
-
-    trips_data = filter_by_date(get_trips(trips_db), start_date, end_date)
-    for trip in trips_data:
-        if 'checkout_kiosk_id' in trip and 'return_kiosk_id' in trip:
-            kiosk_set = {trip['checkout_kiosk_id'], trip['return_kiosk_id']}
-            if kiosk_set == {k1, k2} or kiosk_set == {k2, k1}:
-                trips.append(trip)
+    # Look up the trips between the two kiosks in the interval
+    id1, id2 = parse_kiosk_ids([k1, k2])
+    index = cached_route_index(trips_db)
+    trips = index.route(id1, id2, to_epoch(start_date), to_epoch(end_date))
 
     # Check if trips is empty
-    if not trips:
+    if MISSING_ID in (id1, id2) or trips.start == trips.stop:
         return "No trips were made during the specified time period/locations."
 
-    # Get trip durations
-    trip_durations = [int(trip['trip_duration_minutes']) for trip in trips]
-
-    # Plot trip durations on histogram and save figure
-    fig = plt.figure(figsize=(15,8))
-    plt.hist(trip_durations, bins=range(0, 31))
-    plt.xlabel('Trip Duration (minutes)')
-    plt.ylabel('Number of Trips')
-    plt.title(f"Trip Durations between {trips[0]['checkout_kiosk']} and {trips[0]['return_kiosk']} ({start_date.strftime('%m/%d/%y')} - {end_date.strftime('%m/%d/%y')})")
-    plt.tight_layout()
+    # Get trip duration counts and the kiosk names of the first trip for the title
+    counts, bins = np.histogram(index.durations[trips], bins=range(0, 31))
+    kiosk_names = {kiosk['kiosk_id']: kiosk['kiosk_name'] for kiosk in cached_kiosks(trips_db, kiosk_db)}
+    checkout_id = str(index.checkout_ids[trips.start])
+    return_id = str(id2 if checkout_id == str(id1) else id1)
+    checkout_name, return_name = kiosk_names.get(checkout_id, checkout_id), kiosk_names.get(return_id, return_id)
 
-    if type(serialize_fig(fig)) == None:
-        logging.warning('serialized fig is none')
-    return serialize_fig(fig)
+    # Plot trip durations on histogram
+    plot = Plot('hist', bins, counts,
+                f"Trip Durations between {checkout_name} and {return_name} ({start_date.strftime('%m/%d/%y')} - {end_date.strftime('%m/%d/%y')})",
+                'Trip Duration (minutes)', 'Number of Trips')
+    return renderer.render(plot, job_parameters['format'])
 
 def trips_per_day_job(job_data:dict):
     '''
@@ -104,59 +271,33 @@ def trips_per_day_job(job_data:dict):
         - 'long',
         - 'radius'
     
-    Returns bytes data for a png image. Image is of a plot of the number of trips per day. 
+    Optional keys: 'format', one of render.FORMATS (default 'png')
+
+    Returns bytes data for the plot of the number of trips per day, as an image or data series.
     '''
     # get data
-    trips_data, kiosk_data = get_trips(trips_db), get_kiosks(kiosk_db)
+    counts, kiosk_data = cached_daily_counts(trips_db), cached_kiosks(trips_db, kiosk_db)
     
     # parse job parameters
-    radius = (1 if job_data['radius'] == 'default' else float(job_data['radius']))*1.609344
-    lat = 30.2862730619728 if job_data['lat'] == 'default' else float(job_data['lat'])
-    long = -97.73937727490916 if job_data['long'] == 'default' else float(job_data['long'])
-    start_date = datetime(year=2023, month=1, day=31) if job_data['start_date'] == 'default' else datetime.strptime(job_data['start_date'], "%m/%d/%Y")
-    end_date = datetime(year=2024, month=1, day=31) if job_data['end_date'] == 'default' else datetime.strptime(job_data['end_date'], "%m/%d/%Y")
-
-    # filter trip data
-    filtered_trips_temp = filter_by_date(trips_data, start_date, end_date)
-    filtered_trips = filter_by_location(filtered_trips_temp, kiosk_data, (lat, long), radius)
-
-    # trips_by_date = { <datetime1> : [<trip dict1>, <trip dict2> ...] ... }
-    trips_by_date = {}
-    for trip_dict in filtered_trips:
-        date_str = trip_dict['checkout_date']
-        trip_date = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S.%f') # datetime object
-        if trip_date not in trips_by_date.keys():
-            trips_by_date[trip_date] = [trip_dict]
-        else:
-            trips_by_date[trip_date].append(trip_dict)
-
-    logging.debug(f"Collected dates: {trips_by_date.keys()}")
+    job_data = jobs.canonical_job_params(job_data)
+    radius = float(job_data['radius'])*1.609344
+    lat = float(job_data['lat'])
+    long = float(job_data['long'])
+    start_date = datetime.strptime(job_data['start_date'], "%m/%d/%Y")
+    end_date = datetime.strptime(job_data['end_date'], "%m/%d/%Y")
 
-    dates = sorted(trips_by_date.keys())
-    number_trips = [len(trips_by_date[date]) for date in dates]
+    # sum the daily counts of the routes between kiosks in range (days since the Unix epoch)
+    kiosk_ids = kiosks_within(kiosk_data, (lat, long), radius, cached_kiosk_index(trips_db, kiosk_db))
+    days, number_trips = counts.trips_per_day(kiosk_ids, to_epoch(start_date) // 86400, to_epoch(end_date) // 86400)
+    dates = days.astype('datetime64[D]')
 
-    fig = plt.figure(figsize=(15,8))
-    plt.plot(dates, number_trips)
-    plt.xlabel('Date')
-    plt.ylabel('Number of Trips')
-    plt.title(f"Trips per day {start_date.strftime('%m/%d/%y')} - {end_date.strftime('%m/%d/%y')}, Location: ({lat:.3f}, {long:.3f}), Radius: {job_data['radius']} mi")
-    plt.tight_layout()
+    logging.debug(f"Collected dates: {dates}")
 
-    return serialize_fig(fig)
-
-
-def serialize_fig(figure)->bytes:
-    '''
-    Converts a matplotlibfigure into png binary data that
-    can be stored in redis.
-
-    Parameters:
-    - figure (matplotlib.Figure): The figure to be serialized.
-    '''
-    buf = io.BytesIO()
-    figure.savefig(buf)
-    return buf.getvalue() #BytesIO object
+    plot = Plot('line', dates, number_trips,
+                f"Trips per day {start_date.strftime('%m/%d/%y')} - {end_date.strftime('%m/%d/%y')}, Location: ({lat:.3f}, {long:.3f}), Radius: {job_data['radius']} mi",
+                'Date', 'Number of Trips')
+    return renderer.render(plot, job_data['format'])
 
 # Start processing jobs
 if __name__ == '__main__':
-    process_job()
\ No newline at end of file
+    run_workers()
\ No newline at end of file
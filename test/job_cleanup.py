@@ -0,0 +1,17 @@
+'''
+Removes the jobs created by a test from Redis, leaving everything else in
+the jobs database alone, including the queue and other jobs in it.
+'''
+import jobs as j
+
+def delete_jobs(*job_dicts):
+    '''Delete the records, queue entries, in-flight markers, memos and results of `job_dicts`.'''
+    pipe = j.jdb.pipeline()
+    for job_dict in job_dicts:
+        pipe.delete(j.job_record_key(job_dict['id']))
+        pipe.lrem(j.q.key, 0, j.q.serializer.dumps(job_dict['id']))
+        if 'key' in job_dict:
+            pipe.delete(f"inflight:{job_dict['key']}")
+            j.res.delete(f"memo:{job_dict['key']}")
+        j.res.delete(job_dict['id'])
+    pipe.execute()
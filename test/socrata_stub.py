@@ -0,0 +1,114 @@
+'''
+Local stand-in for the Socrata trips and kiosk endpoints, serving synthetic
+data so that ingestion can be tested and benchmarked offline.
+
+Supports the subset of SoQL used by ingest.py: $select (a column or
+count(*) AS <alias>), $where (checkout_datetime compared with >, >=, <, <=
+to a quoted timestamp), $order, $limit and $offset.
+'''
+import json
+import random
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+def synthetic_kiosks(n_kiosks: int = 100, seed: int = 0) -> list:
+    '''Kiosk records scattered around downtown Austin.'''
+    rng = random.Random(seed)
+    return [{
+        'kiosk_id': str(1000 + i),
+        'kiosk_name': f'Synthetic Kiosk {i}',
+        'kiosk_status': 'active' if rng.random() < 0.9 else 'closed',
+        'location': {'latitude': f'{rng.gauss(30.275, 0.02):.6f}', 'longitude': f'{rng.gauss(-97.74, 0.02):.6f}'},
+    } for i in range(n_kiosks)]
+
+def synthetic_trips(n_trips: int, kiosks: list, seed: int = 0, start: datetime = datetime(2023, 1, 1), days: int = 400) -> list:
+    '''Trip records between random kiosks, spread uniformly over `days` days from `start`.'''
+    rng = random.Random(seed)
+    trips = []
+    for i in range(n_trips):
+        checkout = start + timedelta(seconds=rng.randrange(days * 86400))
+        checkout_kiosk, return_kiosk = rng.choice(kiosks), rng.choice(kiosks)
+        trips.append({
+            'trip_id': str(10**8 + i),
+            'membership_type': 'Student Membership',
+            'bicycle_id': str(rng.randrange(100, 999)),
+            'bike_type': rng.choice(['classic', 'electric']),
+            'checkout_datetime': checkout.strftime('%Y-%m-%dT%H:%M:%S.000'),
+            'checkout_date': checkout.strftime('%Y-%m-%dT00:00:00.000'),
+            'checkout_time': checkout.strftime('%H:%M:%S'),
+            'checkout_kiosk_id': checkout_kiosk['kiosk_id'],
+            'checkout_kiosk': checkout_kiosk['kiosk_name'],
+            'return_kiosk_id': return_kiosk['kiosk_id'],
+            'return_kiosk': return_kiosk['kiosk_name'],
+            'trip_duration_minutes': str(int(rng.expovariate(1 / 12)) + 1),
+            'month': str(checkout.month),
+            'year': str(checkout.year),
+        })
+    return trips
+
+_WHERE = re.compile(r"^(\w+)\s*(>=|<=|>|<)\s*'([^']*)'$")
+_COUNT = re.compile(r"^count\(\*\)\s+AS\s+(\w+)$", re.IGNORECASE)
+_OPERATORS = {'>=': str.__ge__, '<=': str.__le__, '>': str.__gt__, '<': str.__lt__}
+
+def query(records: list, params: dict) -> list:
+    '''Apply SoQL query parameters to a list of records.'''
+    if '$where' in params:
+        field, op, value = _WHERE.match(params['$where']).groups()
+        records = [record for record in records if _OPERATORS[op](record[field], value)]
+    if '$order' in params:
+        # sort by the last key first, relying on sort stability
+        for term in reversed(params['$order'].split(',')):
+            field, *direction = term.split()
+            records = sorted(records, key=lambda record: record[field],
+                             reverse=bool(direction) and direction[0].upper() == 'DESC')
+    if '$select' in params:
+        count = _COUNT.match(params['$select'])
+        if count:
+            return [{count.group(1): str(len(records))}]
+        fields = [field.strip() for field in params['$select'].split(',')]
+        records = [{field: record[field] for field in fields} for record in records]
+    offset = int(params.get('$offset', 0))
+    limit = int(params.get('$limit', 1000))
+    return records[offset:offset + limit]
+
+@contextmanager
+def serve(trips: list, kiosks: list):
+    '''
+    Serve `trips` and `kiosks` over HTTP on a free local port.
+
+    Yields:
+        tuple: (trips url, kiosk url)
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/trips.json':
+                body = json.dumps(query(trips, params)).encode()
+            elif url.path == '/kiosks.json':
+                body = json.dumps(kiosks).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        yield f'{base_url}/trips.json', f'{base_url}/kiosks.json'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -19,6 +19,24 @@ def test_get_trip_data(base_url):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+def test_get_trip_data_pages(base_url):
+    expected = requests.get(f'{base_url}/trips', params={"radius": "5"}).json()
+    pages, params = [], {"radius": "5", "limit": "100", "fields": "trip_id"}
+    while True:
+        response = requests.get(f'{base_url}/trips', params=params)
+        assert response.status_code == 200
+        pages.extend(response.json()["trips"])
+        if not response.json()["next_cursor"]:
+            break
+        params["cursor"] = response.json()["next_cursor"]
+    assert pages == [{"trip_id": trip["trip_id"]} for trip in expected]
+
+def test_get_trip_data_ndjson(base_url):
+    response = requests.get(f'{base_url}/trips', params={"radius": "5", "limit": "10", "format": "ndjson"}, stream=True)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert len([line for line in response.iter_lines() if line]) <= 10
+
 def test_get_kiosk_keys(base_url):
     response = requests.get(f'{base_url}/kiosk_ids')
     assert response.status_code == 200
@@ -34,4 +52,24 @@ def test_get_results(base_url, job_id):
 
 def test_nearest(base_url):
     response = requests.get(f'{base_url}/nearest', params={"n":"5","lat":"30.2862730619728","long":"-97.73937727490916"})
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+def test_show_nearest_cached(base_url):
+    params = {"n": "5", "lat": "30.2862730619728", "long": "-97.73937727490916"}
+    first = requests.get(f'{base_url}/show_nearest', params=params)
+    hits = requests.get(f'{base_url}/cache/stats').json()["map"]["hits"]
+    second = requests.get(f'{base_url}/show_nearest', params={**params, "lat": "30.28627"})
+    assert first.status_code == second.status_code == 200
+    assert first.headers["Content-Type"].startswith("text/html") and second.content == first.content
+    assert requests.get(f'{base_url}/cache/stats').json()["map"]["hits"] == hits + 1
+
+def test_metrics(base_url):
+    requests.get(f'{base_url}/kiosk_ids')
+    response = requests.get(f'{base_url}/metrics')
+    assert response.status_code == 200 and response.headers["Content-Type"].startswith("text/plain")
+    assert '# TYPE metrobike_stage_seconds histogram' in response.text
+    assert 'metrobike_http_request_seconds_count{route="/kiosk_ids",method="GET",status="200"}' in response.text
+    assert 'metrobike_queue_depth ' in response.text
+
+def test_profile_not_found(base_url):
+    assert requests.get(f'{base_url}/jobs/missing/profile').status_code == 404
@@ -0,0 +1,34 @@
+import asyncio
+import json
+import threading
+import jobs as j
+import api_async
+from job_cleanup import delete_jobs
+
+async def _get(path, query=''):
+    sent = []
+    async def receive():
+        return {'type': 'http.request'}
+    async def send(message):
+        sent.append(message)
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode()}
+    await api_async.app(scope, receive, send)
+    return sent[0]['status'], dict(sent[0]['headers'])[b'content-type'].decode(), sent[1]['body']
+
+def test_job_routes():
+    job_dict = j.add_job({'job_type': 'load_data', 'mode': 'incremental'})
+
+    async def requests():
+        status, content_type, body = await _get(f"/jobs/{job_dict['id']}")
+        assert status == 200 and content_type == 'application/json'
+        assert json.loads(body) == j.get_job_by_id(job_dict['id'])
+        assert (await _get('/jobs/missing'))[2] == b'No job found with ID missing.'
+        assert (await _get('/trips'))[0] == 404
+
+        # the wait returns as soon as the job finishes
+        threading.Timer(0.2, j.finish_job, [job_dict['id'], 'complete']).start()
+        _, _, body = await _get(f"/jobs/{job_dict['id']}/wait", 'timeout=5')
+        assert json.loads(body)['status'] == 'complete'
+
+    asyncio.run(requests())
+    delete_jobs(job_dict)
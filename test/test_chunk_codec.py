@@ -0,0 +1,24 @@
+import json
+import pytest
+from chunk_codec import available_codecs, encode_chunk, decode_chunk, parse_codec
+from socrata_stub import synthetic_kiosks, synthetic_trips
+
+trips = synthetic_trips(500, synthetic_kiosks(20))
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_round_trip(codec):
+    blob, nbytes = encode_chunk(trips, codec)
+    assert decode_chunk(blob) == trips
+    assert blob[0] >> 4 in [1, 2] and nbytes > 0
+
+def test_reads_chunks_without_header():
+    assert decode_chunk(json.dumps(trips).encode()) == trips
+
+def test_compression_shrinks_chunks():
+    assert len(encode_chunk(trips, 'json+zlib')[0]) < len(encode_chunk(trips, 'json')[0]) / 4
+
+def test_invalid_codecs():
+    with pytest.raises(ValueError):
+        parse_codec('json+gzip')
+    with pytest.raises(ValueError):
+        decode_chunk(b'\x7f')
@@ -0,0 +1,77 @@
+import json
+import sys
+import numpy as np
+from datetime import datetime
+import data_lib as d
+
+trips_data = [
+    {'checkout_datetime': '2023-02-01T08:15:00.000', 'checkout_kiosk_id': '4055', 'return_kiosk_id': '2498', 'trip_duration_minutes': '12'},
+    {'checkout_datetime': '2023-02-02T17:40:00.000', 'checkout_kiosk_id': '2498', 'return_kiosk_id': '4055', 'trip_duration_minutes': '9'},
+    {'checkout_datetime': '2023-03-05T11:00:00.000', 'checkout_kiosk_id': '4055', 'return_kiosk_id': 'Stolen', 'trip_duration_minutes': '30'},
+]
+
+kiosk_data = [
+    {'kiosk_id': '4055', 'location': {'latitude': '30.2862', 'longitude': '-97.7394'}},
+    {'kiosk_id': '2498', 'location': {'latitude': '30.2850', 'longitude': '-97.7335'}},
+]
+
+class FakeGenerationDB:
+    '''Stands in for the trips_db connection, only the generation key is read.'''
+    def __init__(self):
+        self.generation = b'1'
+
+    def get(self, key):
+        return self.generation
+
+def test_build_trip_columns():
+    columns = d.build_trip_columns(trips_data)
+    assert set(columns) == set(d.TRIP_COLUMNS)
+    assert list(columns['checkout_kiosk_id']) == [4055, 2498, 4055]
+    assert list(columns['return_kiosk_id']) == [2498, 4055, d.MISSING_ID]
+    assert list(columns['duration_minutes']) == [12, 9, 30]
+    assert columns['day'][0] == (datetime(2023, 2, 1) - datetime(1970, 1, 1)).days
+
+def test_columnar_filters_match_list_filters():
+    columns = d.sort_trip_columns(d.build_trip_columns(trips_data))
+    start, end = datetime(2023, 2, 1), datetime(2023, 3, 1)
+    columns = d.slice_columns(columns, d.date_range(columns, start, end))
+    rows = columns['row'][d.location_mask(columns, kiosk_data, (30.286, -97.739), 5)]
+    expected = d.filter_by_location(d.filter_by_date(trips_data, start, end), kiosk_data, (30.286, -97.739), 5)
+    assert [trips_data[i] for i in rows] == expected
+
+def test_sort_trip_columns():
+    unsorted = list(reversed(trips_data))
+    columns = d.sort_trip_columns(d.build_trip_columns(unsorted))
+    assert np.all(np.diff(columns['checkout_epoch']) >= 0)
+    assert [unsorted[i]['checkout_datetime'] for i in columns['row']] == [trip['checkout_datetime'] for trip in trips_data]
+    rows = d.date_range(columns, datetime(2023, 2, 2), datetime(2023, 12, 31))
+    assert (rows.start, rows.stop) == (1, 3)
+
+def test_dataset_cache_generation():
+    db = FakeGenerationDB()
+    cache = d.DatasetCache(max_bytes=100)
+    loads = []
+    loader = lambda: (loads.append(1) or len(loads), 10)
+    assert cache.get(db, 'trips', loader) == 1
+    assert cache.get(db, 'trips', loader) == 1
+    db.generation = b'2'
+    assert cache.get(db, 'trips', loader) == 2
+    assert cache.stats()['hits'] == 1
+
+def test_dataset_cache_eviction():
+    db = FakeGenerationDB()
+    cache = d.DatasetCache(max_bytes=25)
+    for name in ['a', 'b', 'c']:
+        cache.get(db, name, lambda: (name, 10))
+    assert cache.stats()['entries'] == ['b', 'c']
+    assert cache.nbytes == 20
+    cache.get(db, 'huge', lambda: ('huge', 100))
+    assert 'huge' not in cache.stats()['entries']
+
+def test_records_nbytes():
+    records = [dict(trip) for trip in trips_data for _ in range(1000)]
+    # estimated from a sample of the records
+    assert abs(d.records_nbytes(records) - d.value_nbytes(records)) < 0.01 * d.value_nbytes(records)
+    assert d.records_nbytes(records) > 2 * len(json.dumps(records))
+    assert d.records_nbytes(kiosk_data) == d.value_nbytes(kiosk_data)
+    assert d.records_nbytes([]) == sys.getsizeof([])
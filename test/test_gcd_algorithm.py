@@ -0,0 +1,36 @@
+import math
+import numpy as np
+import pytest
+from gcd_algorithm import great_circle_distance, great_circle_distances
+
+ut_coords = (30.2850, -97.7335)
+capitol_coords = (30.2747, -97.7404)
+
+def test_scalar_matches_law_of_cosines():
+    lat1, long1, lat2, long2 = map(math.radians, ut_coords + capitol_coords)
+    expected = math.acos(math.sin(lat1)*math.sin(lat2) + math.cos(lat1)*math.cos(lat2)*math.cos(long1 - long2)) * 6371.009
+    assert great_circle_distance(*ut_coords, *capitol_coords) == pytest.approx(expected, rel=1e-6)
+    assert great_circle_distance(*ut_coords, *capitol_coords, method='cosines') == pytest.approx(expected, rel=1e-9)
+
+def test_identical_points():
+    # acos of a value rounded above 1 used to raise a math domain error
+    assert great_circle_distance(30.2862730619728, -97.73937727490916, 30.2862730619728, -97.73937727490916, method='cosines') == 0
+    assert great_circle_distance(30.2862730619728, -97.73937727490916, 30.2862730619728, -97.73937727490916) == 0
+
+def test_one_to_many():
+    lats, longs = np.array([ut_coords[0], capitol_coords[0]]), np.array([ut_coords[1], capitol_coords[1]])
+    distances = great_circle_distances(*ut_coords, lats, longs)
+    assert distances.shape == (2,)
+    assert distances[0] == 0
+    assert distances[1] == pytest.approx(great_circle_distance(*ut_coords, *capitol_coords))
+
+def test_pairwise():
+    lats, longs = np.array([ut_coords[0], capitol_coords[0]]), np.array([ut_coords[1], capitol_coords[1]])
+    matrix = great_circle_distances(lats, longs, lats, longs, pairwise=True)
+    assert matrix.shape == (2, 2)
+    assert np.allclose(matrix, matrix.T)
+    assert np.allclose(np.diag(matrix), 0)
+
+def test_invalid_input_format():
+    with pytest.raises(ValueError):
+        great_circle_distance(*ut_coords, *capitol_coords, input_format='gradians')
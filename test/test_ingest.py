@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from functools import partial
+from datetime import datetime, timedelta
+import pytest
+import redis
+import requests
+import data_lib as d
+import ingest
+from ingest import iter_trip_pages, prefetch, ingest_trips, fetch_kiosks, load_dataset, refresh_dataset
+from socrata_stub import synthetic_kiosks, synthetic_trips, serve
+
+kiosks = synthetic_kiosks(20)
+trips = synthetic_trips(2500, kiosks)
+
+@pytest.fixture
+def socrata():
+    with serve(trips, kiosks) as urls:
+        yield urls
+
+def _scratch(index):
+    # separate databases so the loaded dataset is left alone
+    db = redis.Redis(host=os.environ.get("REDIS_IP"), port=6379, db=index)
+    db.flushdb()
+    yield db
+    db.flushdb()
+
+@pytest.fixture
+def scratch_db():
+    yield from _scratch(15)
+
+@pytest.fixture
+def scratch_kiosk_db():
+    yield from _scratch(14)
+
+@pytest.fixture
+def staging_dbs():
+    for trips_db in _scratch(13):
+        for kiosk_db in _scratch(12):
+            yield trips_db, kiosk_db
+
+def test_iter_trip_pages(socrata):
+    trips_url, _ = socrata
+    pages = list(iter_trip_pages(trips_url, 1000, page_size=300))
+    assert [len(page) for page in pages] == [300, 300, 300, 100]
+    loaded = [trip['checkout_datetime'] for page in pages for trip in page]
+    assert loaded == sorted(trip['checkout_datetime'] for trip in trips)[-1000:]
+
+def test_iter_trip_pages_more_rows_than_available(socrata):
+    trips_url, _ = socrata
+    assert sum(len(page) for page in iter_trip_pages(trips_url, 10**6, page_size=1000)) == len(trips)
+
+def test_prefetch_stops_with_consumer():
+    fetched = []
+
+    def _pages():
+        for i in range(10):
+            fetched.append(i)
+            if i == 3:
+                raise requests.ConnectionError('connection reset')
+            yield [i]
+
+    pages = prefetch(_pages(), depth=1)
+    assert next(pages) == [0]
+    time.sleep(0.2)
+    pages.close()
+    time.sleep(3 * ingest.PREFETCH_POLL)
+    # blocked on the full buffer, then stopped without fetching the failing page
+    assert fetched == [0, 1, 2]
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('prefetch')]
+
+def test_ingest_trips(socrata, scratch_db):
+    trips_url, kiosk_url = socrata
+    n_trips = ingest_trips(scratch_db, prefetch(iter_trip_pages(trips_url, 2000, page_size=300)), chunk_size=700)
+    assert n_trips == 2000
+    assert sorted(scratch_db.keys(b'chunk *')) == [b'chunk 0', b'chunk 1', b'chunk 2']
+    stored = d.get_trips(scratch_db)
+    columns = d.load_trip_columns(scratch_db)
+    assert list(columns['row']) == list(range(2000))
+    assert list(d.build_trip_columns(stored)['checkout_epoch']) == list(columns['checkout_epoch'])
+    assert len(fetch_kiosks(kiosk_url)) == len(kiosks)
+
+def test_manifest_skips_chunks(socrata, scratch_db):
+    trips_url, _ = socrata
+    ingest_trips(scratch_db, iter_trip_pages(trips_url, 2000, page_size=300), chunk_size=700)
+    manifest = d.get_manifest(scratch_db)
+    assert [(chunk['key'], chunk['rows']) for chunk in manifest['chunks']] == [('chunk 0', 700), ('chunk 1', 700), ('chunk 2', 600)]
+    assert manifest['rows'] == 2000 and manifest['schema_version'] == d.MANIFEST_SCHEMA_VERSION
+    # a date range inside the middle chunk only reads that chunk
+    middle = manifest['chunks'][1]
+    start = datetime(1970, 1, 1) + timedelta(seconds=middle['min_epoch'] + 1)
+    end = datetime(1970, 1, 1) + timedelta(seconds=middle['max_epoch'] - 1)
+    assert len(d.get_trips(scratch_db, start, end)) == 700
+    # data loaded before manifests were written
+    scratch_db.delete(d.MANIFEST_KEY)
+    rebuilt = d.get_manifest(scratch_db)['chunks']
+    assert [(chunk['key'], chunk['rows'], chunk['min_epoch']) for chunk in rebuilt] == \
+        [(chunk['key'], chunk['rows'], chunk['min_epoch']) for chunk in manifest['chunks']]
+
+def test_ingest_trips_onto_data_without_columns(socrata, scratch_db):
+    trips_url, _ = socrata
+    pages = list(iter_trip_pages(trips_url, 2000, page_size=300))
+    ingest_trips(scratch_db, iter(pages[:3]), chunk_size=700)
+    # data loaded before the trip columns were written
+    scratch_db.delete(*[d.column_key(name) for name in d.TRIP_COLUMNS], d.MANIFEST_KEY)
+    ingest_trips(scratch_db, iter(pages[3:]), chunk_size=700)
+    columns = d.load_trip_columns(scratch_db)
+    assert scratch_db.exists(*[d.column_key(name) for name in d.TRIP_COLUMNS]) == len(d.TRIP_COLUMNS)
+    assert list(columns['checkout_epoch']) == list(d.build_trip_columns(d.get_trips(scratch_db))['checkout_epoch'])
+    assert len(columns['checkout_epoch']) == d.get_manifest(scratch_db)['rows'] == 2000
+
+def test_load_dataset_swaps_when_complete(socrata, scratch_db, scratch_kiosk_db, staging_dbs):
+    trips_url, kiosk_url = socrata
+    load_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url, 1000)
+    progress = []
+
+    def _check_live_data(stats):
+        # the previous dataset keeps serving until the swap
+        progress.append(stats)
+        assert len(d.get_trips(scratch_db)) == 1000
+
+    assert load_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url, 2000,
+                        progress=_check_live_data) == (2000, len(kiosks))
+    assert progress[-1]['rows_written'] == 2000
+    assert len(d.get_trips(scratch_db)) == 2000
+    assert d.get_generation(scratch_db) == 2
+    assert all(db.dbsize() == 0 for db in staging_dbs)
+
+def test_refresh_dataset(scratch_db, scratch_kiosk_db, staging_dbs):
+    ordered = sorted(trips, key=lambda trip: trip['checkout_datetime'])
+    served = ordered[:2000]
+    with serve(served, kiosks) as (trips_url, kiosk_url):
+        assert load_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url, 1500) == (1500, len(kiosks))
+        served.extend(ordered[2000:])
+
+        def _check_live_data(stats):
+            # the previous dataset keeps serving until the swap
+            assert d.get_manifest(scratch_db)['rows'] == 1500
+            assert len(d.load_trip_columns(scratch_db)['checkout_epoch']) == 1500
+
+        assert refresh_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url,
+                               progress=_check_live_data) == (500, len(kiosks))
+    assert all(db.dbsize() == 0 for db in staging_dbs)
+    assert d.get_generation(scratch_db) == 2
+    assert d.get_manifest(scratch_db)['generation'] == 2 and d.get_manifest(scratch_db)['rows'] == 2000
+    assert [trip['trip_id'] for trip in d.get_trips(scratch_db)] == [trip['trip_id'] for trip in ordered[500:]]
+    assert len(d.load_trip_columns(scratch_db)['checkout_epoch']) == 2000
+    assert d.RouteIndex.from_bytes(scratch_db.get(d.ROUTE_INDEX_KEY)).n_trips == 2000
+    assert d.DailyRouteCounts.from_bytes(scratch_db.get(d.DAILY_COUNTS_KEY)).n_trips == 2000
+
+def test_failed_refresh_keeps_dataset(monkeypatch, scratch_db, scratch_kiosk_db, staging_dbs):
+    ordered = sorted(trips, key=lambda trip: trip['checkout_datetime'])
+
+    def _failing_pages(url, high_water_mark):
+        # one chunk is written before the download fails
+        yield ordered[1000:2000]
+        raise requests.ConnectionError('connection reset')
+
+    with serve(ordered[:1000], kiosks) as (trips_url, kiosk_url):
+        load_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url, 1000)
+        monkeypatch.setattr(ingest, 'ingest_trips', partial(ingest.ingest_trips, chunk_size=500))
+        monkeypatch.setattr(ingest, 'iter_new_trip_pages', _failing_pages)
+        with pytest.raises(requests.RequestException):
+            refresh_dataset(scratch_db, scratch_kiosk_db, *staging_dbs, trips_url, kiosk_url)
+    assert d.get_generation(scratch_db) == 1
+    assert d.get_manifest(scratch_db)['rows'] == 1000
+    assert len(d.load_trip_columns(scratch_db)['checkout_epoch']) == 1000
+    assert all(db.dbsize() == 0 for db in staging_dbs)
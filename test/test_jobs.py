@@ -1,6 +1,7 @@
+import threading
 import pytest
 import jobs as j
-from jobs import jdb
+from job_cleanup import delete_jobs
 
 @pytest.fixture
 def setup_job():
@@ -19,6 +20,7 @@ def test_save_and_get_job(setup_job):
     j._save_job(jid, job_dict)
     retrieved_job_dict = j.get_job_by_id(jid)
     assert retrieved_job_dict == job_dict
+    delete_jobs(job_dict)
 
 def test_update_job_status(setup_job):
     jid, job_dict = setup_job
@@ -27,4 +29,74 @@ def test_update_job_status(setup_job):
     j.update_job_status(jid, new_status)
     updated_job_dict = j.get_job_by_id(jid)
     assert updated_job_dict['status'] == new_status
-    jdb.flushdb()
\ No newline at end of file
+    delete_jobs(job_dict)
+
+def test_job_timestamps(setup_job):
+    jid, job_dict = setup_job
+    j._save_job(jid, job_dict)
+    j.update_job_status(jid, "in progress")
+    j.update_job_progress(jid, {'stage': 'plotting'})
+    j.update_job_status(jid, "complete")
+    job = j.get_job_by_id(jid)
+    assert job['submitted_at'] <= job['started_at'] <= job['finished_at']
+    assert abs(job['duration_ms'] - (job['finished_at'] - job['started_at']) * 1000) <= 1
+    assert isinstance(job['wait_ms'], int) and job['progress'] == {'stage': 'plotting'}
+    with pytest.raises(Exception):
+        j.update_job_status(j._generate_jid(), "complete")
+    delete_jobs(job_dict)
+
+def test_canonical_job_params():
+    submitted = {'plot_type': 'trip_duration', 'kiosk1': '4055', 'kiosk2': 'default',
+                 'start_date': '1/31/2023', 'end_date': 'default'}
+    assert j.canonical_job_params(submitted) == {'plot_type': 'trip_duration', 'kiosk1': '2548', 'kiosk2': '4055',
+                                                 'start_date': '01/31/2023', 'end_date': '01/31/2024', 'format': 'png'}
+    radius_3 = {'plot_type': 'trips_per_day', 'start_date': 'default', 'end_date': 'default',
+                'lat': 'default', 'long': 'default', 'radius': '3'}
+    assert j.job_key(radius_3) == j.job_key({**radius_3, 'radius': '3.0'})
+    assert j.job_key(radius_3) != j.job_key({**radius_3, 'radius': '4'})
+
+def test_add_job_deduplicates():
+    params = {'plot_type': 'trips_per_day', 'start_date': '01/31/2023', 'end_date': '01/31/2024',
+              'lat': '30.286', 'long': '-97.739', 'radius': '3'}
+    first = j.add_job(params)
+    second = j.add_job({**params, 'radius': '3.0'})
+    assert second['attached to'] == first['id']
+    j.store_job_result(first['id'], b'plot')
+    j.finish_job(first['id'], 'complete')
+    third = j.add_job(params)
+    assert third['attached to'] == first['id'] and third['status'] == 'complete'
+    assert j.get_results_by_id(second['id']) == b'plot'
+    delete_jobs(first, second, third)
+
+def test_wait_for_job(setup_job):
+    jid, job_dict = setup_job
+    j._save_job(jid, job_dict)
+    assert j.wait_for_job(jid, 0.1)['status'] == "submitted"
+    timer = threading.Timer(0.2, j.update_job_status, [jid, "complete"])
+    timer.start()
+    assert j.wait_for_job(jid, 10)['status'] == "complete"
+    timer.join()
+    statuses = [job['status'] for job in j.watch_job(jid, 10)]
+    assert statuses == ["complete"]
+    delete_jobs(job_dict)
+
+def test_add_jobs_and_get_results():
+    params = {'plot_type': 'trip_duration', 'kiosk1': '4055', 'kiosk2': '2498',
+              'start_date': '01/31/2023', 'end_date': '01/31/2024'}
+    first, second, other = j.add_jobs([params, {**params, 'kiosk1': '2498', 'kiosk2': '4055'}, {**params, 'format': 'csv'}])
+    assert second['attached to'] == first['id'] and 'attached to' not in other
+    j.store_job_result(first['id'], b'plot')
+    j.finish_job(first['id'], 'complete')
+    results = j.get_results_by_ids([first['id'], second['id'], other['id'], 'missing'])
+    assert [result for _, result in results] == [b'plot', b'plot', None, None]
+    assert results[1][0]['status'] == 'complete' and results[2][0]['status'] == 'submitted'
+    assert isinstance(results[3][0], str)
+    delete_jobs(first, second, other)
+
+def test_profiled_jobs_always_run():
+    params = {'plot_type': 'trip_duration', 'kiosk1': '4055', 'kiosk2': '2498',
+              'start_date': '01/31/2023', 'end_date': '01/31/2024'}
+    first, profiled = j.add_jobs([params, {**params, 'profile': True}])
+    assert 'attached to' not in profiled and 'key' not in profiled
+    assert profiled['job parameters']['profile'] is True
+    delete_jobs(first, profiled)
@@ -0,0 +1,74 @@
+import pytest
+import metrics
+from jobs import jdb
+
+def test_render_counter_and_histogram():
+    rows = metrics.Counter('test_rows_total', 'Rows.', ('stage',))
+    seconds = metrics.Histogram('test_seconds', 'Time.', ('stage',), buckets=(0.1, 1))
+    rows.inc(5, stage='fetch')
+    rows.inc(2, stage='fetch')
+    seconds.observe(0.5, stage='fetch')
+    seconds.observe(2, stage='fetch')
+
+    lines = metrics.render([rows, seconds]).splitlines()
+    assert lines[:3] == ['# HELP test_rows_total Rows.', '# TYPE test_rows_total counter',
+                         'test_rows_total{stage="fetch"} 7']
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="0.1"} 0' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="1"} 1' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{stage="fetch"} 2' in lines
+    assert 'test_seconds_sum{stage="fetch"} 2.5' in lines
+
+    with pytest.raises(ValueError):
+        rows.inc(route='/trips')
+
+def test_render_buckets_in_order():
+    seconds = metrics.Histogram('test_seconds', 'Time.', ('stage',), buckets=(0.01, 2.5, 10))
+    seconds.observe(1, stage='fetch')
+    # as read back from Redis, in no particular order
+    samples = {'test_seconds': dict(reversed(list(seconds.samples().items())))}
+    for source in [None, samples]:
+        lines = metrics.render([seconds], [({}, source)]).splitlines()[2:]
+        assert lines == ['test_seconds_bucket{stage="fetch",le="0.01"} 0', 'test_seconds_bucket{stage="fetch",le="2.5"} 1',
+                         'test_seconds_bucket{stage="fetch",le="10"} 1', 'test_seconds_bucket{stage="fetch",le="+Inf"} 1',
+                         'test_seconds_count{stage="fetch"} 1', 'test_seconds_sum{stage="fetch"} 1']
+
+def test_stage_records_rows_and_bytes():
+    with metrics.stage('test_stage') as stage:
+        stage.rows, stage.nbytes = 3, 100
+    assert metrics.STAGE_ROWS.samples()['metrobike_stage_rows_total{stage="test_stage"}'] >= 3
+    assert metrics.STAGE_BYTES.samples()['metrobike_stage_bytes_total{stage="test_stage"}'] >= 100
+    assert metrics.STAGE_SECONDS.samples()['metrobike_stage_seconds_count{stage="test_stage"}'] >= 1
+
+def test_push_and_pull():
+    prefix = 'test:metrics'
+    jobs_total = metrics.Counter('test_jobs_total', 'Jobs.', ('job_type',))
+    jdb.delete(f'{prefix}:test_jobs_total')
+    # two processes pushing their counts
+    for _ in range(2):
+        jobs_total.inc(job_type='trips_per_day')
+        metrics.push(jdb, prefix, [jobs_total])
+        assert jobs_total.samples() == {}
+
+    samples = metrics.pull(jdb, prefix, [jobs_total])
+    assert samples == {'test_jobs_total': {'test_jobs_total{job_type="trips_per_day"}': 2.0}}
+    assert 'test_jobs_total{component="worker",job_type="trips_per_day"} 2' in \
+        metrics.render([jobs_total], [({'component': 'worker'}, samples)])
+    jdb.delete(f'{prefix}:test_jobs_total')
+
+def test_take_and_merge():
+    rows = metrics.Counter('test_rows_total', 'Rows.', ('stage',))
+    seconds = metrics.Histogram('test_seconds', 'Time.', ('stage',), buckets=(1,))
+    merged_rows = metrics.Counter('test_rows_total', 'Rows.', ('stage',))
+    merged_seconds = metrics.Histogram('test_seconds', 'Time.', ('stage',), buckets=(1,))
+    # as in two pool processes
+    for value in [0.5, 2]:
+        rows.inc(3, stage='filter')
+        seconds.observe(value, stage='filter')
+        merged_rows.merge(rows.take())
+        merged_seconds.merge(seconds.take())
+        assert rows.samples() == seconds.samples() == {}
+    assert merged_rows.samples() == {'test_rows_total{stage="filter"}': 6}
+    assert merged_seconds.samples()['test_seconds_bucket{stage="filter",le="1"}'] == 1
+    assert merged_seconds.samples()['test_seconds_count{stage="filter"}'] == 2
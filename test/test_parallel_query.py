@@ -0,0 +1,45 @@
+import os
+from datetime import datetime
+import numpy as np
+import pytest
+import redis
+import data_lib as d
+import metrics as m
+import parallel_query as p
+from ingest import ingest_trips
+from socrata_stub import synthetic_kiosks, synthetic_trips
+
+kiosks = synthetic_kiosks(20)
+trips = sorted(synthetic_trips(2500, kiosks), key=lambda trip: trip['checkout_datetime'])
+
+@pytest.fixture
+def trips_db(monkeypatch):
+    db = redis.Redis(host=os.environ.get("REDIS_IP"), port=6379, db=15)
+    db.flushdb()
+    ingest_trips(db, iter([trips]), chunk_size=400)
+    d.bump_generation(db)
+    # run on the pool however small the data
+    monkeypatch.setattr(p, 'PARALLEL_MIN_ROWS', 0)
+    p.start_pool(db, 3)
+    yield db
+    p.stop_pool()
+    db.flushdb()
+
+def test_filter_trips_matches_serial(trips_db):
+    start, end = datetime(2023, 3, 1), datetime(2023, 9, 1)
+    coordinates = (30.2862730619728, -97.73937727490916)
+    expected = d.filter_by_location(d.filter_by_date(d.get_trips(trips_db), start, end), kiosks, coordinates, 2)
+    assert expected
+    before = m.STAGE_ROWS.samples().get('metrobike_stage_rows_total{stage="location_filter"}', 0)
+    assert p.filter_trips(trips_db, start, end, kiosks, coordinates, 2) == expected
+    # the stages run by the pool processes are recorded here
+    assert m.STAGE_ROWS.samples()['metrobike_stage_rows_total{stage="location_filter"}'] == before + len(expected)
+    p.stop_pool()
+    assert p.filter_trips(trips_db, start, end, kiosks, coordinates, 2) == expected
+
+def test_trip_records_matches_cached(trips_db):
+    rows = np.array([5, 6, 401, 1200, 2499, 7])
+    expected = d.cached_trip_records(trips_db, rows)
+    assert p.trip_records(trips_db, rows) == expected == [trips[row] for row in rows]
+    d.dataset_cache.clear()
+    assert p.trip_records(trips_db, rows) == expected
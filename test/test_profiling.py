@@ -0,0 +1,13 @@
+import uuid
+import profiling
+from jobs import res
+
+def test_profile_round_trip():
+    pid = str(uuid.uuid4())
+    with profiling.profiled(res, pid):
+        sorted(range(1000), key=lambda x: -x)
+    report = profiling.profile_report(profiling.get_profile(res, pid), limit=5)
+    assert 'function calls' in report and 'sorted' in report
+    assert res.ttl(profiling.profile_key(pid)) > 0
+    assert profiling.get_profile(res, str(uuid.uuid4())) is None
+    res.delete(profiling.profile_key(pid))
@@ -0,0 +1,29 @@
+import csv
+import io
+import json
+import numpy as np
+from render import Plot, Renderer
+
+renderer = Renderer(width=4, height=3, dpi=50)
+histogram = Plot('hist', np.arange(0, 4), np.array([5, 0, 2]), 'Trip Durations', 'Trip Duration (minutes)', 'Number of Trips')
+per_day = Plot('line', np.array(['2023-02-01', '2023-02-03'], dtype='datetime64[D]'), np.array([4, 7]),
+               'Trips per day', 'Date', 'Number of Trips')
+
+def test_render_png_reuses_figure():
+    for _ in range(3):
+        png = renderer.render(histogram)
+        assert png.startswith(b'\x89PNG')
+    assert len(renderer.figure.axes) == 1
+
+def test_render_svg():
+    assert b'<svg' in renderer.render(per_day, 'svg')
+
+def test_render_json():
+    assert json.loads(renderer.render(histogram, 'json'))['counts'] == [5, 0, 2]
+    assert json.loads(renderer.render(per_day, 'json'))['x'] == ['2023-02-01', '2023-02-03']
+
+def test_render_csv():
+    rows = list(csv.reader(io.StringIO(renderer.render(histogram, 'csv').decode())))
+    assert rows[1:] == [['0', '1', '5'], ['1', '2', '0'], ['2', '3', '2']]
+    rows = list(csv.reader(io.StringIO(renderer.render(per_day, 'csv').decode())))
+    assert rows == [['Date', 'Number of Trips'], ['2023-02-01', '4'], ['2023-02-03', '7']]
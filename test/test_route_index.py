@@ -0,0 +1,65 @@
+import numpy as np
+from route_index import RouteIndex, DailyRouteCounts
+
+rng = np.random.default_rng(332)
+n = 5000
+columns = {
+    'checkout_epoch': np.sort(rng.integers(1_672_531_200, 1_704_067_200, n)),
+    'checkout_kiosk_id': rng.integers(0, 12, n).astype(np.int32),
+    'return_kiosk_id': rng.integers(0, 12, n).astype(np.int32),
+    'duration_minutes': rng.integers(1, 60, n).astype(np.int32),
+}
+columns['return_kiosk_id'][::50] = -1
+columns['day'] = (columns['checkout_epoch'] // 86400).astype(np.int32)
+index = RouteIndex.build(columns)
+counts = DailyRouteCounts.build(columns)
+
+def brute_force(k1, k2, start, end):
+    checkout, ret, epoch = columns['checkout_kiosk_id'], columns['return_kiosk_id'], columns['checkout_epoch']
+    route = ((checkout == k1) & (ret == k2)) | ((checkout == k2) & (ret == k1))
+    return np.flatnonzero(route & (epoch >= start) & (epoch <= end))
+
+def test_route_matches_brute_force():
+    start, end = 1_680_000_000, 1_690_000_000
+    for k1, k2 in [(3, 7), (7, 3), (5, 5)]:
+        trips = index.route(k1, k2, start, end)
+        expected = brute_force(k1, k2, start, end)
+        assert list(index.epochs[trips]) == list(columns['checkout_epoch'][expected])
+        assert list(index.durations[trips]) == list(columns['duration_minutes'][expected])
+
+def test_route_missing():
+    assert index.route(3, 99) == slice(0, 0)
+    assert index.route(3, -1) == slice(0, 0)
+
+def test_extend_matches_build():
+    extended = RouteIndex.build({name: column[:3000] for name, column in columns.items()})
+    extended = extended.extend({name: column[3000:] for name, column in columns.items()})
+    assert extended.n_trips == n
+    for name in ['routes', 'offsets', 'epochs', 'durations', 'checkout_ids']:
+        assert np.array_equal(getattr(extended, name), getattr(index, name))
+
+def test_serialization_round_trip():
+    loaded = RouteIndex.from_bytes(index.to_bytes())
+    assert loaded.n_trips == n
+    assert list(loaded.durations[loaded.route(3, 7)]) == list(index.durations[index.route(3, 7)])
+
+def test_trips_per_day_matches_brute_force():
+    kiosks = np.array([1, 4, 5, 9])
+    start_day, end_day = 19_400, 19_500
+    days, totals = counts.trips_per_day(kiosks, start_day, end_day)
+    checkout, ret, day = columns['checkout_kiosk_id'], columns['return_kiosk_id'], columns['day']
+    mask = np.isin(checkout, kiosks) & np.isin(ret, kiosks) & (day >= start_day) & (day < end_day)
+    expected_days, expected_totals = np.unique(day[mask], return_counts=True)
+    assert list(days) == list(expected_days)
+    assert list(totals) == list(expected_totals)
+
+def test_daily_counts_extend_matches_build():
+    # split in the middle of a day, so that day is counted in both parts
+    split = int(np.searchsorted(columns['day'], columns['day'][3000])) + 1
+    extended = DailyRouteCounts.build({name: column[:split] for name, column in columns.items()})
+    extended = extended.extend({name: column[split:] for name, column in columns.items()})
+    assert extended.n_trips == n
+    for name in ['days', 'routes', 'counts']:
+        assert np.array_equal(getattr(extended, name), getattr(counts, name))
+    loaded = DailyRouteCounts.from_bytes(extended.to_bytes())
+    assert np.array_equal(loaded.counts, counts.counts)
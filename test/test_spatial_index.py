@@ -0,0 +1,30 @@
+import numpy as np
+from gcd_algorithm import great_circle_distances
+from spatial_index import KioskIndex
+
+rng = np.random.default_rng(332)
+lats = 30.27 + rng.uniform(-0.1, 0.1, 200)
+longs = -97.74 + rng.uniform(-0.1, 0.1, 200)
+index = KioskIndex(lats, longs, np.arange(200))
+ut_coords = (30.2850, -97.7335)
+
+def test_knn_matches_brute_force():
+    distances = great_circle_distances(*ut_coords, lats, longs)
+    positions, knn_distances = index.knn(ut_coords, 10)
+    assert list(positions) == list(np.argsort(distances, kind='stable')[:10])
+    assert np.allclose(knn_distances, np.sort(distances)[:10])
+
+def test_knn_more_than_kiosks():
+    positions, _ = index.knn(ut_coords, 500)
+    assert sorted(positions) == list(range(200))
+
+def test_within_matches_brute_force():
+    distances = great_circle_distances(*ut_coords, lats, longs)
+    positions, within_distances = index.within(ut_coords, 3)
+    assert sorted(positions) == list(np.flatnonzero(distances <= 3))
+    assert np.all(within_distances <= 3)
+
+def test_serialization_round_trip():
+    loaded = KioskIndex.from_bytes(index.to_bytes())
+    assert list(loaded.knn(ut_coords, 5)[0]) == list(index.knn(ut_coords, 5)[0])
+    assert list(loaded.within(ut_coords, 2)[0]) == list(index.within(ut_coords, 2)[0])
@@ -24,3 +24,12 @@ def test_trips_per_day_job():
     result = w.trips_per_day_job(job_params)
     assert result is not None
     assert isinstance(result, bytes)
+
+def test_load_data_job_fails_while_locked(monkeypatch):
+    monkeypatch.setattr(w, 'DATA_LOAD_LOCK_WAIT', 0.1)
+    lock = w.jdb.lock('data_load_lock', timeout=10)
+    assert lock.acquire()
+    try:
+        assert w.load_data_job('test', {'mode': 'incremental'}) == ("failed", "another data load is in progress")
+    finally:
+        lock.release()